@@ -0,0 +1,227 @@
+from .utils import Field
+from .lora_block_weight import LBWLoRALoader
+from .lora_fusion import lora_weights
+from .lora_stack import get_available_loras
+from .model_list import model_list
+from .stack import LoRAStack
+
+from comfy.comfy_types import IO
+import comfy.utils
+import folder_paths
+import torch
+import json
+import os
+
+# 型用
+from comfy.model_patcher import ModelPatcher
+from comfy.sd import CLIP
+
+
+# ===============================================
+# スタックの焼き込み
+# ===============================================
+# LORASTACK を1つの LoRA ファイルにまとめる
+# - 各エントリの strength_model / strength_clip と LBW の倍率は up 側に掛けておく
+# - concat: ランクを連結する (適用結果はスタックと同じ)
+# - svd: 連結したものを QR + 小さな SVD で指定のランクに分解し直す
+#   差分の行列 (out x in) は作らず, キーごとに CPU の float32 で処理する
+# - スケジュール (start / end) 付きのエントリは焼き込めないのでスキップする
+# 出力のキーは ComfyUI の汎用形式 (diffusion_model.* / text_encoders.*)
+MODES = ["concat", "svd"]
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+
+
+def _split_key(key):
+    """(重みのキー, 出力方向の範囲 (start, length) または None)"""
+    if isinstance(key, str):
+        return (key, None)
+    # 結合された重み (qkv 等) の一部へのパッチ: (キー, (dim, start, length))
+    if isinstance(key, tuple) and len(key) >= 2 and isinstance(key[1], tuple) and len(key[1]) == 3 and key[1][0] == 0:
+        return (key[0], key[1][1:])
+    return (None, None)
+
+
+def _merge_terms(terms: list, out_features: int, mode: str, rank: int):
+    """[(scale, up, down, rows)] を1つの (up, down, rank) にまとめる"""
+    ups = []
+    downs = []
+    for scale, up, down, rows in terms:
+        up = up.reshape(up.shape[0], up.shape[1]).to(device="cpu", dtype=torch.float32) * scale
+        if rows is not None:
+            # 一部の行だけに掛かるパッチは, それ以外の行を 0 にした up で表す
+            padded = up.new_zeros((out_features, up.shape[1]))
+            padded[rows[0]:rows[0] + rows[1]] = up
+            up = padded
+        ups.append(up)
+        downs.append(down.reshape(down.shape[0], -1).to(device="cpu", dtype=torch.float32))
+
+    up = torch.cat(ups, dim=1)
+    down = torch.cat(downs, dim=0)
+    if mode != "svd" or up.shape[1] <= rank:
+        return (up, down, up.shape[1])
+
+    # up @ down = Qu (Ru Rd^T) Qd^T  小さな行列 (Ru Rd^T) だけを SVD する
+    q_up, r_up = torch.linalg.qr(up)
+    q_down, r_down = torch.linalg.qr(down.T)
+    u, s, vh = torch.linalg.svd(r_up @ r_down.T, full_matrices=False)
+    rank = min(rank, s.shape[0])
+    sqrt_s = s[:rank].sqrt()
+    up = q_up @ (u[:, :rank] * sqrt_s)
+    down = (sqrt_s[:, None] * vh[:rank]) @ q_down.T
+    return (up, down, rank)
+
+
+def _output_path(filename: str) -> tuple[str, str]:
+    """(loras フォルダからの相対パス, フルパス)"""
+    name = filename.strip().replace("\\", "/")
+    if not name:
+        raise ValueError("bake: ファイル名が空です")
+    if not name.endswith(".safetensors"):
+        name += ".safetensors"
+
+    output_dir = os.path.abspath(folder_paths.get_folder_paths("loras")[0])
+    path = os.path.abspath(os.path.join(output_dir, name))
+    if os.path.commonpath([output_dir, path]) != output_dir:
+        raise ValueError(f"bake: loras フォルダの外には保存できません: {filename}")
+    return (os.path.relpath(path, output_dir), path)
+
+
+def bake_stack(
+    stack: LoRAStack,
+    model: ModelPatcher,
+    clip: CLIP=None,
+    filename: str="baked_stack",
+    mode: str="concat",
+    rank: int=64,
+    dtype: str="fp16",
+    overwrite: bool=False,
+) -> str:
+    """スタックを1つの LoRA ファイルとして loras フォルダに保存し, その名前を返す"""
+    if mode not in MODES:
+        raise ValueError(f"bake: 不明なモードです: {mode}")
+    lora_name, path = _output_path(filename)
+    if os.path.exists(path) and not overwrite:
+        raise ValueError(f"bake: {lora_name} は既に存在します")
+
+    stack = LoRAStack.from_value(stack)
+    loader = LBWLoRALoader()
+    model_sd = model.model.state_dict()
+    clip_sd = clip.cond_stage_model.state_dict() if clip is not None else {}
+
+    # 重みのキー -> [(scale, up, down, rows)]
+    terms: dict[str, list] = {}
+    baked = []
+    skipped_scheduled = []
+    skipped_patches = 0
+
+    for value, lora_path in get_available_loras(stack):
+        if not value.enabled: continue
+        if value.start > 0 or value.end < 1:
+            skipped_scheduled.append(value.lora)
+            continue
+
+        strength_model = value.strength_model
+        strength_clip = value.strength_clip if value.clip_mode else strength_model
+        if clip is None:
+            strength_clip = 0
+        if strength_model == 0 and strength_clip == 0: continue
+
+        # LBW の倍率は通常の適用と同じく create_lbw_info の結果を使う
+        loaded, model_mapped, clip_mapped = loader.create_lbw_info(model, clip, value.lora, value.lbw, lora_path)
+        for key, patch in loaded.items():
+            weight_key, rows = _split_key(key)
+            if weight_key in model_sd:
+                scale = strength_model * model_mapped.get(key, 1)
+            elif weight_key in clip_sd:
+                scale = strength_clip * clip_mapped.get(key, 1)
+            else:
+                continue
+            if scale == 0: continue
+
+            weights = lora_weights(patch)
+            # LoHa / LoKr / DoRA / Tucker 分解などは LoRA の形で表せない
+            if weights is None or not weight_key.endswith(".weight") or any(w is not None for w in weights[3:6]):
+                skipped_patches += 1
+                continue
+
+            up, down, alpha = weights[0], weights[1], weights[2]
+            if alpha is not None:
+                scale *= alpha / down.shape[0]
+            terms.setdefault(weight_key, []).append((scale, up, down, rows))
+        baked.append(value.to_dict())
+
+    if not terms:
+        raise ValueError("bake: 焼き込めるLoRAがありません")
+
+    out_dtype = DTYPES.get(dtype, torch.float16)
+    sd = {}
+    skipped_keys = 0
+    for weight_key, key_terms in terms.items():
+        weight = model_sd.get(weight_key, clip_sd.get(weight_key))
+        # 畳み込みなどの down の形 (rank 以外) が揃っていなければまとめられない
+        if len({tuple(down.shape[1:]) for _scale, _up, down, _rows in key_terms}) != 1:
+            skipped_keys += 1
+            continue
+
+        up, down, key_rank = _merge_terms(key_terms, weight.shape[0], mode, rank)
+        up_shape = (up.shape[0], key_rank) + (1,) * (key_terms[0][1].dim() - 2)
+        down_shape = (key_rank,) + tuple(key_terms[0][2].shape[1:])
+
+        prefix = weight_key[:-len(".weight")]
+        if weight_key in clip_sd and weight_key not in model_sd:
+            prefix = f"text_encoders.{prefix}"
+        sd[f"{prefix}.lora_up.weight"] = up.reshape(up_shape).to(out_dtype).contiguous()
+        sd[f"{prefix}.lora_down.weight"] = down.reshape(down_shape).to(out_dtype).contiguous()
+        sd[f"{prefix}.alpha"] = torch.tensor(float(key_rank))
+
+    metadata = {
+        "modelspec.title": os.path.splitext(os.path.basename(lora_name))[0],
+        "jupo_lorastack.baked_from": json.dumps(baked, ensure_ascii=False),
+        "jupo_lorastack.mode": mode,
+    }
+    if mode == "svd":
+        metadata["jupo_lorastack.rank"] = str(rank)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    comfy.utils.save_torch_file(sd, path, metadata=metadata)
+    model_list.invalidate("loras")
+
+    if skipped_scheduled:
+        print(f"[jupo-lorastack] bake: {len(skipped_scheduled)} scheduled LoRA(s) not baked: {', '.join(skipped_scheduled)}")
+    if skipped_patches or skipped_keys:
+        print(f"[jupo-lorastack] bake: skipped {skipped_patches} non-LoRA patch(es), {skipped_keys} key(s) with mismatched shapes")
+    print(f"[jupo-lorastack] bake: saved {lora_name} ({len(baked)} LoRA(s), {len(terms) - skipped_keys} key(s))")
+    return lora_name
+
+
+
+# ===============================================
+# Bake LoRA Stack
+# ===============================================
+class BakeLoRAStack:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "model": Field.model(), 
+                "stack": ("LORASTACK", {}), 
+                "filename": Field.string(default="baked_stack"), 
+                "mode": Field.combo(MODES), 
+                "rank": Field.int(default=64, min=1, max=1024), 
+                "dtype": Field.combo(list(DTYPES)), 
+                "overwrite": Field.boolean(default=False), 
+            }, 
+            "optional": {
+                "clip": Field.clip(), 
+            }, 
+        }
+
+    RETURN_TYPES = (IO.STRING, )
+    RETURN_NAMES = ("lora_name", )
+    FUNCTION = "execute"
+    OUTPUT_NODE = True
+
+    def execute(self, model, stack, filename="baked_stack", mode="concat", rank=64, dtype="fp16", overwrite=False, clip=None):
+        lora_name = bake_stack(stack, model, clip, filename, mode, rank, dtype, overwrite)
+
+        return (lora_name, )
@@ -0,0 +1,93 @@
+from server import PromptServer
+from .workers import coalesce
+
+import aiohttp
+import asyncio
+import time
+import os
+
+
+# ===============================================
+# Civitai API クライアント
+# ===============================================
+# - ClientSession を使い回して接続 (DNS, TLS) を再利用する
+# - 同じキーの処理が実行中なら同じ Future を共有する (リクエストの重複排除)
+# - タイムアウト, リトライ回数, バックオフは環境変数で設定できる
+BASE_URL = os.environ.get("JUPO_CIVITAI_BASE_URL", "https://civitai.com").rstrip("/")
+TIMEOUT = float(os.environ.get("JUPO_CIVITAI_TIMEOUT", 30))
+RETRIES = int(os.environ.get("JUPO_CIVITAI_RETRIES", 3))
+BACKOFF = float(os.environ.get("JUPO_CIVITAI_BACKOFF", 1.0))
+CONNECTION_LIMIT = int(os.environ.get("JUPO_CIVITAI_CONNECTIONS", 8))
+
+# リトライ対象のステータス
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_session: aiohttp.ClientSession = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """共有の ClientSession を取得 (イベントループ上で呼ぶこと)"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            limit_per_host=CONNECTION_LIMIT,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=TIMEOUT, sock_read=TIMEOUT),
+        )
+    return _session
+
+
+async def close_session(*args):
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+try:
+    PromptServer.instance.app.on_cleanup.append(close_session)
+except (AttributeError, RuntimeError):
+    pass
+
+
+async def get_json(url: str) -> tuple[int, dict]:
+    """GET してステータスと JSON を返す (ネットワークエラー, 429, 5xx はバックオフしてリトライ)"""
+    session = get_session()
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+
+    for attempt in range(RETRIES + 1):
+        try:
+            async with session.get(url, timeout=timeout) as response:
+                if response.status == 200:
+                    return (200, await response.json())
+                if response.status not in RETRY_STATUS or attempt == RETRIES:
+                    return (response.status, {})
+                retry_after = response.headers.get("Retry-After")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == RETRIES:
+                print(f"Civitai request failed: {e}")
+                return (0, {})
+            retry_after = None
+
+        delay = BACKOFF * (2 ** attempt)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        await asyncio.sleep(delay)
+
+    return (0, {})
+
+
+async def fetch_model_version_by_hash(file_hash: str) -> tuple[int, dict]:
+    """ハッシュからモデルバージョン情報を取得 (同じハッシュの同時リクエストは1つにまとめる)"""
+    async def fetch():
+        start = time.time()
+        result = await get_json(f"{BASE_URL}/api/v1/model-versions/by-hash/{file_hash}")
+        print(f"Civitaiデータ取得完了: {time.time() - start:.4f}秒")
+        return result
+
+    return await coalesce(("by-hash", file_hash), fetch)
@@ -0,0 +1,188 @@
+from .workers import run_blocking, run_hash_job, coalesce
+from .hash_index import get_hash
+from .search_index import search_indexes
+from . import civitai
+import folder_paths
+
+import threading
+import asyncio
+import sqlite3
+import json
+import time
+import os
+
+
+# ===============================================
+# Civitai サイドカー (.civitai.json) のキャッシュポリシー
+# ===============================================
+# サイドカーの内容は Civitai API のレスポンスのまま保持し
+# 取得結果 (hit / miss) と取得時刻は別の SQLite に記録する
+# - hit / miss で別々の TTL を持つ
+# - TTL 切れでもローカルのデータを即座に返し, バックグラウンドで再取得する
+# - miss (API が 200 以外) と error (通信エラー) は失敗回数に応じて再取得までの間隔を伸ばす
+# - hit の再取得に失敗した場合はデータを残し, error と同じ間隔で再試行する
+# - 壊れたサイドカー (JSON として読めない) は無いものとして扱う
+DAY = 24 * 60 * 60
+HIT_TTL = float(os.environ.get("JUPO_CIVITAI_HIT_TTL_DAYS", 30)) * DAY
+MISS_TTL = float(os.environ.get("JUPO_CIVITAI_MISS_TTL_DAYS", 1)) * DAY
+MISS_TTL_MAX = float(os.environ.get("JUPO_CIVITAI_MISS_TTL_MAX_DAYS", 30)) * DAY
+ERROR_TTL = float(os.environ.get("JUPO_CIVITAI_ERROR_TTL_MINUTES", 10)) * 60
+
+STATUS_HIT = "hit"
+STATUS_MISS = "miss"
+STATUS_ERROR = "error"
+
+
+def _default_db_path():
+    return os.path.join(folder_paths.get_user_directory(), "jupo-lorastack", "civitai_state.sqlite3")
+
+
+class SidecarState:
+    def __init__(self, db_path: str=None):
+        self.db_path = db_path or _default_db_path()
+        self.conn = None
+        self.lock = threading.RLock()
+
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sidecar_state (
+                    info_file TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    failures INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+
+    def lookup(self, info_file: str) -> tuple[str, float, int] | None:
+        with self.lock:
+            return self._connect().execute(
+                "SELECT status, fetched_at, failures FROM sidecar_state WHERE info_file=?",
+                (info_file,),
+            ).fetchone()
+
+
+    def get(self, info_file: str, info: dict) -> tuple[str, float, int]:
+        """(status, fetched_at, failures) を返す  未記録ならサイドカーの内容と mtime から推定する"""
+        row = self.lookup(info_file)
+        if row is not None:
+            return row
+
+        status = STATUS_HIT if info else STATUS_MISS
+        return (status, os.path.getmtime(info_file), 0 if info else 1)
+
+
+    def set(self, info_file: str, status: str, failures: int):
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO sidecar_state (info_file, status, fetched_at, failures) VALUES (?, ?, ?, ?)",
+                (info_file, status, time.time(), failures),
+            )
+            conn.commit()
+
+
+state = SidecarState()
+_background_tasks: set[asyncio.Task] = set()
+
+
+def ttl_for(status: str, failures: int) -> float:
+    backoff = 2 ** max(failures - 1, 0)
+    if status == STATUS_HIT and failures == 0:
+        return HIT_TTL
+    if status in (STATUS_HIT, STATUS_ERROR):
+        return min(ERROR_TTL * backoff, MISS_TTL)
+    return min(MISS_TTL * backoff, MISS_TTL_MAX)
+
+
+def _read_json(path: str):
+    with open(path, mode="r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _write_json(path: str, data):
+    # 書き込み途中のファイルを読まれないように一時ファイルから置き換える
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, mode="w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False, indent=4)
+    os.replace(temp_path, path)
+
+
+def _read_local(info_file: str):
+    """サイドカーと状態を読む  サイドカーも通信エラーの記録もなければ None"""
+    if os.path.isfile(info_file):
+        try:
+            info = _read_json(info_file)
+        except ValueError:
+            info = None
+        if info is not None:
+            return (info, state.get(info_file, info))
+
+    row = state.lookup(info_file)
+    if row is not None and row[0] == STATUS_ERROR:
+        return ({}, row)
+    return None
+
+
+async def get_info(file_path: str, refresh: bool=False) -> tuple[dict, str]:
+    """Civitai 情報と取得元 ("local", "stale", "remote") を返す"""
+    info_file = os.path.splitext(file_path)[0] + ".civitai.json"
+
+    local = None if refresh else await run_blocking(_read_local, info_file)
+    if local is not None:
+        info, (status, fetched_at, failures) = local
+        if time.time() - fetched_at < ttl_for(status, failures):
+            return (info, "local")
+
+        # 期限切れ: ローカルのデータを返しつつバックグラウンドで再取得
+        task = asyncio.ensure_future(revalidate(file_path, info_file))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        return (info, "stale")
+
+    info = await revalidate(file_path, info_file)
+    return (info, "remote")
+
+
+async def revalidate(file_path: str, info_file: str) -> dict:
+    # 同じモデルへの同時リクエストはハッシュ計算から API まで1回にまとめる
+    return await coalesce(("civitai-info", info_file), lambda: _fetch(file_path, info_file))
+
+
+async def _fetch(file_path: str, info_file: str) -> dict:
+    local = await run_blocking(_read_local, info_file)
+    prev_info, (prev_status, _fetched_at, prev_failures) = local if local else ({}, (STATUS_MISS, 0, 0))
+
+    # civitai API から取得 (ハッシュ計算はワーカーで同時実行数を制限)
+    file_hash = await run_hash_job(get_hash, file_path)
+    status, info = await civitai.fetch_model_version_by_hash(file_hash)
+
+    if status == 200:
+        await run_blocking(_write_json, info_file, info)
+        await run_blocking(state.set, info_file, STATUS_HIT, 0)
+        await run_blocking(search_indexes.notify_sidecar, file_path)
+        print("Civitaiデータを保存しました")
+        return info
+
+    # 取得失敗: 以前に取得できたデータは上書きせず, 再試行の間隔を伸ばしていく
+    if prev_status == STATUS_HIT and prev_info:
+        await run_blocking(state.set, info_file, STATUS_HIT, prev_failures + 1)
+        return prev_info
+
+    if status == 0:
+        # 通信エラー: サイドカーは作らず短い間隔で再試行
+        await run_blocking(state.set, info_file, STATUS_ERROR, prev_failures + 1)
+        return prev_info
+
+    if not prev_info:
+        await run_blocking(_write_json, info_file, {})
+    await run_blocking(state.set, info_file, STATUS_MISS, prev_failures + 1)
+    return prev_info
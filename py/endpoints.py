@@ -1,14 +1,24 @@
 from .utils import Endpoint
+from .lora_cache import cache_stats
+from .workers import run_blocking, coalesce, executor
+from .safetensors_header import get_metadata
+from .indexer import indexer
+from .schedule import schedule_stats
+from .preview_index import preview_index
+from .media_tokens import media_tokens
+from .thumbnails import thumbnail_cache, normalize_size
+from .model_list import model_list, filter_files
+from .search_index import SearchIndex, search_indexes, REFRESH_INTERVAL
+from . import civitai
+from . import civitai_sidecar
 import folder_paths
 
 from aiohttp import web
-import aiohttp
 import os
-import json
-import hashlib
 import time
 import mimetypes
-import uuid
+import stat
+import hashlib
 from urllib.parse import urlparse, unquote
 from tqdm import tqdm
 import aiofiles
@@ -24,11 +34,115 @@ import time
 @Endpoint.get("files/{dir}")
 async def get_files(req: web.Request):
     directory = req.match_info["dir"]
-    filename_list = folder_paths.get_filename_list(directory)
+    filename_list = await run_blocking(folder_paths.get_filename_list, directory)
     
     return web.json_response(filename_list)
 
 
+# --- バージョン付きのファイル一覧を取得
+# ?prefix=subdir/  サブフォルダ等で絞り込み
+# ?offset=0&limit=1000  ページング
+# ?since=<version>  指定バージョンからの差分 (added, removed) のみ返す
+#                   バージョンが古すぎる場合は全件を返す ("delta": false)
+@Endpoint.get("list/{dir}")
+async def get_file_list(req: web.Request):
+    directory = req.match_info["dir"]
+    query = req.query
+    prefix = query.get("prefix")
+    since = query.get("since")
+    
+    try:
+        offset = max(0, int(query.get("offset", 0)))
+        limit = int(query["limit"]) if "limit" in query else None
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid offset or limit"}, status=400)
+    
+    version, files = await run_blocking(model_list.get, directory)
+    
+    # 同じバージョン, 同じクエリならレスポンスも同じ
+    query_key = "&".join(f"{k}={v}" for k, v in sorted(query.items()))
+    etag = f'"{version}-{hashlib.sha1(query_key.encode("utf-8")).hexdigest()[:8]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(req.headers.get("If-None-Match"), etag):
+        return web.Response(status=304, headers=headers)
+    
+    if since:
+        delta = await run_blocking(model_list.delta, directory, since)
+        if delta is not None:
+            version, added, removed = delta
+            return web.json_response({
+                "version": version, 
+                "delta": True, 
+                "added": filter_files(added, prefix), 
+                "removed": filter_files(removed, prefix), 
+            }, headers=headers)
+    
+    files = filter_files(files, prefix)
+    page = files[offset:] if limit is None else files[offset:offset + max(0, limit)]
+    return web.json_response({
+        "version": version, 
+        "delta": False, 
+        "total": len(files), 
+        "offset": offset, 
+        "files": page, 
+    }, headers=headers)
+
+
+# --- ファイル名, Civitai情報, metadata から検索
+# ?q=検索語&limit=50
+MAX_SEARCH_LIMIT = 500
+
+@Endpoint.get("search/{dir}")
+async def search_files(req: web.Request):
+    directory = req.match_info["dir"]
+    query = req.query.get("q", "")
+    try:
+        limit = max(1, min(MAX_SEARCH_LIMIT, int(req.query.get("limit", 50))))
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid limit"}, status=400)
+    if not search_indexes.is_known(directory):
+        return web.json_response({"status": "error", "message": f"Unknown directory: {directory}"}, status=404)
+    
+    start = time.time()
+    # 最初の検索ではインデックスを構築する  同時に来た検索は同じ構築を待つ (ワーカーを1つしか使わない)
+    index = await coalesce(("search-index", directory), lambda: run_blocking(search_indexes.get, directory))
+    total, results = await run_blocking(_search, index, query, limit)
+    elapsed = time.time() - start
+    
+    return web.json_response({
+        "query": query, 
+        "total": total, 
+        "results": results, 
+        "elapsed": round(elapsed, 4), 
+    })
+
+
+def _search(index: SearchIndex, query: str, limit: int):
+    # サイドカーの変更はバックグラウンドで定期的に確認
+    if time.time() - index.last_refresh > REFRESH_INTERVAL:
+        index.last_refresh = time.time()
+        executor.submit(index.refresh_sidecars)
+    return index.search(query, limit)
+
+
+# --- LoRAキャッシュの統計を取得
+@Endpoint.get("cache/stats")
+async def get_cache_stats(req: web.Request):
+    return web.json_response(cache_stats())
+
+
+# --- スケジュール (Hook) の切り替え回数を取得
+@Endpoint.get("schedule/stats")
+async def get_schedule_stats(req: web.Request):
+    return web.json_response(schedule_stats.stats())
+
+
+# --- バックグラウンドインデクサの進捗を取得
+@Endpoint.get("index/status")
+async def get_index_status(req: web.Request):
+    return web.json_response(indexer.status())
+
+
 # --- モデルのフルパスを取得
 def get_fullpath(path: str):
     pos = path.index("/")
@@ -47,9 +161,11 @@ async def load_metadata(req: web.Request):
     if not file_path:
         return web.json_response({})
     
+    fields = _parse_fields(req.query.get("fields"))
+    
     start = time.time()
     try:
-        metadata = get_metadata(file_path)
+        metadata = await run_blocking(get_metadata, file_path, fields)
     except:
         metadata = {}
     elapsed = time.time() - start
@@ -58,21 +174,48 @@ async def load_metadata(req: web.Request):
     return web.json_response(metadata)
 
 
-def get_metadata(filepath):
-    with open(filepath, "rb") as file:
-        # https://github.com/huggingface/safetensors#format
-        # 8 bytes: N, an unsigned little-endian 64-bit integer, containing the size of the header
-        header_size = int.from_bytes(file.read(8), "little", signed=False)
+def _parse_fields(value) -> list[str]:
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+    return [str(field).strip() for field in value if str(field).strip()]
 
-        if header_size <= 0:
-            raise BufferError("Invalid header size")
 
-        header = file.read(header_size)
-        if header_size <= 0:
-            raise BufferError("Invalid header")
+# --- 複数モデルのmetadataをまとめて取得
+# body: {"paths": ["loras/xxx.safetensors", ...], "fields": ["ss_base_model_version", ...]}
+MAX_BULK_PATHS = 5000
+
+@Endpoint.post("metadata")
+async def load_metadata_bulk(req: web.Request):
+    try:
+        data = await req.json()
+    except Exception:
+        return web.json_response({"status": "error", "message": "Invalid JSON"}, status=400)
+    
+    paths = data.get("paths")
+    if not isinstance(paths, list):
+        return web.json_response({"status": "error", "message": "paths is required."}, status=400)
+    if len(paths) > MAX_BULK_PATHS:
+        return web.json_response({"status": "error", "message": f"Too many paths (max {MAX_BULK_PATHS})."}, status=400)
+    
+    fields = _parse_fields(data.get("fields"))
+    result = await run_blocking(_get_metadata_bulk, [str(path) for path in paths], fields)
+    return web.json_response(result)
+
 
-        header_json = json.loads(header)
-        return header_json["__metadata__"] if "__metadata__" in header_json else None
+def _get_metadata_bulk(paths: list[str], fields: list[str]) -> dict:
+    result = {}
+    for path in paths:
+        metadata = None
+        try:
+            file_path = get_fullpath(path)
+            if file_path:
+                metadata = get_metadata(file_path, fields)
+        except Exception:
+            pass
+        result[path] = metadata or {}
+    return result
 
 
 # --- Civitaiから情報を取得
@@ -84,83 +227,19 @@ async def load_civitai_info(req: web.Request):
     if not file_path:
         return web.json_response({})
     
-    # infoファイルの確認
-    info = {}
-    file_no_ext = os.path.splitext(file_path)[0]
-    info_file = file_no_ext + ".civitai.json"
-
-    if os.path.isfile(info_file):
-        with open(info_file, mode="r", encoding="utf-8") as file:
-            info = json.load(file)
-    
-    else:
-        # civitai API から取得
-        file_hash = get_hash(file_path)
-        
-        url = f"https://civitai.com/api/v1/model-versions/by-hash/{file_hash}"
-
-        # APIリクエスト
-        info_start = time.time()
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    info = await response.json()
-        info_elapsed = time.time() - info_start
-        print(f"Civitaiデータ取得完了: {info_elapsed:.4f}秒")
-        
-        # infoファイルを保存
-        with open(info_file, mode="w", encoding="utf-8") as file:
-            json.dump(info, file, ensure_ascii=False, indent=4)
-        print("Civitaiデータを保存しました")
-    
-    return web.json_response(info)
-
-
-def get_hash(file_path: str):
-    start = time.time()
-    chunk_size = 8 * 1024 * 1024
-    try:
-        # blake3使用可能時
-        from blake3 import blake3
-        hasher = blake3()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(chunk_size), b""):
-                hasher.update(chunk)
-        file_hash = hasher.hexdigest()
-    
-    except:
-        # hashlibで
-        sha256 = hashlib.sha256()
-        with open(file_path, "rb") as file:
-            for chunk in iter(lambda: file.read(chunk_size), b""):
-                sha256.update(chunk)
-        file_hash = sha256.hexdigest()
-    
-    elapsed = time.time() - start
-    print(f"ハッシュ取得完了: {elapsed:.2f}秒")
-
-    return file_hash
-    
+    # ローカルのデータを優先して返す (期限切れならバックグラウンドで再取得)
+    # ?refresh=1 で強制的に再取得
+    refresh = req.query.get("refresh") in ("1", "true")
+    info, source = await civitai_sidecar.get_info(file_path, refresh)
+    return web.json_response(info, headers={"X-Jupo-Civitai-Source": source})
 
 
-        
 # --- 同フォルダからプレビューメディアを取得
 # --- メディア用トークンを返す
-media_cache = {}
-TOKEN_EXPIRE_TIME = 3600
-
-def cleanup_expired_tokens():
-    """期限切れトークンをクリーンアップ"""
-    current_time = time.time()
-    expired_tokens = [
-        token for token, data in media_cache.items()
-        if current_time - data.get("created_at", 0) > TOKEN_EXPIRE_TIME
-    ]
-    
-    for token in expired_tokens:
-        del media_cache[token]
-    
-    return len(expired_tokens)
+def _issue_media_token(full_path: str, cate: str) -> dict:
+    # 同じファイル (パス, mtime) には同じトークンが返る
+    token = media_tokens.issue(full_path, cate)
+    return {"path": full_path, "cate": cate, "token": token}
 
 
 @Endpoint.get("preview/{path}")
@@ -174,38 +253,84 @@ async def get_preview_media(req: web.Request):
         if not file_path:
             return web.json_response(res)
 
-        # メディア候補
-        SUPPORTED_EXTENSIONS = {
-            "image": ["jpg", "jpeg", "bmp", "png", "webp", "gif"],
-            "video": ["mp4", "webm"],
-            "audio": ["mp3", "ogg", "wav"]
-        }
-        file_no_ext = os.path.splitext(file_path)[0]
-
-        for cate, exts in SUPPORTED_EXTENSIONS.items():
-            for ext in exts:
-                if os.path.isfile(f"{file_no_ext}.{ext}"):
-                    full_path = f"{file_no_ext}.{ext}"
-                    
-                    token = str(uuid.uuid4())
-                    media_cache[token] = {
-                        "path": full_path, 
-                        "cate": cate, 
-                        "created_at": time.time()
-                    }
-                    
-                    res["path"] = full_path
-                    res["cate"] = cate
-                    res["token"] = token
-                    return web.json_response(res)
+        # フォルダ単位のインデックスから検索 (フォルダの mtime が変わらなければ stat 1回)
+        found = await run_blocking(preview_index.find, file_path)
+        if found is None:
+            return web.json_response(res)
         
-        return web.json_response(res)
+        return web.json_response(await run_blocking(_issue_media_token, *found))
     
     except Exception as e:
         print(f"Error processing media token request: {e}")
         return web.json_response(res)
 
 
+# --- 複数モデルのプレビューをまとめて取得
+# body: {"paths": ["loras/xxx.safetensors", ...]}
+@Endpoint.post("previews")
+async def get_preview_media_bulk(req: web.Request):
+    try:
+        data = await req.json()
+    except Exception:
+        return web.json_response({"status": "error", "message": "Invalid JSON"}, status=400)
+    
+    paths = data.get("paths")
+    if not isinstance(paths, list):
+        return web.json_response({"status": "error", "message": "paths is required."}, status=400)
+    if len(paths) > MAX_BULK_PATHS:
+        return web.json_response({"status": "error", "message": f"Too many paths (max {MAX_BULK_PATHS})."}, status=400)
+    
+    result = await run_blocking(_find_previews_bulk, [str(path) for path in paths])
+    return web.json_response(result)
+
+
+def _find_previews_bulk(paths: list[str]) -> dict:
+    result = {}
+    for path in paths:
+        res = {"path": None, "cate": None, "token": None}
+        try:
+            file_path = get_fullpath(path)
+            found = preview_index.find(file_path) if file_path else None
+            if found is not None:
+                res = _issue_media_token(*found)
+        except Exception:
+            pass
+        result[path] = res
+    return result
+
+
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+
+def _stat_file(path: str):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
+
+
+def _read_file(path: str) -> bytes | None:
+    try:
+        with open(path, "rb") as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for value in if_none_match.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        if value == etag:
+            return True
+    return False
+
+
 @Endpoint.get("media/{token}")
 async def serve_media(req: web.Request):
     """トークン経由でメディアファイルを配信"""
@@ -214,7 +339,7 @@ async def serve_media(req: web.Request):
         if not token:
             return web.Response(status=400, text="Token required")
         
-        media_data = media_cache.get(token)
+        media_data = media_tokens.get(token)
         if not media_data:
             return web.Response(status=404, text="Token not found or expired")
         
@@ -222,11 +347,26 @@ async def serve_media(req: web.Request):
         if not file_path:
             return web.Response(status=404, text="File path not found")
         
-        if not os.path.isfile(file_path):
+        st = await run_blocking(_stat_file, file_path)
+        if st is None:
             # ファイルが存在しない場合、キャッシュからも削除
-            del media_cache[token]
+            media_tokens.remove(token)
             return web.Response(status=404, text="File not found")
         
+        if st.st_mtime_ns != media_data.get("mtime_ns"):
+            # トークン発行後にファイルが更新された (URL は不変として配信しているので別トークンにする)
+            media_tokens.remove(token)
+            return web.Response(status=404, text="Token expired")
+        
+        # トークンはファイルの (パス, mtime) から決まるため URL ごとの内容は不変
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        cache_headers = {
+            "ETag": etag, 
+            "Cache-Control": f"private, max-age={MEDIA_MAX_AGE}, immutable", 
+        }
+        if _etag_matches(req.headers.get("If-None-Match"), etag):
+            return web.Response(status=304, headers=cache_headers)
+        
         # MIMEタイプ指定
         mime_type, encoding = mimetypes.guess_type(file_path)
         if not mime_type:
@@ -241,10 +381,12 @@ async def serve_media(req: web.Request):
             else:
                 mime_type = "application/octet-stream"
         
-        headers = {"Content-Type": mime_type}
+        headers = {"Content-Type": mime_type, "Accept-Ranges": "bytes"}
+        headers.update(cache_headers)
         if encoding:
             headers["Content-Encoding"] = encoding
         
+        # Range / If-Modified-Since / If-Range は FileResponse が処理する
         return web.FileResponse(file_path, headers=headers)
     
     except Exception as e:
@@ -252,24 +394,69 @@ async def serve_media(req: web.Request):
         return web.Response(status=500, text="Internal server error")
 
 
+# --- サムネイルを配信
+# ?size=256 (SIZE_STEP 単位に切り上げ)  生成できない場合は 404 (クライアントは元のメディアを使う)
+@Endpoint.get("thumbnail/{token}")
+async def serve_thumbnail(req: web.Request):
+    try:
+        token = req.match_info["token"]
+        media_data = media_tokens.get(token)
+        if not media_data:
+            return web.Response(status=404, text="Token not found or expired")
+        
+        file_path = media_data.get("path")
+        st = await run_blocking(_stat_file, file_path)
+        if st is None or st.st_mtime_ns != media_data.get("mtime_ns"):
+            return web.Response(status=404, text="File not found")
+        
+        size = normalize_size(req.query.get("size"))
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}-{size}"'
+        cache_headers = {
+            "ETag": etag, 
+            "Cache-Control": f"private, max-age={MEDIA_MAX_AGE}, immutable", 
+        }
+        if _etag_matches(req.headers.get("If-None-Match"), etag):
+            return web.Response(status=304, headers=cache_headers)
+        
+        # 同じサムネイルの同時生成は1回にまとめる
+        cate = media_data.get("cate")
+        thumb_path = await coalesce(
+            ("thumbnail", file_path, st.st_mtime_ns, size), 
+            lambda: run_blocking(thumbnail_cache.get, file_path, cate, st.st_mtime_ns, size)
+        )
+        if thumb_path is None:
+            return web.Response(status=404, text="Thumbnail not available")
+        
+        # FileResponse は ETag をサムネイルファイル自体の mtime / サイズで上書きするため
+        # 小さなファイルはそのまま読んで返す (If-None-Match と同じ ETag になるように)
+        body = await run_blocking(_read_file, thumb_path)
+        if body is None:
+            return web.Response(status=404, text="Thumbnail not available")
+        return web.Response(body=body, content_type="image/webp", headers=cache_headers)
+    
+    except Exception as e:
+        print(f"Error serving thumbnail: {e}")
+        return web.Response(status=500, text="Internal server error")
+
+
 # --- プレビューとして保存
 
 async def _download_media_with_progress(save_path, url):
     print(f"Downloading preview from: {url}")
     CHUNK_SIZE = 8192
     
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            response.raise_for_status()
-            total_size = int(response.headers.get("content-length") or 0)
-            
-            pbar = tqdm(total=total_size, unit="B", unit_scale=True, desc="Downloading")
-            
-            async with aiofiles.open(save_path, "wb") as f:
-                with pbar:
-                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
-                        await f.write(chunk)
-                        pbar.update(len(chunk))
+    session = civitai.get_session()
+    async with session.get(url) as response:
+        response.raise_for_status()
+        total_size = int(response.headers.get("content-length") or 0)
+        
+        pbar = tqdm(total=total_size, unit="B", unit_scale=True, desc="Downloading")
+        
+        async with aiofiles.open(save_path, "wb") as f:
+            with pbar:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    await f.write(chunk)
+                    pbar.update(len(chunk))
     print(f"Preview saved to: {save_path}")
 
 def _remove_old_previews(model_path_no_ext, current_full_path):
@@ -286,7 +473,7 @@ async def _save_uploaded_file(save_path, file_payload):
     print(f"Saving uploaded preview to: {save_path}")
     file_data_base64 = file_payload.get("data")
     _header, encoded_data = file_data_base64.split(",", 1)
-    decoded_data = base64.b64decode(encoded_data)
+    decoded_data = await run_blocking(base64.b64decode, encoded_data)
     
     async with aiofiles.open(save_path, "wb") as f:
         await f.write(decoded_data)
@@ -307,7 +494,7 @@ async def save_as_preview(req: web.Request):
         apiName = unquote(apiName).replace("\\", "/")
         
         full_path = get_fullpath(apiName)
-        if not full_path or not os.path.exists(full_path):
+        if not full_path or not await run_blocking(os.path.exists, full_path):
             return web.json_response({"status": "error", "message": f"Model file not found: {apiName}"}, status=404)
         
         file_no_ext = os.path.splitext(full_path)[0]
@@ -324,12 +511,15 @@ async def save_as_preview(req: web.Request):
         save_path = f"{file_no_ext}{ext}"
 
 
-        _remove_old_previews(file_no_ext, full_path)
+        await run_blocking(_remove_old_previews, file_no_ext, full_path)
         
         if url:
             await _download_media_with_progress(save_path, url)
         else:
             await _save_uploaded_file(save_path, file_payload)
+        
+        # mtime の分解能が粗いファイルシステム向けに明示的に破棄
+        preview_index.invalidate(os.path.dirname(full_path))
             
         return web.json_response({"status": "success"})
 
@@ -349,7 +539,8 @@ async def delete_preview(req: web.Request):
         full_path = get_fullpath(apiName)
         file_no_ext = os.path.splitext(full_path)[0]
 
-        _remove_old_previews(file_no_ext, full_path)
+        await run_blocking(_remove_old_previews, file_no_ext, full_path)
+        preview_index.invalidate(os.path.dirname(full_path))
         
         return web.json_response({"status": "success"})
         
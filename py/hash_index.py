@@ -0,0 +1,168 @@
+import folder_paths
+
+import threading
+import sqlite3
+import hashlib
+import time
+import os
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+
+# ===============================================
+# ハッシュインデックス
+# ===============================================
+# モデルファイルのハッシュを (絶対パス, サイズ, mtime_ns) ごとに SQLite に保存する
+# 同じバージョンのファイルは一度しかハッシュ計算しない
+# WAL モードなので同じマシン上の複数の ComfyUI プロセスから共有できる
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def _default_db_path():
+    return os.path.join(folder_paths.get_user_directory(), "jupo-lorastack", "hash_index.sqlite3")
+
+
+class HashIndex:
+    def __init__(self, db_path: str=None):
+        self.db_path = db_path or _default_db_path()
+        self.conn = None
+        self.lock = threading.RLock()
+        # パス -> [ロック, 待機中を含む使用数]  使用数が 0 になったら削除する
+        self.path_locks: dict[str, list] = {}
+
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS file_hash (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT,
+                    blake3 TEXT,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+
+    def lookup(self, file_path: str) -> dict | None:
+        """現在のファイルバージョンのハッシュが登録済みなら返す"""
+        path, size, mtime_ns = self._identity(file_path)
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT sha256, blake3 FROM file_hash WHERE path=? AND size=? AND mtime_ns=?",
+                (path, size, mtime_ns),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"sha256": row[0], "blake3": row[1]}
+
+
+    def get(self, file_path: str) -> dict:
+        """ハッシュを取得 (未登録なら計算して登録)"""
+        hashes = self.lookup(file_path)
+        if hashes is not None:
+            return hashes
+
+        # 同じファイルを同時に計算しないようにパスごとにロック
+        path = os.path.abspath(file_path)
+        # 待機中のスレッドがいる間にロックを消すと, 次に来たスレッドが別のロックで同時に計算してしまう
+        with self.lock:
+            entry = self.path_locks.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                hashes = self.lookup(file_path)
+                if hashes is None:
+                    identity = self._identity(file_path)
+                    hashes = compute_hashes(file_path)
+                    # 計算中にファイルが変更された場合は登録しない
+                    if self._identity(file_path) == identity:
+                        self._store(identity, hashes)
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self.path_locks.pop(path, None)
+        return hashes
+
+
+    def get_in_background(self, file_path: str, wait_if_paused) -> dict:
+        """バックグラウンド用の get  一時停止することがあるのでパスごとのロックを持たない
+
+        ロックを持ったまま待機すると, 同じファイルの情報を開いたフォアグラウンドの要求が
+        (ハッシュ計算の枠ごと) プロンプトの終了まで待たされるため
+        """
+        hashes = self.lookup(file_path)
+        if hashes is not None:
+            return hashes
+
+        identity = self._identity(file_path)
+        hashes = compute_hashes(file_path, wait_if_paused)
+        # フォアグラウンドで先に登録された場合もそのまま上書きしてよい (同じ値)
+        if self._identity(file_path) == identity:
+            self._store(identity, hashes)
+        return hashes
+
+
+    def _store(self, identity: tuple, hashes: dict):
+        path, size, mtime_ns = identity
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO file_hash (path, size, mtime_ns, sha256, blake3, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (path, size, mtime_ns, hashes.get("sha256"), hashes.get("blake3"), time.time()),
+            )
+            conn.commit()
+
+
+    @staticmethod
+    def _identity(file_path: str):
+        st = os.stat(file_path)
+        return (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+
+
+def compute_hashes(file_path: str, wait_if_paused=None) -> dict:
+    """sha256 と blake3 を1回の読み込みで計算する
+
+    wait_if_paused: チャンクごとに呼ばれる関数 (バックグラウンド処理の一時停止用)
+    """
+    start = time.time()
+    sha256 = hashlib.sha256()
+    hasher_b3 = blake3() if blake3 is not None else None
+
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            if wait_if_paused is not None:
+                wait_if_paused()
+            sha256.update(chunk)
+            if hasher_b3 is not None:
+                hasher_b3.update(chunk)
+
+    elapsed = time.time() - start
+    print(f"ハッシュ取得完了: {elapsed:.2f}秒")
+
+    return {
+        "sha256": sha256.hexdigest(),
+        "blake3": hasher_b3.hexdigest() if hasher_b3 is not None else None,
+    }
+
+
+hash_index = HashIndex()
+
+
+def get_hash(file_path: str) -> str:
+    """Civitai 検索用のハッシュ (blake3 使用可能時は blake3, それ以外は sha256)"""
+    hashes = hash_index.get(file_path)
+    return hashes.get("blake3") or hashes["sha256"]
@@ -0,0 +1,137 @@
+from server import PromptServer
+from .hash_index import hash_index
+from .safetensors_header import get_metadata
+import folder_paths
+
+import threading
+import time
+import os
+
+
+# ===============================================
+# バックグラウンドインデクサ
+# ===============================================
+# loras / checkpoints のハッシュと safetensors ヘッダーを事前に計算しておき
+# 情報ダイアログを初回から即座に開けるようにする
+# - ハッシュはハッシュインデックスに保存されるため再起動後も続きから再開できる
+# - プロンプト実行中は一時停止する
+# - 環境変数 JUPO_LORASTACK_INDEXER=1 で有効化
+ENABLED = os.environ.get("JUPO_LORASTACK_INDEXER", "0") == "1"
+FOLDERS = ["loras", "checkpoints"]
+START_DELAY = float(os.environ.get("JUPO_LORASTACK_INDEXER_START_DELAY", 30))
+FILE_DELAY = float(os.environ.get("JUPO_LORASTACK_INDEXER_FILE_DELAY", 0.5))
+PAUSE_POLL_INTERVAL = 1.0
+
+
+def _lower_io_priority():
+    """現在のスレッドの優先度を下げる (Linux では I/O 優先度も nice 値に従う)"""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+
+def _is_prompt_running() -> bool:
+    try:
+        return len(PromptServer.instance.prompt_queue.currently_running) > 0
+    except AttributeError:
+        return False
+
+
+class BackgroundIndexer:
+    def __init__(self):
+        self.thread = None
+        self.state = "idle"
+        self.total = 0
+        self.done = 0
+        self.hashed = 0
+        self.errors = 0
+        self.current = None
+        self.paused = False
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="jupo-lorastack-indexer", daemon=True)
+        self.thread.start()
+
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "enabled": ENABLED,
+                "state": self.state,
+                "total": self.total,
+                "done": self.done,
+                "hashed": self.hashed,
+                "errors": self.errors,
+                "current": self.current,
+                "paused": self.paused,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+
+    def wait_if_paused(self):
+        """プロンプト実行中は待機する"""
+        while _is_prompt_running():
+            self.paused = True
+            time.sleep(PAUSE_POLL_INTERVAL)
+        self.paused = False
+
+
+    def _run(self):
+        _lower_io_priority()
+        self.state = "waiting"
+        time.sleep(START_DELAY)
+
+        with self.lock:
+            self.state = "running"
+            self.started_at = time.time()
+
+        files = []
+        for folder in FOLDERS:
+            for name in folder_paths.get_filename_list(folder):
+                files.append((folder, name))
+        self.total = len(files)
+
+        for folder, name in files:
+            self.wait_if_paused()
+            self.current = f"{folder}/{name}"
+            try:
+                self._index_file(folder, name)
+            except Exception as e:
+                self.errors += 1
+                print(f"[jupo-lorastack] indexer: {name}: {e}")
+            self.done += 1
+            time.sleep(FILE_DELAY)
+
+        with self.lock:
+            self.current = None
+            self.state = "finished"
+            self.finished_at = time.time()
+
+
+    def _index_file(self, folder: str, name: str):
+        full_path = folder_paths.get_full_path(folder, name)
+        if not full_path or not os.path.isfile(full_path):
+            return
+
+        if hash_index.lookup(full_path) is None:
+            hash_index.get_in_background(full_path, self.wait_if_paused)
+            self.hashed += 1
+
+        if full_path.endswith(".safetensors"):
+            get_metadata(full_path)
+
+
+indexer = BackgroundIndexer()
+
+
+def start_if_enabled():
+    if ENABLED:
+        indexer.start()
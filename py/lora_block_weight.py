@@ -1,7 +1,6 @@
-import folder_paths
-import comfy.utils
-import comfy.lora
-import comfy.lora_convert
+from .lora_cache import KeyMapInfo, get_unet_key_map, get_clip_key_map, get_loaded_patches
+from .lora_fusion import fuse_patches
+from .schedule import CountingKeyframeGroup
 import comfy.hooks
 
 # 型用
@@ -9,6 +8,21 @@ from comfy.model_patcher import ModelPatcher
 from comfy.sd import CLIP
 
 
+# -----------------------------------------------
+# LBW の倍率ごとにパッチをまとめる
+# -----------------------------------------------
+def group_by_multiplier(loaded: dict, mapped: dict) -> list[tuple[float, dict]]:
+    """(倍率, パッチ) のリストを返す  add_patches の呼び出しを倍率の種類数に抑える"""
+    if not mapped:
+        return [(1, loaded)]
+    
+    groups: dict[float, dict] = {}
+    for key, value in loaded.items():
+        groups.setdefault(mapped.get(key, 1), {})[key] = value
+    return list(groups.items())
+
+
+
 # -----------------------------------------------
 # LBW 用 Hookクラス
 # -----------------------------------------------
@@ -17,6 +31,7 @@ class LBWWeightHook(comfy.hooks.WeightHook):
         super().__init__(strength_model, strength_clip)
         self.loaded = loaded
         self.lbw_map = lbw_map
+        self.groups = None
     
         
     def add_hook_patches(self, model, model_options, target_dict, registered):
@@ -29,10 +44,12 @@ class LBWWeightHook(comfy.hooks.WeightHook):
         else:
             strength = self._strength_model
         
-        for key, value in self.loaded.items():
-            patch = {key: value}
-            strength_patch = strength * self.lbw_map.get(key, 1)
-            model.add_hook_patches(self, patch, strength_patch)
+        if self.groups is None:
+            self.groups = group_by_multiplier(self.loaded, self.lbw_map)
+        
+        for multiplier, patches in self.groups:
+            if multiplier == 0: continue
+            model.add_hook_patches(self, patches, strength * multiplier)
         
         registered.add(self)
         return True
@@ -41,114 +58,145 @@ class LBWWeightHook(comfy.hooks.WeightHook):
         c: LBWWeightHook = super().clone()
         c.loaded = self.loaded
         c.lbw_map = self.lbw_map
+        c.groups = self.groups
         return c
     
 
 
 
-class LBWLoRALoader:
+# -----------------------------------------------
+# HookGroup の組み立て
+# -----------------------------------------------
+class HookGroupBuilder:
+    """Hook を集めて最後に1回だけ HookGroup を作る"""
+    # LoRA ごとに clone_and_combine すると, それまでの Hook が毎回 clone されて
+    # スタックの長さの2乗のコストになる  ここでは作った Hook を clone せずに並べる
     def __init__(self):
-        self.loaded_lora = None
-        
+        self.hooks: list[comfy.hooks.Hook] = []
+    
+    def add(self, hook: comfy.hooks.Hook, hook_kf: comfy.hooks.HookKeyframeGroup=None):
+        # set_keyframes_on_hooks と同じ (同じ hook_kf を渡した Hook はキーフレームグループを共有する)
+        if hook_kf is not None:
+            hook.hook_keyframe = hook_kf
+        self.hooks.append(hook)
+    
+    def build(self) -> comfy.hooks.HookGroup | None:
+        if not self.hooks:
+            return None
+        hook_group = comfy.hooks.HookGroup()
+        for hook in self.hooks:
+            hook_group.add(hook)
+        return hook_group
+
+
+
+
+class LBWLoRALoader:
     # -------------------------------------------
     # メインメソッド 通常版
     # -------------------------------------------
-    def load_lora(self, model: ModelPatcher, clip: CLIP, lora_name: str, strength_model: float, strength_clip: float, lbw: dict[str, dict]):
+    def load_lora(self, model: ModelPatcher, clip: CLIP, lora_name: str, strength_model: float, strength_clip: float, lbw: dict[str, dict], lora_path: str=None):
         if strength_model == 0 and strength_clip == 0:
             return (model, clip)
         
-        lora = self.prepare_lora(lora_name)
-        loaded, model_mapped, clip_mapped = self.create_lbw_info(model, clip, lora, lbw)
+        loaded, model_mapped, clip_mapped = self.create_lbw_info(model, clip, lora_name, lbw, lora_path)
 
-        for key, value in loaded.items():
-            patch = {key: value}
-            strength_patch_model = strength_model * model_mapped.get(key, 1)
-            strength_patch_clip = strength_clip * clip_mapped.get(key, 1)
+        if model:
+            for multiplier, patches in group_by_multiplier(loaded, model_mapped):
+                if multiplier == 0: continue
+                model.add_patches(patches, strength_model * multiplier)
+        if clip:
+            for multiplier, patches in group_by_multiplier(loaded, clip_mapped):
+                if multiplier == 0: continue
+                clip.patcher.add_patches(patches, strength_clip * multiplier)
+        
+        return (model, clip)
+    
+    
+    # -------------------------------------------
+    # メインメソッド 連結版
+    # -------------------------------------------
+    def load_loras_fused(self, model: ModelPatcher, clip: CLIP, loras: list[tuple]):
+        """[(lora_name, strength_model, strength_clip, lbw, lora_path)] を同じキーごとに連結して適用"""
+        model_groups = []
+        clip_groups = []
+        for lora_name, strength_model, strength_clip, lbw, lora_path in loras:
+            if strength_model == 0 and strength_clip == 0: continue
             
+            loaded, model_mapped, clip_mapped = self.create_lbw_info(model, clip, lora_name, lbw, lora_path)
             if model:
-                model.add_patches(patch, strength_patch_model)
+                model_groups += [(strength_model * multiplier, patches) for multiplier, patches in group_by_multiplier(loaded, model_mapped)]
             if clip:
-                clip.patcher.add_patches(patch, strength_patch_clip)
+                clip_groups += [(strength_clip * multiplier, patches) for multiplier, patches in group_by_multiplier(loaded, clip_mapped)]
+        
+        if model:
+            for strength, patches in fuse_patches(model_groups, get_unet_key_map(model).targets):
+                model.add_patches(patches, strength)
+        if clip:
+            for strength, patches in fuse_patches(clip_groups, get_clip_key_map(clip).targets):
+                clip.patcher.add_patches(patches, strength)
         
         return (model, clip)
     
     
     # -------------------------------------------
-    # メインメソッド Hook版
-    # -------------------------------------------    
-    def load_lora_with_hook(self, model: ModelPatcher, clip: CLIP, lora_name: str, strength_model: float, strength_clip: float, lbw: dict[str, dict], start: float, end: float, prev_hooks: comfy.hooks.HookGroup):
-        if prev_hooks is None:
-            prev_hooks = comfy.hooks.HookGroup()
-        prev_hooks = prev_hooks.clone()
-        
-        if strength_model == 0 and strength_clip == 0:
-            return prev_hooks
-        
-        lora = self.prepare_lora(lora_name)
-        
-        # LBW
-        hooks_lbw = self.create_lbw_hook(model, clip, lora, strength_model, strength_clip, lbw)
-        
-        # Schedule
-        hook_kf = self.create_schedule_hook(start, end)
-        hooks_lbw = hooks_lbw.clone()
-        hooks_lbw.set_keyframes_on_hooks(hook_kf=hook_kf)
-        
-        hooks = prev_hooks.clone_and_combine((hooks_lbw), )
-        return hooks
+    # メインメソッド Hook版 (同じスケジュールの LoRA をまとめる)
+    # -------------------------------------------
+    def load_loras_with_schedule(self, builder: "HookGroupBuilder", model: ModelPatcher, clip: CLIP, loras: list[tuple], start: float, end: float):
+        """[(lora_name, strength_model, strength_clip, lbw, lora_path)] の Hook を1つのキーフレームグループで builder に追加"""
+        hook_kf = None
+        for lora_name, strength_model, strength_clip, lbw, lora_path in loras:
+            if strength_model == 0 and strength_clip == 0: continue
+            if hook_kf is None:
+                hook_kf = self.create_schedule_hook(start, end)
+            builder.add(self.create_lbw_weight_hook(model, clip, lora_name, strength_model, strength_clip, lbw, lora_path), hook_kf)
+        return builder
     
     
     # -------------------------------------------
     # LBW
     # -------------------------------------------
-    def create_lbw_hook(self, model: ModelPatcher, clip: CLIP, lora: dict, strength_model: float, strength_clip: float, lbw: dict[str, dict]):
-        loaded, model_mapped, clip_mapped = self.create_lbw_info(model, clip, lora, lbw)
+    def create_lbw_weight_hook(self, model: ModelPatcher, clip: CLIP, lora_name: str, strength_model: float, strength_clip: float, lbw: dict[str, dict], lora_path: str=None):
+        loaded, model_mapped, clip_mapped = self.create_lbw_info(model, clip, lora_name, lbw, lora_path)
         lbw_map = model_mapped | clip_mapped
         
-        hook_group = comfy.hooks.HookGroup()
-        if len(lbw_map) > 0:
-            hook = LBWWeightHook(strength_model, strength_clip, loaded, lbw_map)
-        else:
-            hook = comfy.hooks.WeightHook(strength_model, strength_clip)
-            hook.weights = lora
-        
-        hook_group.add(hook)
-        return hook_group
+        # 変換済みパッチを共有するため、LBW なしでも LBWWeightHook を使う (倍率は全て1)
+        return LBWWeightHook(strength_model, strength_clip, loaded, lbw_map)
     
     
-    def create_lbw_info(self, model: ModelPatcher, clip: CLIP, lora: dict, lbw: dict[str, dict]):
-        model_key_map = {}
-        clip_key_map = {}
+    def create_lbw_info(self, model: ModelPatcher, clip: CLIP, lora_name: str, lbw: dict[str, dict], lora_path: str=None):
+        model_key_map = None
+        clip_key_map = None
 
         model_mapped = {}
         clip_mapped = {}
 
+        # key map / 変換済みパッチはモデル構造と LoRA ファイルが同じならキャッシュから取得
         if model is not None:
-            model_key_map = comfy.lora.model_lora_keys_unet(model.model)
+            model_key_map = get_unet_key_map(model)
             model_block_info = lbw.get("model", {})
             model_mapped = self.mapping_block_info(model_block_info, model_key_map)
         
         if clip is not None:
-            clip_key_map = comfy.lora.model_lora_keys_clip(clip.cond_stage_model)
+            clip_key_map = get_clip_key_map(clip)
             clip_block_info = lbw.get("clip", {})
             clip_mapped = self.mapping_block_info(clip_block_info, clip_key_map)
         
-        key_map = model_key_map | clip_key_map
-        lora = comfy.lora_convert.convert_lora(lora)
-        loaded = comfy.lora.load_lora(lora, key_map)
+        loaded = get_loaded_patches(lora_name, model_key_map, clip_key_map, lora_path=lora_path)
 
         return (loaded, model_mapped, clip_mapped)
     
     
-    def mapping_block_info(self, block_info: dict, lora_key_map: dict):
+    def mapping_block_info(self, block_info: dict, key_map_info: KeyMapInfo):
         normalized = {}
+        if not block_info:
+            return normalized
 
-        internal_keys = list(lora_key_map.values())
-
+        # 部分一致の結果はモデル構造ごとのインデックスにメモ化されている
+        block_index = key_map_info.block_index
         for search_key, weight in block_info.items():
-            for internal_key in internal_keys:
-                if search_key in internal_key:
-                    normalized[internal_key] = weight
+            for internal_key in block_index.lookup(search_key):
+                normalized[internal_key] = weight
         
         return normalized
 
@@ -159,8 +207,8 @@ class LBWLoRALoader:
     # -------------------------------------------
     def create_schedule_hook(self, start: float, end: float):
         
-        keyframe_group = comfy.hooks.HookKeyframeGroup()
-        keyframe_group = keyframe_group.clone()
+        # 切り替えの回数を数えるため CountingKeyframeGroup を使う
+        keyframe_group = CountingKeyframeGroup()
         
         # startよりも前は強度0
         if start > 0:
@@ -171,33 +219,10 @@ class LBWLoRALoader:
         keyframe = comfy.hooks.HookKeyframe(strength=1, start_percent=start)
         keyframe_group.add(keyframe)
 
-        # endから強度0
-        keyframe = comfy.hooks.HookKeyframe(strength=0, start_percent=end)
-        keyframe_group.add(keyframe)
+        # endから強度0 (end = 1 なら切り替わらないので作らない)
+        if end < 1:
+            keyframe = comfy.hooks.HookKeyframe(strength=0, start_percent=end)
+            keyframe_group.add(keyframe)
 
 
         return keyframe_group
-        
-
-    
-    # -------------------------------------------
-    # ユーティリティ
-    # -------------------------------------------
-    def prepare_lora(self, lora_name: str):
-        lora_path = folder_paths.get_full_path_or_raise("loras", lora_name)
-        lora = None
-        if self.loaded_lora is not None:
-            if self.loaded_lora[0] == lora_path:
-                lora = self.loaded_lora[1]
-            else:
-                temp = self.loaded_lora
-                self.loaded_lora = None
-                del temp
-        
-        if lora is None:
-            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
-            self.loaded_lora = (lora_path, lora)
-        
-        return lora
-    
-    
\ No newline at end of file
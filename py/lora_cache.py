@@ -0,0 +1,507 @@
+import folder_paths
+import comfy.utils
+import comfy.lora
+import comfy.lora_convert
+
+from collections import OrderedDict
+import threading
+import weakref
+import bisect
+import hashlib
+import os
+
+
+# ===============================================
+# LoRA state dict キャッシュ
+# ===============================================
+# apply_stack は毎回 LoRA を読み直すため、プロセス全体で共有するキャッシュを用意する
+# キー: (フルパス, mtime_ns, サイズ)  ファイルが更新されれば自動的に別エントリになる
+# 上限は JUPO_LORA_CACHE_MB  未指定なら 1GB (搭載メモリの 1/8 の方が小さければそちら)
+DEFAULT_CACHE_MB = 1024
+
+
+def _default_max_mb() -> int:
+    if os.environ.get("JUPO_LORA_CACHE_MB"):
+        return int(os.environ["JUPO_LORA_CACHE_MB"])
+    try:
+        import psutil
+    except ImportError:
+        return DEFAULT_CACHE_MB
+    return min(DEFAULT_CACHE_MB, psutil.virtual_memory().total // 8 // (1024 * 1024))
+
+
+DEFAULT_MAX_BYTES = _default_max_mb() * 1024 * 1024
+
+
+def _state_dict_nbytes(sd: dict) -> int:
+    total = 0
+    for value in sd.values():
+        try:
+            total += value.nelement() * value.element_size()
+        except AttributeError:
+            pass
+    return total
+
+
+def file_identity(path: str):
+    """(フルパス, mtime_ns, サイズ) を返す"""
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+class LoRACache:
+    def __init__(self, max_bytes: int=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple, tuple[dict, int]] = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # エントリが消えたときに呼ばれる (変換済みパッチのキャッシュを一緒に捨てるため)
+        self.listeners = []
+        self.lock = threading.RLock()
+
+
+    def load(self, lora_path: str) -> dict:
+        """キャッシュ経由で LoRA を読み込む"""
+        key = file_identity(lora_path)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
+        nbytes = _state_dict_nbytes(lora)
+
+        with self.lock:
+            # 同じファイルの古いバージョンは不要なので先に捨てる
+            for old_key in [k for k in self.entries if k[0] == key[0] and k != key]:
+                self._remove(old_key)
+
+            if key not in self.entries and nbytes <= self.max_bytes:
+                self.entries[key] = (lora, nbytes)
+                self.current_bytes += nbytes
+                self._evict()
+
+        return lora
+
+
+    def set_max_bytes(self, max_bytes: int):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._remove(key)
+
+
+    def charge(self, key: tuple, nbytes: int) -> bool:
+        """key のエントリに nbytes を追加で計上する (エントリがなければ False)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] + nbytes > self.max_bytes:
+                return False
+            self.entries[key] = (entry[0], entry[1] + nbytes)
+            self.current_bytes += nbytes
+            self._evict(keep=key)
+            return key in self.entries
+
+
+    def uncharge(self, key: tuple, nbytes: int):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries[key] = (entry[0], entry[1] - nbytes)
+                self.current_bytes -= nbytes
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+    def _remove(self, key):
+        _lora, nbytes = self.entries.pop(key)
+        self.current_bytes -= nbytes
+        for listener in self.listeners:
+            listener(key)
+
+
+    def _evict(self, keep: tuple=None):
+        while self.current_bytes > self.max_bytes and self.entries:
+            oldest = next(iter(self.entries))
+            if oldest == keep:
+                # 追加で計上したエントリ自体は残し, 次に古いものから捨てる
+                if len(self.entries) == 1:
+                    break
+                self.entries.move_to_end(keep)
+                continue
+            self._remove(oldest)
+            self.evictions += 1
+
+
+lora_cache = LoRACache()
+
+
+def resolve_lora_path(lora_name: str, lora_path: str=None) -> str:
+    """解決済みのフルパスがあればそれを使う"""
+    return lora_path or folder_paths.get_full_path_or_raise("loras", lora_name)
+
+
+def load_lora_file(lora_name: str, lora_path: str=None) -> dict:
+    """loras フォルダ内の LoRA をキャッシュ経由で読み込む"""
+    return lora_cache.load(resolve_lora_path(lora_name, lora_path))
+
+
+def lora_identity(lora_name: str, lora_path: str=None):
+    """LoRA ファイルの (フルパス, mtime_ns, サイズ)"""
+    return file_identity(resolve_lora_path(lora_name, lora_path))
+
+
+
+# ===============================================
+# キーマップ / 変換済みパッチ キャッシュ
+# ===============================================
+# 1段目: モデルのクラスと state dict のキー集合 -> lora key map
+# 2段目: LoRA の identity と key map の fingerprint -> comfy.lora.load_lora の結果
+KEY_MAP_CACHE_SIZE = 16
+PATCH_CACHE_SIZE = int(os.environ.get("JUPO_LORA_PATCH_CACHE_SIZE", 64))
+
+
+class _LRU:
+    def __init__(self, max_size: int, on_evict=None):
+        self.max_size = max_size
+        # on_evict(key, value): 件数の上限で捨てたときに (ロックの外で) 呼ばれる
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        evicted = []
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                evicted.append(self.entries.popitem(last=False))
+        if self.on_evict is not None:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+
+    def remove_if(self, predicate):
+        """predicate(key) が真のエントリを捨てる (on_evict は呼ばない)"""
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class BlockIndex:
+    """key map の内部キーに対する部分一致検索のインデックス
+
+    内部キーを改行区切りの1つの文字列にまとめ、str.find で一致位置を探す
+    検索結果は検索キーごとにメモ化するので、2回目以降は一致したキー数のコストで済む
+    """
+    def __init__(self, internal_keys: list):
+        self.keys = internal_keys
+        self.starts = []
+        parts = []
+        pos = 0
+        for key in internal_keys:
+            # (key, offset) 形式の内部キーはキー文字列部分で検索する
+            text = key[0] if isinstance(key, tuple) else key
+            self.starts.append(pos)
+            parts.append(text)
+            pos += len(text) + 1
+        self.text = "\n".join(parts)
+        self.memo: dict[str, tuple] = {}
+        self.lock = threading.Lock()
+
+
+    def lookup(self, search_key: str) -> tuple:
+        """search_key を部分文字列として含む内部キーを返す"""
+        matched = self.memo.get(search_key)
+        if matched is not None:
+            return matched
+
+        matched = []
+        if not search_key:
+            # 空文字列はすべてのキーに含まれる (従来の `in` による判定と同じ)
+            matched = list(self.keys)
+        elif "\n" not in search_key:
+            last = -1
+            pos = self.text.find(search_key)
+            while pos != -1:
+                index = bisect.bisect_right(self.starts, pos) - 1
+                if index != last:
+                    matched.append(self.keys[index])
+                    last = index
+                # 同じキー内の2つ目以降の一致は不要なので次のキーへ進む
+                next_start = self.starts[index + 1] if index + 1 < len(self.starts) else len(self.text)
+                pos = self.text.find(search_key, max(pos + 1, next_start))
+
+        matched = tuple(matched)
+        with self.lock:
+            self.memo[search_key] = matched
+        return matched
+
+
+class KeyMapInfo:
+    """lora key map とその fingerprint, ブロック検索用インデックス"""
+    __slots__ = ("key_map", "fingerprint", "_block_index", "_targets")
+
+    def __init__(self, key_map: dict):
+        self.key_map = key_map
+        hasher = hashlib.sha1()
+        for lora_key, internal_key in sorted(key_map.items(), key=lambda kv: kv[0]):
+            hasher.update(f"{lora_key}\0{internal_key}\n".encode("utf-8"))
+        self.fingerprint = hasher.hexdigest()
+        self._block_index = None
+        self._targets = None
+
+    @property
+    def block_index(self) -> BlockIndex:
+        if self._block_index is None:
+            # 同じ内部キーが複数の LoRA キーから参照されるため重複を除く
+            self._block_index = BlockIndex(list(dict.fromkeys(self.key_map.values())))
+        return self._block_index
+
+    @property
+    def targets(self) -> set:
+        """パッチの対象になる内部キー (load_lora の結果のキー) の集合"""
+        if self._targets is None:
+            self._targets = set(self.key_map.values())
+        return self._targets
+
+
+def _patch_tensors(patch):
+    """パッチ (LoRAAdapter / 旧来のタプル) が参照するテンソル"""
+    if isinstance(patch, tuple) and len(patch) == 2 and isinstance(patch[0], str):
+        weights = patch[1]
+    else:
+        weights = getattr(patch, "weights", ())
+    return [w for w in weights if hasattr(w, "nelement")]
+
+
+def _storage_id(tensor):
+    try:
+        return tensor.untyped_storage().data_ptr()
+    except Exception:
+        return id(tensor)
+
+
+def _patch_extra_nbytes(loaded: dict, lora: dict) -> int:
+    """変換済みパッチのうち, 元の state dict と共有していないテンソルのバイト数"""
+    shared = {_storage_id(value) for value in lora.values() if hasattr(value, "nelement")}
+    extra = 0
+    seen = set()
+    for patch in loaded.values():
+        for tensor in _patch_tensors(patch):
+            storage = _storage_id(tensor)
+            if storage in shared or storage in seen:
+                continue
+            seen.add(storage)
+            extra += tensor.nelement() * tensor.element_size()
+    return extra
+
+
+# 変換済みパッチは LoRA のテンソルを参照するので, lora_cache のエントリと寿命をそろえる
+# - lora_cache に載っている LoRA のパッチだけをキャッシュする
+# - 新たに作られたテンソルの分は lora_cache のバイト数に計上する
+# - lora_cache から消えたら, その LoRA のパッチも捨てる
+key_map_cache = _LRU(KEY_MAP_CACHE_SIZE)
+patch_cache = _LRU(PATCH_CACHE_SIZE, on_evict=lambda key, value: lora_cache.uncharge(key[0], value[1]))
+lora_cache.listeners.append(lambda identity: patch_cache.remove_if(lambda key: key[0] == identity))
+
+
+def _get_key_map(target, builder) -> KeyMapInfo:
+    cache_key = (type(target), frozenset(target.state_dict().keys()))
+    info = key_map_cache.get(cache_key)
+    if info is None:
+        info = KeyMapInfo(builder(target, {}))
+        key_map_cache.put(cache_key, info)
+    return info
+
+
+def get_unet_key_map(model) -> KeyMapInfo:
+    """ModelPatcher 用の key map (model.model 単位でキャッシュ)"""
+    return _get_key_map(model.model, comfy.lora.model_lora_keys_unet)
+
+
+def get_clip_key_map(clip) -> KeyMapInfo:
+    """CLIP 用の key map (cond_stage_model 単位でキャッシュ)"""
+    return _get_key_map(clip.cond_stage_model, comfy.lora.model_lora_keys_clip)
+
+
+def get_loaded_patches(lora_name: str, *key_map_infos: KeyMapInfo, lora_path: str=None) -> dict:
+    """convert_lora + load_lora の結果をキャッシュ経由で取得 (ヒット時は LoRA も読み込まない)"""
+    key_map_infos = [info for info in key_map_infos if info is not None]
+    fingerprint = tuple(info.fingerprint for info in key_map_infos)
+    lora_path = resolve_lora_path(lora_name, lora_path)
+    cache_key = (lora_identity(lora_name, lora_path), fingerprint)
+
+    cached = patch_cache.get(cache_key)
+    if cached is not None:
+        return cached[0]
+
+    key_map = {}
+    for info in key_map_infos:
+        key_map.update(info.key_map)
+    lora = load_lora_file(lora_name, lora_path)
+    loaded = comfy.lora.load_lora(comfy.lora_convert.convert_lora(lora), key_map)
+
+    # lora_cache の上限を超える場合はパッチもキャッシュしない
+    # (計上と登録の間に LoRA が捨てられないよう, lora_cache のロック内で行う)
+    extra = _patch_extra_nbytes(loaded, lora)
+    with lora_cache.lock:
+        if lora_cache.charge(cache_key[0], extra):
+            patch_cache.put(cache_key, (loaded, extra))
+    return loaded
+
+
+# ===============================================
+# apply_stack の結果のキャッシュ
+# ===============================================
+# 入力の model / clip が同じオブジェクトで, 有効なエントリの内容も同じなら
+# パッチ登録済みの clone をそのまま返す (シード等の変更だけで再実行された場合)
+# モデルを持ち続けないよう, 入力も結果も弱参照で持つ
+# - 結果は呼び出し側 (ComfyUI の出力キャッシュ等) が持っている間だけ再利用できる
+#   (clone は入力を参照しうるので, 強参照で持つと入力が解放されなくなる)
+# - 入力か結果のどれかが解放されたら weakref.finalize でエントリを捨てる
+# 既定では無効 (0)  JUPO_LORASTACK_APPLIED_CACHE_SIZE で件数を指定すると有効になる
+APPLIED_CACHE_SIZE = int(os.environ.get("JUPO_LORASTACK_APPLIED_CACHE_SIZE", 0))
+
+
+def _patches_uuid(patcher):
+    """ModelPatcher がその場で書き換えられた場合の検出用"""
+    return getattr(patcher, "patches_uuid", None) if patcher is not None else None
+
+
+def _ref(obj):
+    return weakref.ref(obj) if obj is not None else None
+
+
+def _deref(ref):
+    return ref() if ref is not None else None
+
+
+class AppliedStackCache(_LRU):
+    def __init__(self, max_size: int):
+        super().__init__(max_size, on_evict=self._detach)
+
+
+    def _key(self, model, clip, digest: str) -> tuple:
+        clip_patcher = getattr(clip, "patcher", None)
+        return (id(model), id(clip), _patches_uuid(model), _patches_uuid(clip_patcher), digest)
+
+
+    def get_applied(self, model, clip, digest: str):
+        """(model, clip) を返す  なければ None"""
+        if self.max_size <= 0:
+            return None
+        key = self._key(model, clip, digest)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                model_ref, clip_ref, result_refs, _finalizers = value
+                result = tuple(_deref(ref) for ref in result_refs)
+                # id が再利用された別オブジェクトでないこと, 結果が解放されていないことを確認
+                if (_deref(model_ref) is model and _deref(clip_ref) is clip
+                        and all(obj is not None or ref is None for obj, ref in zip(result, result_refs))):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                self._drop(key)
+            self.misses += 1
+            return None
+
+
+    def put_applied(self, model, clip, digest: str, result: tuple):
+        if self.max_size <= 0:
+            return
+        key = self._key(model, clip, digest)
+        objects = [obj for obj in (model, clip, *result) if obj is not None]
+        finalizers = [weakref.finalize(obj, self._drop, key) for obj in objects]
+        for finalizer in finalizers:
+            # プロセス終了時に呼ぶ必要はない
+            finalizer.atexit = False
+        with self.lock:
+            self._drop(key)
+            self.put(key, (_ref(model), _ref(clip), tuple(_ref(obj) for obj in result), finalizers))
+
+
+    def clear(self):
+        with self.lock:
+            values = list(self.entries.items())
+            self.entries.clear()
+        for key, value in values:
+            self._detach(key, value)
+
+
+    def _drop(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+        if value is not None:
+            self._detach(key, value)
+
+
+    def _detach(self, _key, value):
+        # 残ったオブジェクトの finalize は不要になるので外す
+        for finalizer in value[3]:
+            finalizer.detach()
+
+
+applied_cache = AppliedStackCache(APPLIED_CACHE_SIZE)
+
+
+def cache_stats() -> dict:
+    return {
+        "lora": lora_cache.stats(),
+        "key_map": key_map_cache.stats(),
+        "patch": patch_cache.stats(),
+        "applied": applied_cache.stats(),
+    }
+
+
+def clear_caches():
+    lora_cache.clear()
+    key_map_cache.clear()
+    patch_cache.clear()
+    applied_cache.clear()
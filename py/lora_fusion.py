@@ -0,0 +1,82 @@
+import torch
+import os
+
+
+# ===============================================
+# 静的な LoRA のランク連結
+# ===============================================
+# 同じ重みに掛かる複数の LoRA パッチを, up / down を連結した1つのパッチにまとめる
+#   sum_i s_i * (a_i / r_i) * up_i @ down_i = [s'_1 up_1 | ... ] @ [down_1; ...]
+# 強度と LBW の倍率, alpha / rank は up 側に掛けておき, alpha = 連結後のランク (倍率1) にする
+# パッチ適用時の行列積がキーごとに1回になる  スケジュール付き (Hook) のものは対象外
+ENABLED = os.environ.get("JUPO_LORASTACK_FUSE", "0") == "1"
+
+
+def lora_weights(patch):
+    """LoRA 形式のパッチなら (up, down, alpha, mid, dora_scale, reshape) を返す"""
+    if isinstance(patch, tuple) and len(patch) == 2 and patch[0] == "lora":
+        return patch[1]
+    if getattr(patch, "name", None) == "lora":
+        return patch.weights
+    return None
+
+
+def _make_patch(template, weights: tuple):
+    """template と同じ形式 (LoRAAdapter / 旧来のタプル) のパッチを作る"""
+    if isinstance(template, tuple):
+        return ("lora", weights)
+    return type(template)(getattr(template, "loaded_keys", set()), weights)
+
+
+def _fuse(items: list[tuple[float, object]]):
+    """[(強度, パッチ)] を1つのパッチにする  まとめられなければ None"""
+    entries = []
+    for strength, patch in items:
+        weights = lora_weights(patch)
+        # Tucker 分解 / DoRA / reshape 付きは連結できない
+        if weights is None or any(w is not None for w in weights[3:6]):
+            return None
+        entries.append((strength, weights))
+
+    first_up, first_down = entries[0][1][0], entries[0][1][1]
+    for _strength, (up, down, *_rest) in entries:
+        if up.shape[0] != first_up.shape[0] or up.shape[2:] != first_up.shape[2:] or down.shape[1:] != first_down.shape[1:]:
+            return None
+
+    ups = []
+    downs = []
+    for strength, (up, down, alpha, *_rest) in entries:
+        scale = strength * (alpha / down.shape[0] if alpha is not None else 1.0)
+        ups.append((up.to(torch.float32) * scale).to(first_up.dtype))
+        downs.append(down.to(device=first_down.device, dtype=first_down.dtype))
+
+    up = torch.cat([up.to(first_up.device) for up in ups], dim=1)
+    down = torch.cat(downs, dim=0)
+    return _make_patch(items[0][1], (up, down, float(down.shape[0]), None, None, None))
+
+
+def fuse_patches(groups: list[tuple[float, dict]], targets: set) -> list[tuple[float, dict]]:
+    """add_patches に渡す (強度, パッチ) のリストの, 同じキーのものを連結する"""
+    # 連結したものは強度1でまとめ, 連結できなかったものは元の強度のまま残す
+    # targets に含まれないキー (CLIP 用のキー等) は捨てる
+    per_key: dict = {}
+    for index, (strength, patches) in enumerate(groups):
+        if strength == 0: continue
+        for key, patch in patches.items():
+            if key in targets:
+                per_key.setdefault(key, []).append((index, strength, patch))
+
+    fused = {}
+    rest: list[dict] = [{} for _ in groups]
+    for key, items in per_key.items():
+        if len(items) > 1:
+            patch = _fuse([(strength, patch) for _index, strength, patch in items])
+            if patch is not None:
+                fused[key] = patch
+                continue
+        for index, _strength, patch in items:
+            rest[index][key] = patch
+
+    result = [(1.0, fused)] if fused else []
+    result.extend((strength, patches) for (strength, _), patches in zip(groups, rest) if patches)
+    return result
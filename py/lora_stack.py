@@ -1,115 +1,134 @@
 from comfy.comfy_types import IO
 from .utils import Field
-from .lora_block_weight import LBWLoRALoader
-from nodes import LoraLoader
+from .lora_block_weight import LBWLoRALoader, HookGroupBuilder
+from .model_list import name_resolver
+from .workflow_index import workflow_index, lora_list_parser
+from .stack import LoRAEntry, LoRAStack
+from .lora_cache import applied_cache, file_identity
+from .lora_fusion import ENABLED as FUSE_STATIC
+from .schedule import normalize_schedule, schedule_stats
 
-import folder_paths
 from comfy.model_patcher import ModelPatcher
 from comfy.sd import CLIP
 import comfy.hooks
+import hashlib
 import os
-from pathlib import Path
-import json
 
 
-def get_available_loras(stack: list[dict]) -> list[dict]:
+def get_available_loras(stack: LoRAStack) -> list[tuple[LoRAEntry, str]]:
+    """存在する LoRA を (エントリ, フルパス) で返す  見つからないものはまとめて警告する"""
     available_loras = []
-    exist_loras = folder_paths.get_filename_list("loras")
+    missing = []
 
     for value in stack:
-        file = value.get("lora")
-        
-        if file in exist_loras:
-            available_loras.append(value)
+        file = value.lora
+        if file == "None":
+            continue
+
+        # ファイル一覧のバージョンごとに作られた集合で引くので O(1)
+        full_path = name_resolver.resolve("loras", file)
+        if full_path is not None:
+            available_loras.append((value, full_path))
         else:
-            if not file == "None":
-                print(f"{file} is not Found. skipped.")
+            missing.append(file)
+    
+    if missing:
+        print(f"[jupo-lorastack] {len(missing)} LoRA(s) not found, skipped: {', '.join(missing)}")
     
     return available_loras
 
 
-def get_stack(unique_id=None, extra_pnginfo=None, lora_list_str="") -> tuple[list[dict], dict]:
+def get_stack(unique_id=None, extra_pnginfo=None, lora_list_str="") -> tuple[LoRAStack, str]:
 
     lora_list = []
     try:
-        nodes = extra_pnginfo.get("workflow").get("nodes")
-        for node in nodes:
-            if (str(node.get("id")) == str(unique_id)):
-                lora_list = node.get("lora_list")
+        # ノードの索引はプロンプト内の全スタックノードで共有される
+        node = workflow_index.get_node(extra_pnginfo, unique_id)
+        if node is not None:
+            lora_list = node.get("lora_list")
     except Exception as e:
         print(f"Failed to load LoRA-List from extra_pnginfo: {e}")
     
     # extra_pnginfoから取得したlora_listが空の場合、JSON形式のlora_listから取得を試みる
     if not lora_list:
         try:
-            lora_list = json.loads(lora_list_str)
+            lora_list = lora_list_parser.parse(lora_list_str)
         except Exception as e:
             print(f"Failed to load LoRA-List from JSON string: {e}")
     
     # lora_list = [lora for lora in lora_list if lora.get("enabled")]
-    for lora in lora_list:
-        lora["lora"] = str(Path(lora.get("lora"))) # パス形式を統一
+    # 検証 / パス形式の統一は LoRAEntry の生成時に1回だけ行う
+    stack = LoRAStack.from_value(lora_list)
     
-    stack = []
     trigger = ""
-    if lora_list:
-        stack = lora_list
-        
-        for lora in lora_list:
-            enabled = lora.get("enabled", False)
-            enable_trigger = lora.get("enabled_trigger", False)
-            trigger_value = lora.get("trigger", "")
-            if enabled and enable_trigger and trigger_value.strip():
-                trigger += trigger_value
+    for lora in stack:
+        if lora.enabled and lora.enabled_trigger and lora.trigger.strip():
+            trigger += lora.trigger
     
     return (stack, trigger)
 
 
-def apply_stack(stack, model: ModelPatcher=None, clip: CLIP=None):
+def applied_digest(available_loras: list[tuple[LoRAEntry, str]]) -> str:
+    """パッチ結果に影響する内容 (有効なエントリの設定とファイルの同一性) のハッシュ"""
+    hasher = hashlib.sha1()
+    for value, lora_path in available_loras:
+        if not value.enabled: continue
+        lbw = sorted((target, sorted(info.items())) for target, info in value.lbw.items())
+        key = (value.lora, value.strength_model, value.strength_clip, value.clip_mode, lbw, value.start, value.end)
+        hasher.update(repr((key, file_identity(lora_path))).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def apply_stack(stack: LoRAStack, model: ModelPatcher=None, clip: CLIP=None):
+    # 従来の dict のリストも受け付ける
+    stack = LoRAStack.from_value(stack)
     available_loras = get_available_loras(stack)
-    prev_hooks = None
+
+    # 適用済みキャッシュが無効 (既定) ならファイルの stat を含む digest の計算も省く
+    if applied_cache.max_size <= 0:
+        return _apply_stack(available_loras, model, clip)
+
+    # 同じ入力に同じスタックを適用済みなら clone をそのまま返す
+    digest = applied_digest(available_loras)
+    applied = applied_cache.get_applied(model, clip, digest)
+    if applied is not None:
+        return applied
+
+    applied = _apply_stack(available_loras, model, clip)
+    applied_cache.put_applied(model, clip, digest, applied)
+    return applied
+
+
+def _apply_stack(available_loras: list[tuple[LoRAEntry, str]], model: ModelPatcher=None, clip: CLIP=None):
+    # 連結モードではスケジュールなしの LoRA をまとめて最後に適用する
+    static_loras = []
+    # (start, end) -> LoRA のリスト  同じスケジュールは1つのキーフレームグループにまとめる
+    scheduled: dict[tuple[float, float], list] = {}
     
     model = model.clone() if model else None
     clip = clip.clone() if clip else None
         
-    for value in available_loras:
-        enabled = value.get("enabled", False)
-        file = value.get("lora", "")
-        strength_model = value.get("strength_model", 1)
-        strength_clip = value.get("strength_clip", 1)
-        clip_mode = value.get("clip_mode", False)
-        
-        enabled_lbw = value.get("enabled_block", False)
-        lbw = value.get("block", {})
+    for value, lora_path in available_loras:
+        if not value.enabled: continue
         
-        start = max(0, value.get("start", 0))
-        end = min(value.get("end", 1), 1)
+        file = value.lora
+        strength_model = value.strength_model
+        strength_clip = value.strength_clip if value.clip_mode else strength_model
         
-        if not enabled: continue
-        if not file or file == "None": continue
+        enabled_lbw = value.enabled_block
+        lbw = value.lbw
         
-        if not clip_mode:
-            strength_clip = strength_model
+        # start / end は LoRAEntry の生成時に 0..1 に収めてある  近い境界は同じ値に丸める
+        start, end = normalize_schedule(value.start, value.end)
         
         if clip is None:
             strength_clip = 0
         
-        if not enabled_lbw:
-            lbw = {}
-        
         
         if start > 0 or end < 1:
-            prev_hooks = LBWLoRALoader().load_lora_with_hook(
-                model, 
-                clip, 
-                file, 
-                strength_model, 
-                strength_clip, 
-                lbw, 
-                start, 
-                end, 
-                prev_hooks
-            )
+            scheduled.setdefault((start, end), []).append((file, strength_model, strength_clip, lbw, lora_path))
+        elif FUSE_STATIC:
+            static_loras.append((file, strength_model, strength_clip, lbw, lora_path))
         elif enabled_lbw:
             model, clip = LBWLoRALoader().load_lora(
                 model, 
@@ -118,21 +137,36 @@ def apply_stack(stack, model: ModelPatcher=None, clip: CLIP=None):
                 strength_model, 
                 strength_clip, 
                 lbw, 
+                lora_path=lora_path, 
             )
         else:
-            model, clip = LoraLoader().load_lora(
+            # LBW なしでも変換済みパッチのキャッシュを使うため LBWLoRALoader で読み込む
+            model, clip = LBWLoRALoader().load_lora(
                 model, 
                 clip, 
                 file, 
                 strength_model, 
-                strength_clip
+                strength_clip, 
+                {}, 
+                lora_path=lora_path, 
             )
     
+    if static_loras:
+        model, clip = LBWLoRALoader().load_loras_fused(model, clip, static_loras)
+    
+    if scheduled:
+        schedule_stats.plan(list(scheduled))
+    # Hook は builder に集めて最後に1回だけ HookGroup にする (スタックの長さに比例するコスト)
+    builder = HookGroupBuilder()
+    for (start, end), loras in scheduled.items():
+        LBWLoRALoader().load_loras_with_schedule(builder, model, clip, loras, start, end)
+    
     # Hookを適用
-    hooks = prev_hooks
+    hooks = builder.build()
     if hooks is not None:
         if clip is not None:
             clip.apply_hooks_to_conds = hooks
+            # forced_hooks は別の HookGroup にしておく (clone は最後の1回だけ)
             clip.patcher.forced_hooks = hooks.clone()
             clip.use_clip_schedule = True
             clip.patcher.register_all_hook_patches(hooks, comfy.hooks.create_target_dict(comfy.hooks.EnumWeightTarget.Clip))
@@ -167,10 +201,12 @@ class JupoLoRAStack:
     def execute(self, prev_stack=[], prev_trigger="", unique_id=None, extra_pnginfo=None, lora_list=""):
         stack, trigger = get_stack(unique_id, extra_pnginfo, lora_list)
 
-        stack = prev_stack + stack
+        # 前段のスタックは親として共有される (コピーしない)
+        stack = LoRAStack.from_value(prev_stack).chain(stack)
         trigger = prev_trigger + trigger
         
-        return (stack, trigger)
+        # 他のカスタムノードには従来どおり dict のリストとして渡す
+        return (stack.to_list(), trigger)
 
 
 # ===============================================
@@ -201,7 +237,7 @@ class JupoLoRALoader:
     
     def execute(self, model, clip=None, prev_stack=[], prev_trigger="", unique_id=None, extra_pnginfo=None, lora_list=""):
         stack, trigger = get_stack(unique_id, extra_pnginfo, lora_list)
-        stack = prev_stack + stack
+        stack = LoRAStack.from_value(prev_stack).chain(stack)
         trigger = prev_trigger + trigger
         
         model, clip = apply_stack(stack, model, clip)
@@ -257,23 +293,19 @@ class StackToWanWrapper:
 
     def execute(self, stack: list, low_mem_load=False, merge_loras=True):
         loras_list = []
-        available_loras = get_available_loras(stack)
-
-        for value in available_loras:
-            enabled = value.get("enabled", False)
-            file = value.get("lora", "")
-            strength_model = value.get("strength_model", 1)
-            enabled_block = value.get("enabled_block", False)
-            model_type = value.get("model_type", None)
-            block_info = value.get("block", {}).get("model", {})
-
-            if not enabled: continue
-            if not file or file == "None": continue
+        available_loras = get_available_loras(LoRAStack.from_value(stack))
+
+        for value, lora_path in available_loras:
+            file = value.lora
+            strength_model = value.strength_model
+            block_info = value.lbw.get("model", {})
+
+            if not value.enabled: continue
             if strength_model == 0: continue
             
-            if enabled:
+            if value.enabled:
                 wrapper_lora = {
-                    "path": folder_paths.get_full_path("loras", file), 
+                    "path": lora_path, 
                     "strength": strength_model, 
                     "name": os.path.splitext(file)[0], 
                     "blocks": {}, 
@@ -281,7 +313,7 @@ class StackToWanWrapper:
                     "low_mem_load": low_mem_load, 
                     "merge_loras": merge_loras
                 }
-                if enabled_block and model_type == "WAN" and block_info:
+                if value.model_type == "WAN" and block_info:
                     wrapper_lora["blocks"] = block_info
 
                 loras_list.append(wrapper_lora)
@@ -0,0 +1,129 @@
+import folder_paths
+
+from collections import OrderedDict
+import threading
+import hashlib
+import secrets
+import time
+import os
+
+
+# ===============================================
+# メディア用トークンストア
+# ===============================================
+# - 同じファイル (パス, mtime) には同じトークンを返す
+# - エントリ数の上限と TTL を持ち, 期限切れは発行/取得のついでに削除する
+# - 秘密値を保存しておき, 再起動後も同じトークンになるようにする (ブラウザキャッシュの再利用)
+TOKEN_EXPIRE_TIME = 3600
+MAX_TOKENS = int(os.environ.get("JUPO_LORASTACK_MAX_MEDIA_TOKENS", 10000))
+CLEANUP_INTERVAL = 60
+
+
+def load_secret() -> bytes:
+    """トークン生成用の秘密値 (トークンからパスを推測されないように)"""
+    path = os.path.join(folder_paths.get_user_directory(), "jupo-lorastack", "media_token_secret")
+    try:
+        with open(path, "rb") as file:
+            secret = file.read()
+        if len(secret) >= 16:
+            return secret
+    except OSError:
+        pass
+
+    secret = secrets.token_bytes(32)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(secret)
+    except OSError:
+        pass
+    return secret
+
+
+class MediaTokenStore:
+    def __init__(self, max_size: int=MAX_TOKENS, expire_time: float=TOKEN_EXPIRE_TIME, clock=time.time, secret: bytes=None):
+        self.max_size = max_size
+        self.expire_time = expire_time
+        self.clock = clock
+        self.secret = secret if secret is not None else secrets.token_bytes(16)
+        # token -> {"path", "cate", "mtime_ns", "created_at"}  古いものが先頭
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.last_cleanup = clock()
+        self.lock = threading.Lock()
+
+
+    def make_token(self, path: str, mtime_ns: int) -> str:
+        hasher = hashlib.sha256(self.secret)
+        hasher.update(f"{path}\0{mtime_ns}".encode("utf-8"))
+        return hasher.hexdigest()[:32]
+
+
+    def issue(self, path: str, cate: str, mtime_ns: int=None) -> str:
+        """トークンを発行 (同じファイル, 同じ mtime なら同じトークン)"""
+        if mtime_ns is None:
+            mtime_ns = os.stat(path).st_mtime_ns
+        token = self.make_token(path, mtime_ns)
+        now = self.clock()
+
+        with self.lock:
+            self.entries[token] = {
+                "path": path,
+                "cate": cate,
+                "mtime_ns": mtime_ns,
+                "created_at": now,
+            }
+            self.entries.move_to_end(token)
+            self._cleanup(now)
+        return token
+
+
+    def get(self, token: str) -> dict | None:
+        now = self.clock()
+        with self.lock:
+            self._cleanup(now)
+            entry = self.entries.get(token)
+            if entry is None:
+                return None
+            if now - entry["created_at"] > self.expire_time:
+                del self.entries[token]
+                return None
+            return entry
+
+
+    def remove(self, token: str):
+        with self.lock:
+            self.entries.pop(token, None)
+
+
+    def cleanup(self) -> int:
+        """期限切れトークンを削除して削除数を返す"""
+        with self.lock:
+            return self._cleanup(self.clock(), force=True)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def _cleanup(self, now: float, force: bool=False) -> int:
+        removed = 0
+        # 上限を超えた分は古いものから削除
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            removed += 1
+
+        if not force and now - self.last_cleanup < CLEANUP_INTERVAL:
+            return removed
+        self.last_cleanup = now
+
+        # 発行順に並んでいるので先頭から期限切れを削除
+        while self.entries:
+            token, entry = next(iter(self.entries.items()))
+            if now - entry["created_at"] <= self.expire_time:
+                break
+            del self.entries[token]
+            removed += 1
+        return removed
+
+
+media_tokens = MediaTokenStore(secret=load_secret())
@@ -0,0 +1,155 @@
+from .watcher import watcher, POLL_INTERVAL
+import folder_paths
+
+from collections import OrderedDict
+import threading
+import hashlib
+import time
+
+
+# ===============================================
+# モデル一覧 (バージョン付き)
+# ===============================================
+# folder_paths.get_filename_list の結果にバージョン (内容のハッシュ) を付け
+# 直近のバージョンを保持しておくことで差分 (追加 / 削除) を返せるようにする
+# 監視中のフォルダは変更通知があるまで一覧を取り直さない
+# ポーリングで監視中の場合, POLL_INTERVAL より古い一覧はルートのフォルダを stat して確認する
+# (サブフォルダへの追加は最大 POLL_INTERVAL 遅れて反映される)
+MAX_VERSIONS = 16
+
+
+class ModelList:
+    def __init__(self):
+        # directory -> OrderedDict[version, tuple[str, ...]]  新しいものが末尾
+        self.versions: dict[str, OrderedDict[str, tuple]] = {}
+        # directory -> (hash(tuple), version)  内容が変わっていなければ sha1 を計算しない
+        self.latest: dict[str, tuple[int, str]] = {}
+        # 変更通知を受けたフォルダ
+        self.dirty: set[str] = set()
+        # directory -> 一覧を取得 / 確認した時刻 (time.monotonic)
+        self.checked: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+
+    def invalidate(self, folder_name: str, directory: str=None):
+        """folder_name ("loras" 等) の一覧を次回取り直す"""
+        with self.lock:
+            self.dirty.add(folder_name)
+
+
+    def get(self, directory: str) -> tuple[str, tuple]:
+        """(version, ファイル一覧) を返す"""
+        now = time.monotonic()
+        with self.lock:
+            stale = now - self.checked.get(directory, now) > POLL_INTERVAL
+            if stale:
+                self.checked[directory] = now
+        if stale:
+            # 変更があれば通知 (invalidate) されるので, 下で取り直す
+            watcher.check_roots(directory)
+
+        with self.lock:
+            latest = self.latest.get(directory)
+            if latest is not None and directory not in self.dirty and watcher.is_watching(directory):
+                history = self.versions[directory]
+                if latest[1] in history:
+                    return (latest[1], history[latest[1]])
+            # 取得中に届いた通知は次回に反映されるよう先に消す
+            self.dirty.discard(directory)
+
+        files = tuple(folder_paths.get_filename_list(directory))
+        quick = hash(files)
+        with self.lock:
+            self.checked[directory] = now
+
+        with self.lock:
+            latest = self.latest.get(directory)
+            if latest is not None and latest[0] == quick:
+                history = self.versions[directory]
+                if latest[1] in history:
+                    return (latest[1], history[latest[1]])
+
+        hasher = hashlib.sha1()
+        for name in files:
+            hasher.update(name.encode("utf-8"))
+            hasher.update(b"\n")
+        version = hasher.hexdigest()[:16]
+
+        with self.lock:
+            history = self.versions.setdefault(directory, OrderedDict())
+            history[version] = files
+            history.move_to_end(version)
+            while len(history) > MAX_VERSIONS:
+                history.popitem(last=False)
+            self.latest[directory] = (quick, version)
+        return (version, files)
+
+
+    def delta(self, directory: str, since: str):
+        """since から最新までの (version, added, removed)  since が不明なら None"""
+        version, files = self.get(directory)
+        with self.lock:
+            old = self.versions.get(directory, {}).get(since)
+        if old is None:
+            return None
+
+        old_set = set(old)
+        new_set = set(files)
+        added = [name for name in files if name not in old_set]
+        removed = [name for name in old if name not in new_set]
+        return (version, added, removed)
+
+
+def filter_files(files, prefix: str=None) -> list:
+    """prefix (サブフォルダ等) で絞り込む  区切り文字は / と \\ を区別しない"""
+    if not prefix:
+        return list(files)
+    prefix = prefix.replace("\\", "/")
+    return [name for name in files if name.replace("\\", "/").startswith(prefix)]
+
+
+def normalize_name(name: str) -> str:
+    return name.replace("\\", "/")
+
+
+class NameResolver:
+    """ファイル名 -> フルパス の解決 (ファイル一覧のバージョンごとに集合を作り直す)"""
+    def __init__(self, model_list: ModelList):
+        self.model_list = model_list
+        # directory -> (version, {正規化した名前: 元の名前}, {元の名前: フルパス})
+        self.cache: dict[str, tuple[str, dict[str, str], dict[str, str]]] = {}
+        self.lock = threading.Lock()
+
+
+    def _get(self, directory: str):
+        version, files = self.model_list.get(directory)
+        with self.lock:
+            cached = self.cache.get(directory)
+            if cached is None or cached[0] != version:
+                cached = (version, {normalize_name(name): name for name in files}, {})
+                self.cache[directory] = cached
+        return cached
+
+
+    def resolve(self, directory: str, name: str) -> str | None:
+        """存在すればフルパスを返す (フルパスはバージョン内でメモ化)"""
+        _version, names, full_paths = self._get(directory)
+        actual = names.get(normalize_name(name))
+        if actual is None:
+            # 一覧に反映される前に追加されたファイル (監視の遅れ) はディスクを直接確認する
+            full_path = folder_paths.get_full_path(directory, name)
+            if full_path is not None:
+                self.model_list.invalidate(directory)
+            return full_path
+
+        full_path = full_paths.get(actual)
+        if full_path is None:
+            full_path = folder_paths.get_full_path(directory, actual)
+            if full_path is not None:
+                full_paths[actual] = full_path
+        return full_path
+
+
+model_list = ModelList()
+watcher.subscribe(model_list.invalidate)
+name_resolver = NameResolver(model_list)
@@ -0,0 +1,91 @@
+from .watcher import watcher
+
+import threading
+import sys
+import os
+
+
+# ===============================================
+# プレビューメディアのインデックス
+# ===============================================
+# モデルごとに拡張子を1つずつ stat するのではなく, フォルダごとに1回 os.scandir して
+# ファイル名の stem でまとめておく  フォルダの mtime が変わったら作り直す
+SUPPORTED_EXTENSIONS = {
+    "image": ["jpg", "jpeg", "bmp", "png", "webp", "gif"],
+    "video": ["mp4", "webm"],
+    "audio": ["mp3", "ogg", "wav"]
+}
+
+# 拡張子 -> (優先順位, カテゴリ)
+_EXT_INFO = {}
+for _cate, _exts in SUPPORTED_EXTENSIONS.items():
+    for _ext in _exts:
+        _EXT_INFO[_ext] = (len(_EXT_INFO), _cate)
+
+
+def _stem_key(stem: str) -> str:
+    """stem の比較用キー  Windows / macOS のファイルシステムは大文字小文字を区別しない"""
+    if sys.platform == "darwin":
+        return stem.lower()
+    return os.path.normcase(stem)
+
+
+class PreviewIndex:
+    def __init__(self):
+        self.dirs: dict[str, tuple[int, dict[str, tuple[int, str, str]]]] = {}
+        self.lock = threading.Lock()
+
+
+    def _scan(self, directory: str) -> dict[str, tuple[int, str, str]]:
+        """_stem_key(stem) -> (優先順位, ファイル名, カテゴリ)  同じ stem は優先順位の高いものだけ残す"""
+        previews = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                stem, ext = os.path.splitext(entry.name)
+                # 拡張子は大文字小文字を区別しない (model.PNG 等)
+                info = _EXT_INFO.get(ext[1:].lower())
+                if info is None or not entry.is_file():
+                    continue
+                stem = _stem_key(stem)
+                current = previews.get(stem)
+                if current is None or info[0] < current[0]:
+                    previews[stem] = (info[0], entry.name, info[1])
+        return previews
+
+
+    def _get_dir(self, directory: str) -> dict[str, tuple[int, str, str]]:
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            return {}
+
+        with self.lock:
+            cached = self.dirs.get(directory)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+
+        previews = self._scan(directory)
+        with self.lock:
+            self.dirs[directory] = (mtime_ns, previews)
+        return previews
+
+
+    def find(self, file_path: str):
+        """モデルと同名のプレビューメディアを探して (パス, カテゴリ) を返す"""
+        directory, name = os.path.split(os.path.splitext(file_path)[0])
+        found = self._get_dir(directory).get(_stem_key(name))
+        if found is None:
+            return None
+        return (os.path.join(directory, found[1]), found[2])
+
+
+    def invalidate(self, directory: str=None):
+        with self.lock:
+            if directory is None:
+                self.dirs.clear()
+            else:
+                self.dirs.pop(directory, None)
+
+
+preview_index = PreviewIndex()
+watcher.subscribe(lambda _folder_name, directory: preview_index.invalidate(directory))
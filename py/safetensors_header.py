@@ -0,0 +1,66 @@
+from collections import OrderedDict
+import threading
+import mmap
+import json
+import os
+
+
+# ===============================================
+# safetensors ヘッダー読み込み
+# ===============================================
+# 解析済みの __metadata__ を (パス, サイズ, mtime_ns) ごとにキャッシュする
+# 壊れたファイルや巨大なヘッダーでメモリを使い切らないようにサイズを検証する
+CACHE_SIZE = 4096
+MAX_HEADER_SIZE = int(os.environ.get("JUPO_LORASTACK_MAX_HEADER_MB", 100)) * 1024 * 1024
+
+_cache: OrderedDict[tuple, dict | None] = OrderedDict()
+_lock = threading.Lock()
+
+
+def _read_metadata(filepath, file_size: int):
+    # https://github.com/huggingface/safetensors#format
+    # 8 bytes: N, an unsigned little-endian 64-bit integer, containing the size of the header
+    if file_size < 8:
+        raise BufferError("Invalid header size")
+
+    with open(filepath, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header_size = int.from_bytes(mm[:8], "little", signed=False)
+
+            if header_size <= 0 or header_size > MAX_HEADER_SIZE or header_size + 8 > file_size:
+                raise BufferError("Invalid header size")
+
+            header = mm[8:8 + header_size]
+
+    if not header.startswith(b"{"):
+        raise BufferError("Invalid header")
+
+    header_json = json.loads(header)
+    if not isinstance(header_json, dict):
+        raise BufferError("Invalid header")
+
+    metadata = header_json.get("__metadata__")
+    return metadata if isinstance(metadata, dict) else None
+
+
+def get_metadata(filepath, fields: list[str]=None):
+    """__metadata__ を取得する (fields 指定時はそのキーのみ返す)"""
+    st = os.stat(filepath)
+    key = (os.path.abspath(filepath), st.st_size, st.st_mtime_ns)
+
+    with _lock:
+        found = key in _cache
+        if found:
+            _cache.move_to_end(key)
+            metadata = _cache[key]
+
+    if not found:
+        metadata = _read_metadata(filepath, st.st_size)
+        with _lock:
+            _cache[key] = metadata
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+
+    if metadata is None or not fields:
+        return metadata
+    return {field: metadata[field] for field in fields if field in metadata}
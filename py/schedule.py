@@ -0,0 +1,120 @@
+import comfy.hooks
+
+import threading
+import os
+
+
+# ===============================================
+# スケジュール (start / end) のまとめ
+# ===============================================
+# サンプリング中は, いずれかのキーフレームの境界をまたぐたびに Hook のパッチが当て直される
+# - 同じ (start, end) の LoRA は1つのキーフレームグループを共有する
+# - 境界は JUPO_LORASTACK_SCHEDULE_STEP 単位に丸め, 近い境界を同じステップにまとめる
+#   (0 の場合は浮動小数点の誤差だけを丸める)
+#   丸めると区間が空になる, またはスケジュールなし (0, 1) になる場合は丸めない
+# - end = 1 のキーフレームは不要なので作らない
+# 当て直しの回数は schedule_stats で確認できる (/jupo/LoRAStack/schedule/stats)
+SCHEDULE_STEP = float(os.environ.get("JUPO_LORASTACK_SCHEDULE_STEP", 0))
+
+
+def _snap(value: float) -> float:
+    if SCHEDULE_STEP > 0:
+        value = round(value / SCHEDULE_STEP) * SCHEDULE_STEP
+    return round(min(max(value, 0.0), 1.0), 4)
+
+
+def normalize_schedule(start: float, end: float) -> tuple[float, float]:
+    start = min(max(start, 0.0), 1.0)
+    end = min(max(end, 0.0), 1.0)
+    snapped_start, snapped_end = _snap(start), _snap(end)
+
+    # 丸めで適用される区間の意味を変えない
+    # - 0 より後の start を 0 に, 1 より前の end を 1 にしない (スケジュールなしになってしまう)
+    # - start < end の区間を空にしない
+    if start > 0 and snapped_start <= 0:
+        snapped_start = start
+    if end < 1 and snapped_end >= 1:
+        snapped_end = end
+    if start < end and snapped_end <= snapped_start:
+        snapped_start, snapped_end = start, end
+    return (snapped_start, snapped_end)
+
+
+def schedule_boundaries(schedules) -> list[float]:
+    """当て直しが起こりうる境界 (0 < x < 1) の一覧"""
+    boundaries = set()
+    for start, end in schedules:
+        if 0 < start < 1: boundaries.add(start)
+        if 0 < end < 1: boundaries.add(end)
+    return sorted(boundaries)
+
+
+class ScheduleStats:
+    """キーフレームの切り替え (= パッチの当て直し) をサンプリングごとに数える"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.last_t = None
+        # {"steps": 評価された t, "events": 切り替えのあった t}
+        self.current = None
+        self.last_run = None
+        self.planned = None
+
+
+    def plan(self, schedules: list[tuple[float, float]]):
+        """apply_stack 時点の見込み (グループ数と境界の数)"""
+        with self.lock:
+            self.planned = {
+                "hook_groups": len(schedules),
+                "boundaries": schedule_boundaries(schedules),
+            }
+
+
+    def record(self, curr_t, changed: bool):
+        t = float(curr_t)
+        with self.lock:
+            # t (sigma) はサンプリング中は減っていくので, 増えたら新しい実行とみなす
+            if self.last_t is None or t > self.last_t:
+                if self.current is not None:
+                    self.last_run = self.current
+                self.current = {"steps": set(), "events": set()}
+                self.runs += 1
+            self.last_t = t
+            self.current["steps"].add(t)
+            if changed:
+                self.current["events"].add(t)
+
+
+    def stats(self) -> dict:
+        def summary(run):
+            if run is None:
+                return None
+            return {"steps": len(run["steps"]), "repatch_events": len(run["events"])}
+
+        with self.lock:
+            return {
+                "runs": self.runs,
+                "planned": self.planned,
+                "current_run": summary(self.current),
+                "last_run": summary(self.last_run),
+            }
+
+
+schedule_stats = ScheduleStats()
+
+
+class CountingKeyframeGroup(comfy.hooks.HookKeyframeGroup):
+    """切り替えを schedule_stats に記録する HookKeyframeGroup"""
+    def prepare_current_keyframe(self, curr_t, *args, **kwargs) -> bool:
+        changed = super().prepare_current_keyframe(curr_t, *args, **kwargs)
+        schedule_stats.record(curr_t, changed)
+        return changed
+
+    def clone(self):
+        # 基底クラスの clone は HookKeyframeGroup を作るため上書きする
+        # キーフレームは start_t 等の状態を持つので, 基底クラスと同じく clone する
+        c = CountingKeyframeGroup()
+        for keyframe in self.keyframes:
+            c.keyframes.append(keyframe.clone())
+        c._set_first_as_current()
+        return c
@@ -0,0 +1,293 @@
+from .model_list import model_list
+from .safetensors_header import get_metadata
+from .watcher import watcher
+import folder_paths
+
+import threading
+import bisect
+import json
+import time
+import re
+import os
+
+
+# ===============================================
+# 検索インデックス
+# ===============================================
+# ファイル名, Civitai サイドカー (.civitai.json), safetensors の __metadata__ から
+# トークンの転置インデックスを作成する
+# - ファイル一覧のバージョンが変わったら追加 / 削除分だけ更新する
+# - サイドカーの更新は notify_sidecar とフォルダの変更通知で反映, 定期的に mtime も確認する
+# - クエリの各トークンは前方一致, 全トークンを含むものだけを返す (AND)
+REFRESH_INTERVAL = 300
+MAX_TAGS = 30
+
+# フィールドごとの重み
+WEIGHTS = {
+    "file": 3.0,
+    "name": 3.0,
+    "trigger": 2.0,
+    "tag": 1.5,
+    "base_model": 1.0,
+    "metadata": 1.0,
+}
+EXACT_BONUS = 1.5
+
+_TOKEN_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_RE.findall(text.lower()) if text else []
+
+
+def _sidecar_path(full_path: str) -> str:
+    return os.path.splitext(full_path)[0] + ".civitai.json"
+
+
+def _mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _read_sidecar(path: str) -> dict:
+    try:
+        with open(path, mode="r", encoding="utf-8") as file:
+            data = json.load(file)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _top_tags(tag_frequency: str) -> list[str]:
+    """ss_tag_frequency ({dataset: {tag: count}}) から多い順にタグを返す"""
+    try:
+        data = json.loads(tag_frequency)
+    except (TypeError, ValueError):
+        return []
+    counts = {}
+    for tags in data.values() if isinstance(data, dict) else []:
+        if isinstance(tags, dict):
+            for tag, count in tags.items():
+                counts[tag] = counts.get(tag, 0) + (count if isinstance(count, int) else 0)
+    return sorted(counts, key=counts.get, reverse=True)[:MAX_TAGS]
+
+
+def build_document(name: str, full_path: str) -> dict:
+    """検索用のドキュメント (フィールド -> テキストのリスト) と表示用の情報を作る"""
+    fields = {"file": [name.replace("\\", "/")]}
+    info = {}
+
+    sidecar = _read_sidecar(_sidecar_path(full_path))
+    if sidecar:
+        model = sidecar.get("model") or {}
+        fields["name"] = [str(model.get("name") or ""), str(sidecar.get("name") or "")]
+        fields["trigger"] = [str(word) for word in sidecar.get("trainedWords") or []]
+        fields["tag"] = [str(tag) for tag in model.get("tags") or []]
+        fields["base_model"] = [str(sidecar.get("baseModel") or "")]
+        info["name"] = model.get("name")
+        info["base_model"] = sidecar.get("baseModel")
+
+    if full_path.endswith(".safetensors"):
+        try:
+            metadata = get_metadata(full_path, ["ss_output_name", "ss_base_model_version", "modelspec.title", "ss_tag_frequency"]) or {}
+        except Exception:
+            metadata = {}
+        fields["metadata"] = [
+            str(metadata.get("ss_output_name") or ""),
+            str(metadata.get("ss_base_model_version") or ""),
+            str(metadata.get("modelspec.title") or ""),
+        ]
+        fields.setdefault("tag", []).extend(_top_tags(metadata.get("ss_tag_frequency")))
+        info.setdefault("base_model", metadata.get("ss_base_model_version"))
+
+    return {"fields": fields, "info": info}
+
+
+class SearchIndex:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.version = None
+        # name -> {"full_path", "sidecar_mtime", "tokens": {token: weight}, "info"}
+        self.docs: dict[str, dict] = {}
+        # token -> {name: weight}
+        self.postings: dict[str, dict[str, float]] = {}
+        self.sorted_tokens: list[str] = []
+        self.tokens_dirty = False
+        self.last_refresh = 0
+        self.lock = threading.RLock()
+        # sync 同士の排他  構築中も lock は短時間しか持たないので検索は止まらない
+        self.sync_lock = threading.Lock()
+
+
+    # -------------------------------------------
+    # 更新
+    # -------------------------------------------
+    def sync(self):
+        """ファイル一覧のバージョンが変わっていれば追加 / 削除分だけ反映する"""
+        version, files = model_list.get(self.directory)
+        if version == self.version:
+            return
+
+        delta = model_list.delta(self.directory, self.version) if self.version else None
+        if delta is None:
+            current = set(files)
+            with self.lock:
+                added = [name for name in files if name not in self.docs]
+                removed = [name for name in self.docs if name not in current]
+        else:
+            _version, added, removed = delta
+
+        with self.lock:
+            for name in removed:
+                self._remove(name)
+        for name in added:
+            self.update(name)
+        self.version = version
+
+
+    def update(self, name: str):
+        full_path = folder_paths.get_full_path(self.directory, name)
+        if not full_path:
+            return
+        doc = build_document(name, full_path)
+
+        tokens: dict[str, float] = {}
+        for field, texts in doc["fields"].items():
+            weight = WEIGHTS[field]
+            for text in texts:
+                for token in tokenize(text):
+                    if tokens.get(token, 0) < weight:
+                        tokens[token] = weight
+
+        with self.lock:
+            self._remove(name)
+            self.docs[name] = {
+                "full_path": full_path,
+                "sidecar_mtime": _mtime(_sidecar_path(full_path)),
+                "tokens": tokens,
+                "info": doc["info"],
+            }
+            for token, weight in tokens.items():
+                posting = self.postings.get(token)
+                if posting is None:
+                    self.postings[token] = posting = {}
+                    self.tokens_dirty = True
+                posting[name] = weight
+
+
+    def refresh_sidecars(self, directory: str=None):
+        """サイドカーの mtime が変わったドキュメントを更新する (directory 指定時はそのフォルダのみ)"""
+        if directory is None:
+            self.last_refresh = time.time()
+        with self.lock:
+            targets = [
+                (name, doc["full_path"], doc["sidecar_mtime"]) for name, doc in self.docs.items()
+                if directory is None or os.path.dirname(doc["full_path"]) == directory
+            ]
+        for name, full_path, sidecar_mtime in targets:
+            if _mtime(_sidecar_path(full_path)) != sidecar_mtime:
+                self.update(name)
+
+
+    def _remove(self, name: str):
+        doc = self.docs.pop(name, None)
+        if doc is None:
+            return
+        for token in doc["tokens"]:
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(name, None)
+            if not posting:
+                del self.postings[token]
+                self.tokens_dirty = True
+
+
+    # -------------------------------------------
+    # 検索
+    # -------------------------------------------
+    def _matches(self, query_token: str) -> dict[str, float]:
+        """前方一致するトークンを持つドキュメント -> スコア"""
+        if self.tokens_dirty:
+            self.sorted_tokens = sorted(self.postings)
+            self.tokens_dirty = False
+
+        scores: dict[str, float] = {}
+        sorted_tokens = self.sorted_tokens
+        for i in range(bisect.bisect_left(sorted_tokens, query_token), len(sorted_tokens)):
+            token = sorted_tokens[i]
+            if not token.startswith(query_token):
+                break
+            bonus = EXACT_BONUS if token == query_token else 1.0
+            for name, weight in self.postings[token].items():
+                score = weight * bonus
+                if scores.get(name, 0) < score:
+                    scores[name] = score
+        return scores
+
+
+    def search(self, query: str, limit: int=50) -> tuple[int, list[dict]]:
+        query_tokens = list(dict.fromkeys(tokenize(query)))
+        if not query_tokens:
+            return (0, [])
+
+        with self.lock:
+            # ヒット数の少ないトークンから絞り込む
+            per_token = sorted((self._matches(token) for token in query_tokens), key=len)
+            scores = dict(per_token[0])
+            for matches in per_token[1:]:
+                scores = {name: score + matches[name] for name, score in scores.items() if name in matches}
+                if not scores:
+                    break
+
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            results = [
+                {"file": name, "score": round(score, 3), **self.docs[name]["info"]}
+                for name, score in ranked[:limit]
+            ]
+        return (len(scores), results)
+
+
+class SearchIndexes:
+    def __init__(self):
+        self.indexes: dict[str, SearchIndex] = {}
+        self.lock = threading.Lock()
+
+
+    def is_known(self, directory: str) -> bool:
+        return directory in folder_paths.folder_names_and_paths
+
+
+    def get(self, directory: str) -> SearchIndex:
+        with self.lock:
+            index = self.indexes.get(directory)
+            if index is None:
+                index = self.indexes[directory] = SearchIndex(directory)
+        with index.sync_lock:
+            index.sync()
+        return index
+
+
+    def notify_sidecar(self, full_path: str):
+        """サイドカーを書き込んだモデルのドキュメントを更新する"""
+        with self.lock:
+            indexes = list(self.indexes.values())
+        for index in indexes:
+            with index.lock:
+                names = [name for name, doc in index.docs.items() if doc["full_path"] == full_path]
+            for name in names:
+                index.update(name)
+
+
+    def notify_directory(self, folder_name: str, directory: str):
+        """フォルダの変更通知  サイドカーの追加 / 削除を反映する"""
+        with self.lock:
+            index = self.indexes.get(folder_name)
+        if index is not None:
+            index.refresh_sidecars(directory)
+
+
+search_indexes = SearchIndexes()
+watcher.subscribe(search_indexes.notify_directory)
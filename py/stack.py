@@ -0,0 +1,254 @@
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+import functools
+import hashlib
+import copy
+import json
+
+
+# ===============================================
+# LORASTACK の型
+# ===============================================
+# - LoRAEntry: 1つの LoRA の設定  生成時に1回だけ検証 / 正規化し, 以後は変更しない
+# - LoRAStack: エントリの列  連結は親をたどる形で共有し, リスト全体をコピーしない
+#   内容のハッシュ (digest) を持つので下流のキャッシュのキーにそのまま使える
+# 従来の dict のリストも受け付ける (LoRAStack.from_value) / 返せる (to_list)
+# - StackList: ノードの出力 (dict のリスト)  元の LoRAStack を持ち, 次のノードでそのまま使う
+# どちらも pickle / deepcopy でき, to_dict / to_list の結果はそのまま JSON にできる
+
+
+class FrozenDict(dict):
+    """変更できない dict  (dict のサブクラスなので JSON / pickle / deepcopy がそのまま使える)"""
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenDict is read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return type(self)(copy.deepcopy(dict(self), memo))
+
+
+_EMPTY = FrozenDict()
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_path(path: str) -> str:
+    """パス形式を統一 (OS の区切り文字)"""
+    return str(Path(path))
+
+
+def _to_float(value, default: float) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _freeze_block(block) -> FrozenDict:
+    """{"model": {キー: 重み}, "clip": {...}} を読み取り専用にする"""
+    if not isinstance(block, dict):
+        return _EMPTY
+    return FrozenDict({
+        target: FrozenDict({str(key): _to_float(weight, 1.0) for key, weight in info.items()})
+        for target, info in block.items() if isinstance(info, dict)
+    })
+
+
+@dataclass(frozen=True, slots=True, eq=False)
+class LoRAEntry:
+    lora: str = "None"
+    enabled: bool = False
+    strength_model: float = 1.0
+    strength_clip: float = 1.0
+    clip_mode: bool = False
+    enabled_block: bool = False
+    model_type: str | None = None
+    block: FrozenDict = None
+    start: float = 0.0
+    end: float = 1.0
+    enabled_trigger: bool = False
+    trigger: str = ""
+    # 上記以外のキー (フロントエンドの display_name 等)  to_dict でそのまま返す
+    extra: FrozenDict = None
+    # 正規化した内容の sha1 (比較 / ハッシュ用)
+    digest: str = field(init=False, repr=False)
+
+
+    def __post_init__(self):
+        setattr_ = functools.partial(object.__setattr__, self)
+        setattr_("lora", normalize_path(self.lora) if self.lora else "None")
+        setattr_("enabled", bool(self.enabled))
+        setattr_("strength_model", _to_float(self.strength_model, 1.0))
+        setattr_("strength_clip", _to_float(self.strength_clip, 1.0))
+        setattr_("clip_mode", bool(self.clip_mode))
+        setattr_("enabled_block", bool(self.enabled_block))
+        if not isinstance(self.block, FrozenDict):
+            setattr_("block", _freeze_block(self.block))
+        setattr_("start", max(0.0, _to_float(self.start, 0.0)))
+        setattr_("end", min(_to_float(self.end, 1.0), 1.0))
+        setattr_("enabled_trigger", bool(self.enabled_trigger))
+        setattr_("trigger", self.trigger if isinstance(self.trigger, str) else "")
+        setattr_("model_type", self.model_type if isinstance(self.model_type, str) else None)
+        if not isinstance(self.extra, FrozenDict):
+            extra = self.extra if isinstance(self.extra, dict) else {}
+            setattr_("extra", FrozenDict({key: copy.deepcopy(value) for key, value in extra.items() if key not in _FIELD_NAMES}))
+
+        content = json.dumps(self.to_dict(), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        setattr_("digest", hashlib.sha1(content.encode("utf-8")).hexdigest())
+
+
+    @classmethod
+    def from_dict(cls, value: dict) -> "LoRAEntry":
+        if isinstance(value, LoRAEntry):
+            return value
+        extra = {key: item for key, item in value.items() if key not in _FIELD_NAMES}
+        return cls(**{name: value[name] for name in _FIELD_NAMES if name in value}, extra=extra)
+
+
+    def to_dict(self) -> dict:
+        data = copy.deepcopy(dict(self.extra))
+        data.update((name, getattr(self, name)) for name in _FIELD_NAMES)
+        data["block"] = {target: dict(info) for target, info in self.block.items()}
+        return data
+
+
+    def __reduce__(self):
+        # slots のみで digest は生成時に計算するため, dict から作り直す
+        return (LoRAEntry.from_dict, (self.to_dict(),))
+
+
+    @property
+    def lbw(self) -> dict[str, dict]:
+        """LBWLoRALoader に渡すブロック情報 (無効なら空)"""
+        if not self.enabled_block:
+            return {}
+        return {target: dict(info) for target, info in self.block.items()}
+
+
+    # dict と同じように読めるようにする (従来のコードとの互換用)
+    def get(self, name: str, default=None):
+        if name in _FIELD_NAMES:
+            return getattr(self, name)
+        return self.extra.get(name, default)
+
+    def __getitem__(self, name: str):
+        if name in _FIELD_NAMES:
+            return getattr(self, name)
+        return self.extra[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in _FIELD_NAMES or name in self.extra
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, LoRAEntry) and self.digest == other.digest
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+
+_FIELD_NAMES = tuple(f.name for f in fields(LoRAEntry) if f.name not in ("digest", "extra"))
+
+
+class LoRAStack:
+    """LoRAEntry の永続リスト  連結しても既存のスタックは変わらない"""
+    __slots__ = ("parent", "entries", "length", "digest", "_hasher", "_flat")
+
+    def __init__(self, entries: tuple[LoRAEntry, ...]=(), parent: "LoRAStack"=None):
+        if parent is not None and not parent:
+            parent = None
+        self.parent = parent
+        self.entries = tuple(entries)
+        self.length = (len(parent) if parent else 0) + len(self.entries)
+
+        # 親のハッシュ状態を引き継ぐので, 連結の仕方によらず並びが同じなら同じ digest になる
+        hasher = parent._hasher.copy() if parent else hashlib.sha1()
+        for entry in self.entries:
+            hasher.update(entry.digest.encode("ascii"))
+        self._hasher = hasher
+        self.digest = hasher.hexdigest()
+        self._flat = None
+
+
+    @classmethod
+    def from_value(cls, value) -> "LoRAStack":
+        """LoRAStack / dict (または LoRAEntry) のリスト / None を LoRAStack にする"""
+        if isinstance(value, LoRAStack):
+            return value
+        # StackList がその場で変更されていたら (要素数が違えば) dict から作り直す
+        if isinstance(value, StackList) and value.stack is not None and len(value) == len(value.stack):
+            return value.stack
+        if not value:
+            return EMPTY_STACK
+        return cls(tuple(LoRAEntry.from_dict(item) for item in value))
+
+
+    def chain(self, other) -> "LoRAStack":
+        """self の後ろに other をつなげたスタック (self は親として共有される)"""
+        other = LoRAStack.from_value(other)
+        if not other:
+            return self
+        if not self:
+            return other
+        return LoRAStack(tuple(other), parent=self)
+
+
+    def flat(self) -> tuple[LoRAEntry, ...]:
+        if self._flat is None:
+            self._flat = (self.parent.flat() if self.parent else ()) + self.entries
+        return self._flat
+
+
+    def to_list(self) -> "StackList":
+        return StackList(self)
+
+
+    def __reduce__(self):
+        # hashlib のオブジェクトは pickle できないので, 平坦なエントリ列から作り直す
+        return (LoRAStack, (self.flat(),))
+
+
+    def __add__(self, other) -> "LoRAStack":
+        return self.chain(other)
+
+    def __radd__(self, other) -> "LoRAStack":
+        return LoRAStack.from_value(other).chain(self)
+
+    def __iter__(self):
+        return iter(self.flat())
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index):
+        return self.flat()[index]
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, LoRAStack) and self.digest == other.digest
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+    def __repr__(self) -> str:
+        return f"LoRAStack({len(self)} entries, digest={self.digest[:12]})"
+
+
+class StackList(list):
+    """ノードの出力用の dict のリスト  元の LoRAStack を持つので次のノードで作り直さない
+
+    LORASTACK を受け取る他のカスタムノードは従来どおり list として扱える (isinstance, json.dumps)
+    """
+    def __init__(self, stack: LoRAStack=None):
+        super().__init__(entry.to_dict() for entry in stack or ())
+        self.stack = stack
+
+
+EMPTY_STACK = LoRAStack()
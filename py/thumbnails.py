@@ -0,0 +1,166 @@
+import folder_paths
+
+import threading
+import hashlib
+import time
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+# ===============================================
+# サムネイル
+# ===============================================
+# エクスプローラのグリッド用に縮小した WebP を生成してディスクにキャッシュする
+# - キャッシュのキー: (元ファイルのパス, mtime_ns, サイズ)
+# - 合計サイズが上限を超えたら古いもの (最終アクセス順) から削除する
+#   アクセス時刻はメモリ上に持つ (mtime を変えると配信時の ETag が変わってしまうため)
+#   このプロセスでアクセスしていないものは作成時刻 (mtime) で比べる
+# - 動画は最初のフレームを使う (PyAV か OpenCV がある場合)
+MIN_SIZE = 64
+MAX_SIZE = 1024
+SIZE_STEP = 64
+QUALITY = 80
+MAX_CACHE_BYTES = int(os.environ.get("JUPO_LORASTACK_THUMBNAIL_CACHE_MB", 512)) * 1024 * 1024
+
+
+def normalize_size(size) -> int:
+    """サイズのバリエーションを減らすため SIZE_STEP 単位に切り上げる"""
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        size = 256
+    size = max(MIN_SIZE, min(MAX_SIZE, size))
+    return -(-size // SIZE_STEP) * SIZE_STEP
+
+
+def _open_video_frame(path: str):
+    """動画の最初のフレームを PIL.Image で返す (デコーダーがなければ None)"""
+    try:
+        import av
+        with av.open(path) as container:
+            for frame in container.decode(video=0):
+                return frame.to_image()
+    except ImportError:
+        pass
+    except Exception as e:
+        print(f"Failed to decode video frame: {e}")
+        return None
+
+    try:
+        import cv2
+        capture = cv2.VideoCapture(path)
+        try:
+            ok, frame = capture.read()
+        finally:
+            capture.release()
+        if ok:
+            return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    except ImportError:
+        pass
+    return None
+
+
+class ThumbnailCache:
+    def __init__(self, cache_dir: str=None, max_bytes: int=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir or os.path.join(folder_paths.get_user_directory(), "jupo-lorastack", "thumbnails")
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+        # パス -> 最終アクセス時刻 (time.time)
+        self.accessed: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+
+    def cache_path(self, source: str, mtime_ns: int, size: int) -> str:
+        key = hashlib.sha1(f"{source}\0{mtime_ns}\0{size}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}.webp")
+
+
+    def get(self, source: str, cate: str, mtime_ns: int, size: int) -> str | None:
+        """サムネイルのパスを返す (なければ生成, 生成できなければ None)"""
+        path = self.cache_path(source, mtime_ns, size)
+        if os.path.isfile(path):
+            with self.lock:
+                self.accessed[path] = time.time()
+            return path
+
+        if Image is None:
+            return None
+
+        if cate == "image":
+            image = Image.open(source)
+        elif cate == "video":
+            image = _open_video_frame(source)
+        else:
+            image = None
+        if image is None:
+            return None
+
+        # アニメーション画像は最初のフレームになる
+        with image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            image.save(temp_path, "WEBP", quality=QUALITY)
+            os.replace(temp_path, path)
+
+        with self.lock:
+            self.accessed[path] = time.time()
+        self._add(os.path.getsize(path))
+        return path
+
+
+    def _add(self, nbytes: int):
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = self._scan_total()
+            else:
+                self.total_bytes += nbytes
+            if self.total_bytes > self.max_bytes:
+                self._cleanup()
+
+
+    def _list_files(self) -> list[tuple[float, int, str]]:
+        files = []
+        for root, _dirs, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith(".webp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((max(st.st_mtime, self.accessed.get(path, 0)), st.st_size, path))
+        return files
+
+
+    def _scan_total(self) -> int:
+        return sum(size for _mtime, size, _path in self._list_files())
+
+
+    def _cleanup(self):
+        """上限の 90% になるまで最終アクセスの古いものから削除"""
+        files = sorted(self._list_files())
+        total = sum(size for _mtime, size, _path in files)
+        target = self.max_bytes * 0.9
+        for _mtime, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                self.accessed.pop(path, None)
+            except OSError:
+                pass
+        self.total_bytes = total
+
+
+thumbnail_cache = ThumbnailCache()
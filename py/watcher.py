@@ -0,0 +1,284 @@
+import folder_paths
+
+import threading
+import time
+import os
+
+
+# ===============================================
+# モデルフォルダの変更監視
+# ===============================================
+# loras / checkpoints に登録された全パスを監視し, 変更のあったフォルダを通知する
+# - watchdog がインストールされていれば OS の通知 (inotify 等) を使う
+# - なければフォルダの mtime をポーリングする (フォルダ1つにつき stat 1回)
+# 通知を受けた側は該当フォルダのキャッシュだけを破棄する
+# フォルダは基準 (ポーリングなら全ディレクトリの mtime) を取り終えてから監視中として扱う
+# ポーリングでは変更が最大 POLL_INTERVAL 遅れて反映される
+# (ModelList はルートのフォルダだけ check_roots でその場で確認する)
+ENABLED = os.environ.get("JUPO_LORASTACK_WATCHER", "1") == "1"
+FOLDERS = ["loras", "checkpoints"]
+POLL_INTERVAL = float(os.environ.get("JUPO_LORASTACK_WATCHER_INTERVAL", 2.0))
+
+
+class ModelWatcher:
+    def __init__(self, folders: list[str]=FOLDERS):
+        self.folders = folders
+        self.subscribers = []
+        # ディレクトリ -> mtime_ns (ポーリング用)
+        self.dir_mtimes: dict[str, int] = {}
+        # ディレクトリ -> フォルダ名 ("loras" 等)
+        self.dir_folders: dict[str, str] = {}
+        # ディレクトリ -> (st_dev, st_ino)  シンボリックリンクの循環を辿らないため
+        self.dir_ids: dict[str, tuple[int, int]] = {}
+        self.known_ids: set[tuple[int, int]] = set()
+        # watchdog で監視中のルート -> フォルダ名
+        self.watched_roots: dict[str, str] = {}
+        # 監視できないルートがあるフォルダ (キャッシュを信用しない)
+        self.unwatched: set[str] = set()
+        # 基準を取り終えたフォルダ
+        self.ready: set[str] = set()
+        self.thread = None
+        self.observer = None
+        self.handler_class = None
+        self.active = False
+        self.polling = False
+        self.lock = threading.RLock()
+
+
+    def subscribe(self, callback):
+        """callback(folder_name, directory) を登録する"""
+        self.subscribers.append(callback)
+
+
+    def is_watching(self, folder_name: str) -> bool:
+        return self.active and folder_name in self.ready and folder_name not in self.unwatched
+
+
+    def publish(self, folder_name: str, directory: str):
+        for callback in list(self.subscribers):
+            try:
+                callback(folder_name, directory)
+            except Exception as e:
+                print(f"[jupo-lorastack] watcher: {e}")
+
+
+    def start(self):
+        if self.active:
+            return
+        self.active = True
+        if self._start_watchdog():
+            # 後から追加 / 作成されたルートを監視に加える
+            self._mark_ready(self.folders)
+            target = self._root_loop
+        else:
+            self.polling = True
+            target = self._poll_loop
+        self.thread = threading.Thread(target=target, name="jupo-lorastack-watcher", daemon=True)
+        self.thread.start()
+
+
+    def _mark_ready(self, folders: list[str]):
+        """基準より前に取得されたキャッシュは信用できないので, 破棄させてから監視中にする"""
+        for folder_name in folders:
+            self.ready.add(folder_name)
+            for root in self._roots(folder_name):
+                self.publish(folder_name, root)
+
+
+    # -------------------------------------------
+    # watchdog
+    # -------------------------------------------
+    def _start_watchdog(self) -> bool:
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return False
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def __init__(self, folder_name):
+                self.folder_name = folder_name
+
+            def on_any_event(self, event):
+                # 内容の変更 (modified) はファイル一覧に影響しないので無視
+                if event.event_type in ("modified", "opened", "closed", "closed_no_write"):
+                    return
+                paths = [event.src_path, getattr(event, "dest_path", "")]
+                for path in paths:
+                    if path:
+                        watcher.publish(self.folder_name, os.path.dirname(path))
+
+        observer = Observer()
+        roots = {}
+        try:
+            for folder_name in self.folders:
+                for root in self._roots(folder_name):
+                    observer.schedule(Handler(folder_name), root, recursive=True)
+                    roots[root] = folder_name
+            observer.daemon = True
+            observer.start()
+        except OSError as e:
+            # inotify の上限に達した場合など  ポーリングで監視する
+            print(f"[jupo-lorastack] watcher: watchdog unavailable, falling back to polling: {e}")
+            try:
+                observer.stop()
+            except Exception:
+                pass
+            return False
+
+        self.observer = observer
+        self.handler_class = Handler
+        self.watched_roots = roots
+        return True
+
+
+    def _root_loop(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            try:
+                self.schedule_new_roots()
+            except Exception as e:
+                print(f"[jupo-lorastack] watcher: {e}")
+
+
+    def schedule_new_roots(self):
+        """起動時になかったルート (extra_model_paths 等) を watchdog の監視に加える"""
+        unwatched = set()
+        for folder_name in self.folders:
+            for root in self._roots(folder_name):
+                if root in self.watched_roots:
+                    continue
+                try:
+                    self.observer.schedule(self.handler_class(folder_name), root, recursive=True)
+                except OSError as e:
+                    # 変更を通知できないので, このフォルダは監視中として扱わない
+                    if folder_name not in self.unwatched:
+                        print(f"[jupo-lorastack] watcher: cannot watch {root}: {e}")
+                    unwatched.add(folder_name)
+                    continue
+                self.watched_roots[root] = folder_name
+                self.publish(folder_name, root)
+        self.unwatched = unwatched
+
+
+    # -------------------------------------------
+    # ポーリング
+    # -------------------------------------------
+    def _roots(self, folder_name: str) -> list[str]:
+        try:
+            return [path for path in folder_paths.get_folder_paths(folder_name) if os.path.isdir(path)]
+        except KeyError:
+            return []
+
+
+    def _scan_tree(self, folder_name: str, root: str):
+        # folder_paths と同じくリンク先も辿るが, 既に見たディレクトリ (循環) には入らない
+        for directory, dirs, _files in os.walk(root, followlinks=True):
+            try:
+                st = os.stat(directory)
+            except OSError:
+                dirs[:] = []
+                continue
+            identity = (st.st_dev, st.st_ino)
+            if identity in self.known_ids and self.dir_ids.get(directory) != identity:
+                dirs[:] = []
+                continue
+            self.dir_mtimes[directory] = st.st_mtime_ns
+            self.dir_folders[directory] = folder_name
+            self.dir_ids[directory] = identity
+            self.known_ids.add(identity)
+
+
+    def _forget(self, directory: str):
+        self.dir_mtimes.pop(directory, None)
+        self.dir_folders.pop(directory, None)
+        self.known_ids.discard(self.dir_ids.pop(directory, None))
+
+
+    def _poll_loop(self):
+        for folder_name in self.folders:
+            with self.lock:
+                for root in self._roots(folder_name):
+                    self._scan_tree(folder_name, root)
+            self._mark_ready([folder_name])
+
+        while True:
+            time.sleep(POLL_INTERVAL)
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"[jupo-lorastack] watcher: {e}")
+
+
+    def poll(self):
+        """変更のあったフォルダを通知する"""
+        with self.lock:
+            # 監視対象のルートが増えた場合 (extra_model_paths 等)
+            for folder_name in self.folders:
+                for root in self._roots(folder_name):
+                    if root not in self.dir_mtimes:
+                        self._scan_tree(folder_name, root)
+                        self.publish(folder_name, root)
+
+            for directory in list(self.dir_mtimes):
+                self._check(directory)
+
+
+    def check_roots(self, folder_name: str) -> bool:
+        """ポーリング中なら folder_name のルートだけをその場で確認する (変更があれば通知して True)"""
+        if not self.polling or folder_name not in self.ready:
+            return False
+        changed = False
+        with self.lock:
+            for root in self._roots(folder_name):
+                if root not in self.dir_mtimes:
+                    self._scan_tree(folder_name, root)
+                    self.publish(folder_name, root)
+                    changed = True
+                elif self._check(root):
+                    changed = True
+        return changed
+
+
+    def _check(self, directory: str) -> bool:
+        mtime_ns = self.dir_mtimes.get(directory)
+        folder_name = self.dir_folders.get(directory)
+        if mtime_ns is None:
+            return False
+        try:
+            current = os.stat(directory).st_mtime_ns
+        except OSError:
+            # 削除されたフォルダ
+            self._forget(directory)
+            self.publish(folder_name, directory)
+            return True
+
+        if current == mtime_ns:
+            return False
+        self.dir_mtimes[directory] = current
+        self._scan_new_subdirs(folder_name, directory)
+        self.publish(folder_name, directory)
+        return True
+
+
+    def _scan_new_subdirs(self, folder_name: str, directory: str):
+        """追加されたサブフォルダだけを走査する"""
+        try:
+            with os.scandir(directory) as it:
+                subdirs = [entry.path for entry in it if entry.is_dir()]
+        except OSError:
+            return
+        for subdir in subdirs:
+            if subdir not in self.dir_mtimes:
+                self._scan_tree(folder_name, subdir)
+                self.publish(folder_name, subdir)
+
+
+watcher = ModelWatcher()
+
+
+def start_if_enabled():
+    if ENABLED:
+        watcher.start()
@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import os
+
+
+# ===============================================
+# ブロッキング処理用のワーカープール
+# ===============================================
+# ハッシュ計算やファイルI/Oをイベントループ上で行うと ComfyUI サーバー全体が止まるため
+# 共有のスレッドプールで実行する
+MAX_WORKERS = int(os.environ.get("JUPO_LORASTACK_WORKERS", 4))
+MAX_HASH_JOBS = int(os.environ.get("JUPO_LORASTACK_HASH_JOBS", 1))
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="jupo-lorastack")
+
+# 同時ハッシュ計算数の上限 (ディスクを占有しないように)
+_hash_semaphore = None
+
+
+def _get_hash_semaphore() -> asyncio.Semaphore:
+    global _hash_semaphore
+    if _hash_semaphore is None:
+        _hash_semaphore = asyncio.Semaphore(MAX_HASH_JOBS)
+    return _hash_semaphore
+
+
+async def run_blocking(func, *args, **kwargs):
+    """ブロッキング関数をワーカープールで実行する"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+async def run_hash_job(func, *args, **kwargs):
+    """ハッシュ計算などの重いI/O処理を同時実行数を制限して実行する"""
+    async with _get_hash_semaphore():
+        return await run_blocking(func, *args, **kwargs)
+
+
+# 実行中の処理 (key -> Future)
+_inflight: dict[object, asyncio.Future] = {}
+
+
+async def coalesce(key, factory):
+    """同じ key の処理が実行中ならその結果を待つ, なければ factory() を実行する"""
+    future = _inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(factory())
+        _inflight[key] = future
+        future.add_done_callback(lambda _: _inflight.pop(key, None))
+    # 呼び出し元のキャンセルで共有中の処理が止まらないようにする
+    return await asyncio.shield(future)
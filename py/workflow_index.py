@@ -0,0 +1,69 @@
+from collections import OrderedDict
+import threading
+import hashlib
+import json
+
+
+# ===============================================
+# ワークフローのノード索引
+# ===============================================
+# extra_pnginfo はプロンプト内の全ノードで同じオブジェクトが渡されるので
+# workflow.nodes を1回だけ id -> node の dict に変換して使い回す
+# (ノードごとに全ノードを走査すると, スタックノードの数 x ノード数 になる)
+MAX_WORKFLOWS = 4
+MAX_PARSED_LISTS = 256
+
+
+class WorkflowNodeIndex:
+    def __init__(self, max_size: int=MAX_WORKFLOWS):
+        # id(nodes) -> (nodes, {str(id): node})  nodes を保持して id の再利用を防ぐ
+        self.entries: OrderedDict[int, tuple[list, dict[str, dict]]] = OrderedDict()
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+
+    def get_node(self, extra_pnginfo: dict, unique_id) -> dict | None:
+        nodes = extra_pnginfo.get("workflow").get("nodes")
+        key = id(nodes)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] is not nodes:
+                # 同じ id が複数ある場合は後のものを優先 (従来の走査と同じ)
+                entry = (nodes, {str(node.get("id")): node for node in nodes})
+                self.entries[key] = entry
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(key)
+
+        return entry[1].get(str(unique_id))
+
+
+class LoRAListParser:
+    """JSON 形式の lora_list を内容のハッシュでメモ化して解析する"""
+    def __init__(self, max_size: int=MAX_PARSED_LISTS):
+        self.entries: OrderedDict[bytes, tuple] = OrderedDict()
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+
+    def parse(self, text: str) -> tuple:
+        """解析結果 (共有されるので呼び出し側で書き換えないこと)"""
+        key = hashlib.sha1(text.encode("utf-8")).digest()
+        with self.lock:
+            parsed = self.entries.get(key)
+            if parsed is not None:
+                self.entries.move_to_end(key)
+                return parsed
+
+        parsed = tuple(json.loads(text))
+        with self.lock:
+            self.entries[key] = parsed
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return parsed
+
+
+workflow_index = WorkflowNodeIndex()
+lora_list_parser = LoRAListParser()
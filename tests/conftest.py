@@ -0,0 +1,50 @@
+import importlib.util
+import sys
+import os
+
+import pytest
+
+
+# ComfyUI (comfy / folder_paths) の場所は COMFYUI_PATH で指定する
+# 見つからないモジュールを使うテストは pytest.importorskip でスキップされる
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.environ.get("COMFYUI_PATH"):
+    sys.path.insert(0, os.environ["COMFYUI_PATH"])
+
+
+# py/ は __init__.py を持たず, pytest の py モジュールとも名前が衝突するため
+# 別名のパッケージとして登録する (ノードの登録やインデクサの起動は行わない)
+_spec = importlib.util.spec_from_loader("jupo_lorastack", loader=None, is_package=True)
+_package = importlib.util.module_from_spec(_spec)
+_package.__path__ = [os.path.join(ROOT, "py")]
+sys.modules.setdefault("jupo_lorastack", _package)
+
+
+@pytest.fixture(scope="session")
+def endpoint_routes():
+    """py/endpoints.py のルート (ComfyUI のサーバーを起動せずに aiohttp のアプリに登録する)"""
+    pytest.importorskip("aiohttp")
+    server = pytest.importorskip("server")
+    from aiohttp import web
+    # PromptServer.instance は ComfyUI の起動時に作られる  テストではルートの登録先だけ用意する
+    if getattr(server.PromptServer, "instance", None) is None:
+        server.PromptServer.instance = type("PromptServer", (), {"routes": web.RouteTableDef()})()
+    pytest.importorskip("jupo_lorastack.endpoints")
+    return server.PromptServer.instance.routes
+
+
+@pytest.fixture
+def run_app(endpoint_routes):
+    """run_app(coro_factory) -> coro_factory(client) の結果  client は py/endpoints.py のルートを持つ"""
+    import asyncio
+    from aiohttp import web
+    from aiohttp.test_utils import TestClient, TestServer
+
+    def run(coro_factory):
+        async def main():
+            app = web.Application()
+            app.add_routes(endpoint_routes)
+            async with TestClient(TestServer(app)) as client:
+                return await coro_factory(client)
+        return asyncio.run(main())
+    return run
@@ -0,0 +1,58 @@
+import { test } from "node:test";
+import assert from "node:assert/strict";
+
+import { PreviewBatcher, PREVIEW_CHUNK_SIZE } from "../../web/dialogs/explorer/preview_batcher.js";
+
+// py/endpoints.py の MAX_BULK_PATHS と同じく, 上限を超えるリクエストはエラーを返すサーバー
+const MAX_BULK_PATHS = 5000;
+
+function stubServer() {
+    const requests = [];
+    const post = async (paths) => {
+        requests.push(paths.length);
+        if (paths.length > MAX_BULK_PATHS) {
+            return { status: "error", message: `Too many paths (max ${MAX_BULK_PATHS}).` };
+        }
+        return Object.fromEntries(paths.map(path => [path, { token: `t-${path}` }]));
+    };
+    return { requests, post };
+}
+
+test("more than MAX_BULK_PATHS previews are requested in chunks", async () => {
+    const server = stubServer();
+    const batcher = new PreviewBatcher(server.post);
+    const paths = Array.from({ length: 12345 }, (_, i) => `loras/${i}.safetensors`);
+
+    const results = await Promise.all(paths.map(path => batcher.request(path)));
+
+    assert.equal(server.requests.length, Math.ceil(paths.length / PREVIEW_CHUNK_SIZE));
+    assert.ok(server.requests.every(count => count <= PREVIEW_CHUNK_SIZE));
+    assert.deepEqual(results.map(result => result.token), paths.map(path => `t-${path}`));
+});
+
+test("duplicate paths share one request entry", async () => {
+    const server = stubServer();
+    const batcher = new PreviewBatcher(server.post);
+
+    const results = await Promise.all(["a", "a", "b"].map(path => batcher.request(path)));
+
+    assert.deepEqual(server.requests, [2]);
+    assert.deepEqual(results.map(result => result.token), ["t-a", "t-a", "t-b"]);
+});
+
+test("a failed chunk resolves only its own paths to null", async () => {
+    let calls = 0;
+    const batcher = new PreviewBatcher(async (paths) => {
+        calls += 1;
+        if (calls === 1) throw new Error("network");
+        return Object.fromEntries(paths.map(path => [path, { token: path }]));
+    }, 2);
+    const original = console.error;
+    console.error = () => {};
+    try {
+        const results = await Promise.all(["a", "b", "c"].map(path => batcher.request(path)));
+        assert.deepEqual(results, [null, null, { token: "c" }]);
+    } finally {
+        console.error = original;
+    }
+});
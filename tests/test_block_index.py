@@ -0,0 +1,119 @@
+import time
+
+import pytest
+
+lora_cache = pytest.importorskip("jupo_lorastack.lora_cache")
+BlockIndex = lora_cache.BlockIndex
+
+
+def flux_internal_keys() -> list:
+    """FLUX の key map の内部キーに相当するもの (結合された qkv の一部は (キー, (dim, start, length)))"""
+    keys = []
+    for i in range(19):
+        for stream in ("img", "txt"):
+            keys.append(f"diffusion_model.double_blocks.{i}.{stream}_attn.qkv.weight")
+            keys.append(f"diffusion_model.double_blocks.{i}.{stream}_attn.proj.weight")
+            keys.append(f"diffusion_model.double_blocks.{i}.{stream}_mlp.0.weight")
+            keys.append(f"diffusion_model.double_blocks.{i}.{stream}_mlp.2.weight")
+            keys.append(f"diffusion_model.double_blocks.{i}.{stream}_mod.lin.weight")
+    for i in range(38):
+        for start in (0, 3072, 6144, 9216):
+            keys.append((f"diffusion_model.single_blocks.{i}.linear1.weight", (0, start, 3072)))
+        keys.append(f"diffusion_model.single_blocks.{i}.linear2.weight")
+        keys.append(f"diffusion_model.single_blocks.{i}.modulation.lin.weight")
+    keys += [
+        "diffusion_model.img_in.weight",
+        "diffusion_model.txt_in.weight",
+        "diffusion_model.time_in.in_layer.weight",
+        "diffusion_model.final_layer.linear.weight",
+    ]
+    return keys
+
+
+def flux_block_info() -> dict:
+    """web/dialogs/block_weight/block_configs.js の FLUX のキー"""
+    info = {"_in": 0.5, "final_layer": 0.5}
+    for i in range(19):
+        info[f"double_blocks.{i}."] = 1.0
+    for i in range(38):
+        info[f"single_blocks.{i}."] = 0.0
+    return info
+
+
+def old_scan(block_info: dict, internal_keys: list) -> dict:
+    """以前の mapping_block_info (全キーに対する `in` の総当たり)"""
+    normalized = {}
+    for search_key, weight in block_info.items():
+        for internal_key in internal_keys:
+            if search_key in internal_key:
+                normalized[internal_key] = weight
+    return normalized
+
+
+def new_lookup(block_info: dict, block_index) -> dict:
+    normalized = {}
+    for search_key, weight in block_info.items():
+        for internal_key in block_index.lookup(search_key):
+            normalized[internal_key] = weight
+    return normalized
+
+
+def test_matches_old_scan_for_string_keys():
+    keys = [key for key in flux_internal_keys() if isinstance(key, str)]
+    block_info = flux_block_info()
+    assert new_lookup(block_info, BlockIndex(keys)) == old_scan(block_info, keys)
+
+
+def test_tuple_keys_match_by_key_string():
+    # 以前は `str in tuple` になり一致しなかった (単一ブロックの linear1 に LBW が効かなかった)
+    keys = flux_internal_keys()
+    index = BlockIndex(keys)
+    matched = index.lookup("single_blocks.3.")
+    linear1 = [key for key in matched if isinstance(key, tuple)]
+    assert len(linear1) == 4
+    assert all(key[0] == "diffusion_model.single_blocks.3.linear1.weight" for key in linear1)
+    assert not any(isinstance(key, tuple) for key in old_scan({"single_blocks.3.": 1.0}, keys))
+
+    # 文字列として扱えば, それ以外は総当たりと同じ
+    as_text = {key: key[0] if isinstance(key, tuple) else key for key in keys}
+    expected = {key for key in keys if "single_blocks.3." in as_text[key]}
+    assert set(matched) == expected
+
+
+def test_lookup_edge_cases():
+    index = BlockIndex(["a.b.c", "a.bb", "bb.a", "c"])
+    # 1つのキー内の複数の一致は1回だけ数える / 区切りをまたいで一致しない
+    assert index.lookup("b") == ("a.b.c", "a.bb", "bb.a")
+    assert index.lookup("c\na") == ()
+    assert index.lookup("a.b") == ("a.b.c", "a.bb")
+    assert index.lookup("") == ("a.b.c", "a.bb", "bb.a", "c")
+    assert index.lookup("missing") == ()
+    # 2回目はメモ化された結果を返す
+    assert index.lookup("b") is index.lookup("b")
+
+
+def test_benchmark_against_old_scan():
+    keys = flux_internal_keys() * 4
+    block_info = flux_block_info()
+    string_keys = [key for key in keys if isinstance(key, str)]
+    rounds = 20
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        expected = old_scan(block_info, string_keys)
+    scan_time = (time.perf_counter() - start) / rounds
+
+    index = BlockIndex(list(dict.fromkeys(keys)))
+    start = time.perf_counter()
+    new_lookup(block_info, index)
+    cold_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = new_lookup(block_info, index)
+    warm_time = (time.perf_counter() - start) / rounds
+
+    # 時間は環境によって変わるので表示だけする (pytest -s)
+    print(f"\nBlockIndex ({len(keys)} keys, {len(block_info)} blocks): "
+          f"scan {scan_time * 1000:.2f}ms, index cold {cold_time * 1000:.2f}ms, warm {warm_time * 1000:.3f}ms")
+    assert {key: value for key, value in result.items() if isinstance(key, str)} == expected
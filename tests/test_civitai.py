@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+test_utils = pytest.importorskip("aiohttp.test_utils")
+civitai = pytest.importorskip("jupo_lorastack.civitai")
+
+
+class StubCivitai:
+    """civitai.com の代わりに by-hash API に応答するサーバー
+
+    responses: 順に返す (ステータス, ヘッダー) のリスト  使い切ったら 200 を返す
+    """
+    def __init__(self, responses=(), delay: float=0.0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.hits = []
+
+    async def handler(self, req):
+        self.hits.append((time.perf_counter(), req.match_info["hash"]))
+        await asyncio.sleep(self.delay)
+        if self.responses:
+            status, headers = self.responses.pop(0)
+            return web.json_response({}, status=status, headers=headers)
+        return web.json_response({"id": 1, "hash": req.match_info["hash"]})
+
+
+def run_with_stub(stub: StubCivitai, monkeypatch, coro_factory):
+    async def run():
+        app = web.Application()
+        app.router.add_get("/api/v1/model-versions/by-hash/{hash}", stub.handler)
+        async with test_utils.TestServer(app) as server:
+            # JUPO_CIVITAI_BASE_URL と同じく, 読み込み済みの設定値を差し替える
+            monkeypatch.setattr(civitai, "BASE_URL", str(server.make_url("")).rstrip("/"))
+            try:
+                return await coro_factory()
+            finally:
+                await civitai.close_session()
+
+    return asyncio.run(run())
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(civitai, "BACKOFF", 0.05)
+    monkeypatch.setattr(civitai, "RETRIES", 3)
+
+
+def test_concurrent_requests_are_coalesced(monkeypatch):
+    stub = StubCivitai(delay=0.2)
+
+    async def fetch_many():
+        return await asyncio.gather(*[civitai.fetch_model_version_by_hash("abc") for _ in range(20)])
+
+    results = run_with_stub(stub, monkeypatch, fetch_many)
+    assert len(stub.hits) == 1
+    assert all(result == (200, {"id": 1, "hash": "abc"}) for result in results)
+
+
+def test_different_hashes_are_not_coalesced(monkeypatch):
+    stub = StubCivitai(delay=0.1)
+
+    async def fetch_many():
+        return await asyncio.gather(*[civitai.fetch_model_version_by_hash(h) for h in ("a", "b", "a", "b")])
+
+    results = run_with_stub(stub, monkeypatch, fetch_many)
+    assert sorted(h for _t, h in stub.hits) == ["a", "b"]
+    assert [result[1]["hash"] for result in results] == ["a", "b", "a", "b"]
+
+
+@pytest.mark.parametrize("status", [429, 500, 502, 503, 504])
+def test_retries_with_backoff(monkeypatch, status):
+    stub = StubCivitai([(status, {}), (status, {})])
+
+    result = run_with_stub(stub, monkeypatch, lambda: civitai.get_json(f"{civitai.BASE_URL}/api/v1/model-versions/by-hash/abc"))
+    assert result == (200, {"id": 1, "hash": "abc"})
+    assert len(stub.hits) == 3
+
+    # 待ち時間は BACKOFF * 2 ** attempt (0.05, 0.1)
+    gaps = [b[0] - a[0] for a, b in zip(stub.hits, stub.hits[1:])]
+    assert gaps[0] >= 0.05
+    assert gaps[1] >= 0.1
+
+
+def test_retry_after_is_respected(monkeypatch):
+    stub = StubCivitai([(429, {"Retry-After": "1"})])
+
+    result = run_with_stub(stub, monkeypatch, lambda: civitai.fetch_model_version_by_hash("abc"))
+    assert result[0] == 200
+    assert stub.hits[1][0] - stub.hits[0][0] >= 1.0
+
+
+def test_gives_up_after_retries(monkeypatch):
+    stub = StubCivitai([(503, {})] * 10)
+
+    result = run_with_stub(stub, monkeypatch, lambda: civitai.fetch_model_version_by_hash("abc"))
+    assert result == (503, {})
+    assert len(stub.hits) == civitai.RETRIES + 1
+
+
+def test_client_errors_are_not_retried(monkeypatch):
+    stub = StubCivitai([(404, {})])
+
+    result = run_with_stub(stub, monkeypatch, lambda: civitai.fetch_model_version_by_hash("abc"))
+    assert result == (404, {})
+    assert len(stub.hits) == 1
@@ -0,0 +1,60 @@
+import asyncio
+import json
+
+import pytest
+
+civitai_sidecar = pytest.importorskip("jupo_lorastack.civitai_sidecar")
+
+
+@pytest.fixture
+def sidecar(tmp_path, monkeypatch):
+    """(モデルのパス, サイドカーのパス, API の応答のリスト)  応答を使い切ったら通信エラー"""
+    model = tmp_path / "model.safetensors"
+    model.write_bytes(b"")
+    responses = []
+
+    async def fetch_model_version_by_hash(file_hash):
+        return responses.pop(0) if responses else (0, {})
+
+    monkeypatch.setattr(civitai_sidecar, "state", civitai_sidecar.SidecarState(str(tmp_path / "state.sqlite3")))
+    monkeypatch.setattr(civitai_sidecar, "get_hash", lambda file_path: "abc")
+    monkeypatch.setattr(civitai_sidecar.civitai, "fetch_model_version_by_hash", fetch_model_version_by_hash)
+    monkeypatch.setattr(civitai_sidecar.search_indexes, "notify_sidecar", lambda file_path: None)
+    return str(model), tmp_path / "model.civitai.json", responses
+
+
+def test_failed_refresh_keeps_data_and_retries_soon(sidecar):
+    model, info_file, responses = sidecar
+    responses.append((200, {"id": 1}))
+    assert asyncio.run(civitai_sidecar.get_info(model)) == ({"id": 1}, "remote")
+
+    # 期限切れの hit を再取得して失敗 (通信エラー)
+    info, source = asyncio.run(civitai_sidecar.get_info(model, refresh=True))
+    assert (info, source) == ({"id": 1}, "remote")
+    assert json.loads(info_file.read_text()) == {"id": 1}
+
+    status, _fetched_at, failures = civitai_sidecar.state.lookup(str(info_file))
+    assert (status, failures) == (civitai_sidecar.STATUS_HIT, 1)
+    # 新しく取得したものとして HIT_TTL 待つのではなく, error と同じ間隔で再試行する
+    assert civitai_sidecar.ttl_for(status, failures) == civitai_sidecar.ttl_for(civitai_sidecar.STATUS_ERROR, 1)
+    assert civitai_sidecar.ttl_for(status, failures) < civitai_sidecar.HIT_TTL
+
+
+def test_corrupt_sidecar_is_a_cache_miss(sidecar):
+    model, info_file, responses = sidecar
+    info_file.write_text('{"id": 1,')
+    responses.append((200, {"id": 2}))
+
+    assert asyncio.run(civitai_sidecar.get_info(model)) == ({"id": 2}, "remote")
+    assert json.loads(info_file.read_text()) == {"id": 2}
+
+
+def test_corrupt_sidecar_with_network_error_waits_for_retry(sidecar):
+    model, info_file, responses = sidecar
+    info_file.write_text("not json")
+
+    assert asyncio.run(civitai_sidecar.get_info(model)) == ({}, "remote")
+    # 通信エラーの記録があるので, 次は再試行の間隔まで API を呼ばない
+    responses.append((200, {"id": 3}))
+    assert asyncio.run(civitai_sidecar.get_info(model)) == ({}, "local")
+    assert responses == [(200, {"id": 3})]
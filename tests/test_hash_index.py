@@ -0,0 +1,43 @@
+import threading
+import time
+
+import pytest
+
+hash_index = pytest.importorskip("jupo_lorastack.hash_index")
+
+
+def test_same_file_is_never_hashed_concurrently(tmp_path, monkeypatch):
+    model = tmp_path / "model.safetensors"
+    model.write_bytes(b"\0" * 1024)
+    index = hash_index.HashIndex(str(tmp_path / "hash_index.sqlite3"))
+    # 計算中にファイルが変わり続ける場合 (登録されないので待っていたスレッドも計算する)
+    monkeypatch.setattr(index, "_store", lambda identity, hashes: None)
+
+    running = 0
+    max_running = 0
+    counter_lock = threading.Lock()
+
+    def slow_compute(file_path, wait_if_paused=None):
+        nonlocal running, max_running
+        with counter_lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.05)
+        with counter_lock:
+            running -= 1
+        return {"sha256": "0" * 64, "blake3": None}
+
+    monkeypatch.setattr(hash_index, "compute_hashes", slow_compute)
+
+    threads = []
+    for _ in range(6):
+        thread = threading.Thread(target=index.get, args=(str(model),))
+        thread.start()
+        threads.append(thread)
+        # 前の計算が終わって待機中のスレッドが動き出す頃に次が来る
+        time.sleep(0.03)
+    for thread in threads:
+        thread.join()
+
+    assert max_running == 1
+    assert index.path_locks == {}
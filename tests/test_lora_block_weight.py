@@ -0,0 +1,179 @@
+import time
+
+import pytest
+
+lora_block_weight = pytest.importorskip("jupo_lorastack.lora_block_weight")
+comfy_hooks = pytest.importorskip("comfy.hooks")
+LBWLoRALoader = lora_block_weight.LBWLoRALoader
+LBWWeightHook = lora_block_weight.LBWWeightHook
+HookGroupBuilder = lora_block_weight.HookGroupBuilder
+group_by_multiplier = lora_block_weight.group_by_multiplier
+
+
+class CountingPatcher:
+    """add_patches の呼び出し回数と結果だけを記録する ModelPatcher の代わり
+
+    ComfyUI の add_patches は呼び出しごとに state dict のキー集合を作り直すので, それも真似る
+    """
+    def __init__(self, state_dict_keys: list):
+        self.state_dict_keys = state_dict_keys
+        self.calls = 0
+        self.patches: dict[str, list] = {}
+
+    def add_patches(self, patches: dict, strength_patch: float=1.0, strength_model: float=1.0):
+        self.calls += 1
+        model_sd = set(self.state_dict_keys)
+        for key, patch in patches.items():
+            if key in model_sd:
+                self.patches.setdefault(key, []).append((strength_patch, patch))
+        return list(patches)
+
+
+def synthetic_lora(blocks: int=57, keys_per_block: int=12):
+    loaded = {}
+    mapped = {}
+    for block in range(blocks):
+        for i in range(keys_per_block):
+            key = f"diffusion_model.blocks.{block}.layer{i}.weight"
+            loaded[key] = ("lora", (key, ))
+            # ブロックごとに 0 / 0.5 / 1 の3種類の倍率
+            mapped[key] = (0.0, 0.5, 1.0)[block % 3]
+    return loaded, mapped
+
+
+def load_per_key(model: CountingPatcher, loaded: dict, mapped: dict, strength: float):
+    """以前の load_lora (キーごとに add_patches を呼ぶ)"""
+    for key, value in loaded.items():
+        model.add_patches({key: value}, strength * mapped.get(key, 1))
+
+
+def load_grouped(model: CountingPatcher, loaded: dict, mapped: dict, strength: float, monkeypatch):
+    monkeypatch.setattr(LBWLoRALoader, "create_lbw_info", lambda self, *args: (loaded, mapped, {}))
+    LBWLoRALoader().load_lora(model, None, "synthetic.safetensors", strength, strength, {})
+
+
+def effective(model: CountingPatcher) -> dict:
+    """キーごとの (強度, パッチ) のうち強度が 0 でないもの"""
+    return {
+        key: [(strength, patch) for strength, patch in entries if strength != 0]
+        for key, entries in model.patches.items()
+        if any(strength != 0 for strength, _patch in entries)
+    }
+
+
+def test_group_by_multiplier():
+    loaded, mapped = synthetic_lora(blocks=6, keys_per_block=2)
+    groups = group_by_multiplier(loaded, mapped)
+    assert sorted(multiplier for multiplier, _patches in groups) == [0.0, 0.5, 1.0]
+    assert sum(len(patches) for _multiplier, patches in groups) == len(loaded)
+    assert group_by_multiplier(loaded, {}) == [(1, loaded)]
+
+
+def test_one_call_per_multiplier(monkeypatch):
+    loaded, mapped = synthetic_lora()
+    before = CountingPatcher(list(loaded))
+    after = CountingPatcher(list(loaded))
+
+    load_per_key(before, loaded, mapped, 0.8)
+    load_grouped(after, loaded, mapped, 0.8, monkeypatch)
+
+    assert before.calls == len(loaded)
+    # 倍率 0 のグループは登録しない
+    assert after.calls == 2
+    assert effective(after) == effective(before)
+
+
+def test_without_lbw_is_a_single_call(monkeypatch):
+    loaded, _mapped = synthetic_lora()
+    model = CountingPatcher(list(loaded))
+    load_grouped(model, loaded, {}, 1.0, monkeypatch)
+    assert model.calls == 1
+    assert len(model.patches) == len(loaded)
+
+
+def test_benchmark_patcher_calls(monkeypatch):
+    loaded, mapped = synthetic_lora(blocks=300, keys_per_block=12)
+    state_dict_keys = list(loaded)
+
+    before = CountingPatcher(state_dict_keys)
+    start = time.perf_counter()
+    load_per_key(before, loaded, mapped, 1.0)
+    before_time = time.perf_counter() - start
+
+    after = CountingPatcher(state_dict_keys)
+    start = time.perf_counter()
+    load_grouped(after, loaded, mapped, 1.0, monkeypatch)
+    after_time = time.perf_counter() - start
+
+    # 時間は環境によって変わるので表示だけする (pytest -s)  検証するのは呼び出し回数
+    print(f"\nadd_patches ({len(loaded)} keys): per key {before.calls} calls / {before_time * 1000:.1f}ms, "
+          f"grouped {after.calls} calls / {after_time * 1000:.1f}ms")
+    assert before.calls == len(loaded)
+    assert after.calls == 2
+    assert effective(after) == effective(before)
+
+
+def scheduled_hooks(count: int):
+    """count 個の LoRA の (Hook, スケジュール)  スケジュールは4種類"""
+    loaded, mapped = synthetic_lora(blocks=4, keys_per_block=4)
+    return [(LBWWeightHook(1.0, 1.0, loaded, mapped), (0.0, (i % 4 + 1) / 5)) for i in range(count)]
+
+
+def build_chained(hooks: list):
+    """以前の load_lora_with_hook (LoRA ごとに clone_and_combine する)"""
+    loader = LBWLoRALoader()
+    prev_hooks = comfy_hooks.HookGroup()
+    for hook, (start, end) in hooks:
+        hooks_lbw = comfy_hooks.HookGroup()
+        hooks_lbw.add(hook)
+        hooks_lbw.set_keyframes_on_hooks(hook_kf=loader.create_schedule_hook(start, end))
+        prev_hooks = prev_hooks.clone_and_combine(hooks_lbw)
+    return prev_hooks
+
+
+def build_with_builder(hooks: list):
+    """apply_stack と同じく, 同じスケジュールのキーフレームグループを共有して最後に1回だけ組み立てる"""
+    loader = LBWLoRALoader()
+    builder = HookGroupBuilder()
+    keyframes = {}
+    for hook, schedule in hooks:
+        if schedule not in keyframes:
+            keyframes[schedule] = loader.create_schedule_hook(*schedule)
+        builder.add(hook, keyframes[schedule])
+    return builder.build()
+
+
+@pytest.mark.parametrize("count", [20, 50])
+def test_benchmark_hook_group_builder(monkeypatch, count):
+    clones = 0
+    original_clone = LBWWeightHook.clone
+
+    def counting_clone(self):
+        nonlocal clones
+        clones += 1
+        return original_clone(self)
+
+    monkeypatch.setattr(LBWWeightHook, "clone", counting_clone)
+
+    start = time.perf_counter()
+    chained = build_chained(scheduled_hooks(count))
+    chained_time = time.perf_counter() - start
+    chained_clones, clones = clones, 0
+
+    hooks = scheduled_hooks(count)
+    start = time.perf_counter()
+    built = build_with_builder(hooks)
+    built_time = time.perf_counter() - start
+    built_clones = clones
+
+    # 時間は表示だけする (pytest -s)  検証するのは clone の回数と Hook の数
+    print(f"\nHookGroup ({count} LoRAs): clone_and_combine {chained_clones} clones / {chained_time * 1000:.1f}ms, "
+          f"builder {built_clones} clones / {built_time * 1000:.1f}ms")
+    assert len(built.hooks) == len(chained.hooks) == count
+    # 以前は LoRA を足すたびにそれまでの Hook を clone していた (2乗のコスト)
+    assert chained_clones >= count * (count - 1) // 2
+    assert built_clones == 0
+    # キーフレームグループはスケジュールの種類数だけ
+    assert len({id(hook.hook_keyframe) for hook in built.hooks}) == 4
+    # 組み立てた Hook は clone ではなく作ったものそのもの
+    assert all(any(hook is created for created, _schedule in hooks) for hook in built.hooks)
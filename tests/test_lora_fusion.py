@@ -0,0 +1,172 @@
+import subprocess
+import time
+import sys
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+lora_fusion = pytest.importorskip("jupo_lorastack.lora_fusion")
+fuse_patches = lora_fusion.fuse_patches
+
+
+def lora_patch(out_features: int, in_features: int, rank: int, alpha: float=None, generator=None):
+    up = torch.randn(out_features, rank, generator=generator)
+    down = torch.randn(rank, in_features, generator=generator)
+    return ("lora", (up, down, alpha, None, None, None))
+
+
+def synthetic_stack(count: int, keys: int, size: int, rank: int, seed: int=0):
+    """add_patches に渡す [(強度, {キー: パッチ})] を count 個の LoRA 分作る"""
+    generator = torch.Generator().manual_seed(seed)
+    groups = []
+    for i in range(count):
+        patches = {f"blocks.{k}.weight": lora_patch(size, size, rank, float(rank // 2), generator) for k in range(keys)}
+        groups.append((0.5 + i * 0.1, patches))
+    return groups
+
+
+def delta(groups: list) -> dict:
+    """ComfyUI と同じく, パッチごとに strength * alpha / rank * (up @ down) を足し込む"""
+    result = {}
+    for strength, patches in groups:
+        for key, (_name, (up, down, alpha, *_rest)) in patches.items():
+            scale = strength * (alpha / down.shape[0] if alpha is not None else 1.0)
+            result[key] = result.get(key, 0) + scale * (up @ down)
+    return result
+
+
+def test_fused_delta_matches_separate_patches():
+    groups = synthetic_stack(count=3, keys=4, size=32, rank=4)
+    fused = fuse_patches(groups, targets={f"blocks.{k}.weight" for k in range(4)})
+
+    assert len(fused) == 1 and fused[0][0] == 1.0
+    expected = delta(groups)
+    actual = delta(fused)
+    for key in expected:
+        torch.testing.assert_close(actual[key], expected[key], rtol=1e-4, atol=1e-4)
+    # 連結後のランクは元のランクの合計
+    assert fused[0][1]["blocks.0.weight"][1][0].shape == (32, 12)
+
+
+def test_unfusable_patches_keep_their_strength():
+    generator = torch.Generator().manual_seed(0)
+    dora = ("lora", (torch.randn(8, 2, generator=generator), torch.randn(2, 8, generator=generator), None, None, torch.ones(8), None))
+    groups = [
+        (0.5, {"a.weight": lora_patch(8, 8, 2, generator=generator), "b.weight": dora}),
+        (0.7, {"a.weight": lora_patch(8, 8, 2, generator=generator), "b.weight": lora_patch(8, 8, 2, generator=generator)}),
+        (0.0, {"a.weight": lora_patch(8, 8, 2, generator=generator)}),
+    ]
+    fused = fuse_patches(groups, targets={"a.weight", "b.weight"})
+
+    assert set(fused[0][1]) == {"a.weight"}
+    assert [(strength, set(patches)) for strength, patches in fused[1:]] == [(0.5, {"b.weight"}), (0.7, {"b.weight"})]
+
+
+def test_keys_outside_targets_are_dropped():
+    groups = synthetic_stack(count=2, keys=2, size=8, rank=2)
+    fused = fuse_patches(groups, targets={"blocks.0.weight"})
+    assert [set(patches) for _strength, patches in fused] == [{"blocks.0.weight"}]
+
+
+def best_of(func, repeat: int=5) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+BENCH_SIZE = {"count": 20, "keys": 32, "size": 512, "rank": 8}
+
+
+def apply_patches(weight, groups):
+    """ComfyUI の calculate_weight と同じく, パッチごとに行列積を1回ずつ行う"""
+    for strength, patches in groups:
+        for _key, (_name, (up, down, alpha, *_rest)) in patches.items():
+            scale = strength * (alpha / down.shape[0] if alpha is not None else 1.0)
+            weight.addmm_(up.to(weight.device), down.to(weight.device), alpha=scale)
+
+
+def run_stage(stage: str, device: str="cpu"):
+    """ベンチマークの1段階 (separate: そのまま適用 / fused: 連結して適用)"""
+    groups = synthetic_stack(**BENCH_SIZE)
+    targets = {f"blocks.{k}.weight" for k in range(BENCH_SIZE["keys"])}
+    if device != "cpu":
+        groups = [(strength, {key: ("lora", (up.to(device), down.to(device), *rest)) for key, (_name, (up, down, *rest)) in patches.items()})
+                  for strength, patches in groups]
+    weight = torch.zeros(BENCH_SIZE["size"], BENCH_SIZE["size"], device=device)
+
+    def run():
+        apply_patches(weight, fuse_patches(groups, targets) if stage == "fused" else groups)
+    return groups, run
+
+
+# CPU のテンソルは tracemalloc では追えないので, 新しいプロセスで RSS のピーク (VmHWM) を測る
+# 準備が終わった時点でピークをリセットし (/proc/self/clear_refs), その後の増分を見る  Linux のみ
+PEAK_RSS_SCRIPT = """
+import gc, sys
+sys.path.insert(0, sys.argv[1])
+import conftest  # noqa: F401  (jupo_lorastack パッケージの登録)
+import test_lora_fusion as bench
+
+def status(name):
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith(name + ":"):
+                return int(line.split()[1]) * 1024
+
+_groups, run = bench.run_stage(sys.argv[2])
+gc.collect()
+with open("/proc/self/clear_refs", "w") as file:
+    file.write("5")
+before = status("VmRSS")
+run()
+print(status("VmHWM") - before)
+"""
+
+
+def peak_memory(stage: str, device: str) -> int | None:
+    """stage の実行中に増えたメモリの最大値 (バイト)  測れなければ None"""
+    if device == "cuda":
+        _groups, run = run_stage(stage, device)
+        torch.cuda.synchronize()
+        baseline = torch.cuda.memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+        run()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - baseline
+
+    if not os.path.exists("/proc/self/clear_refs"):
+        return None
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-c", PEAK_RSS_SCRIPT, tests_dir, stage],
+        capture_output=True, text=True, timeout=300,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+    )
+    if result.returncode != 0:
+        return None
+    return int(result.stdout.strip().splitlines()[-1])
+
+
+def test_benchmark_fusion():
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    separate, run_separate = run_stage("separate", device)
+    _fused_groups, run_fused = run_stage("fused", device)
+
+    separate_time = best_of(run_separate)
+    fused_time = best_of(run_fused)
+    separate_peak = peak_memory("separate", device)
+    fused_peak = peak_memory("fused", device)
+
+    def megabytes(nbytes):
+        return "n/a" if nbytes is None else f"{nbytes / 1024 / 1024:.1f}MB"
+
+    patch_bytes = sum(w.nelement() * w.element_size() for _s, patches in separate for _n, (up, down, *_r) in patches.values() for w in (up, down))
+    # 時間とメモリは環境によって変わるので表示だけする (pytest -s)
+    print(f"\nfusion on {device} ({BENCH_SIZE}): "
+          f"separate {separate_time * 1000:.1f}ms / peak +{megabytes(separate_peak)}, "
+          f"fuse + apply {fused_time * 1000:.1f}ms / peak +{megabytes(fused_peak)} "
+          f"(patches {megabytes(patch_bytes)})")
@@ -0,0 +1,122 @@
+import tracemalloc
+
+import pytest
+
+media_tokens = pytest.importorskip("jupo_lorastack.media_tokens")
+MediaTokenStore = media_tokens.MediaTokenStore
+
+
+class FakeClock:
+    def __init__(self, now: float=1_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def browse(store: MediaTokenStore, clock: FakeClock, seconds: int, files: int, start: int=0):
+    """1秒ごとに1枚ずつ, files 枚のプレビューを順に表示し続ける"""
+    tokens = {}
+    for i in range(start, start + seconds):
+        clock.now += 1
+        path = f"/loras/preview_{i % files}.png"
+        tokens[path] = store.issue(path, "loras", mtime_ns=i % files)
+        assert len(store) <= store.max_size
+    return tokens
+
+
+def test_same_file_gets_same_token():
+    store = MediaTokenStore(clock=FakeClock(), secret=b"s" * 16)
+    assert store.issue("/a.png", "loras", 1) == store.issue("/a.png", "loras", 1)
+    assert store.issue("/a.png", "loras", 1) != store.issue("/a.png", "loras", 2)
+    assert len(store) == 2
+
+
+def test_tokens_expire():
+    clock = FakeClock()
+    store = MediaTokenStore(expire_time=3600, clock=clock, secret=b"s" * 16)
+    token = store.issue("/a.png", "loras", 1)
+    clock.now += 3599
+    assert store.get(token)["path"] == "/a.png"
+    clock.now += 2
+    assert store.get(token) is None
+    assert len(store) == 0
+
+
+def test_hours_of_browsing_stay_bounded():
+    # 6時間, 毎秒新しいファイルを表示 (上限より多い種類のファイル)
+    clock = FakeClock()
+    store = MediaTokenStore(max_size=1000, expire_time=3600, clock=clock, secret=b"s" * 16)
+    browse(store, clock, seconds=6 * 3600, files=50_000)
+
+    assert len(store) == 1000
+    # 残っているのは直近に発行したものだけ
+    oldest = next(iter(store.entries.values()))
+    assert clock.now - oldest["created_at"] < 1000
+
+
+def test_expired_tokens_are_removed_without_lookups():
+    # 上限に届かない閲覧でも, 期限切れは発行のついでに消える
+    clock = FakeClock()
+    store = MediaTokenStore(max_size=100_000, expire_time=3600, clock=clock, secret=b"s" * 16)
+    browse(store, clock, seconds=5 * 3600, files=100_000)
+
+    limit = store.expire_time + media_tokens.CLEANUP_INTERVAL
+    assert all(clock.now - entry["created_at"] <= limit for entry in store.entries.values())
+    assert len(store) <= limit
+
+
+def test_memory_reaches_steady_state():
+    clock = FakeClock()
+    store = MediaTokenStore(max_size=100_000, expire_time=3600, clock=clock, secret=b"s" * 16)
+
+    tracemalloc.start()
+    try:
+        browse(store, clock, seconds=2 * 3600, files=1_000_000)
+        after_two_hours = tracemalloc.get_traced_memory()[0]
+        browse(store, clock, seconds=6 * 3600, files=1_000_000, start=2 * 3600)
+        after_eight_hours = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    # 期限より長く閲覧しても, 保持するトークン数 (= メモリ) は増え続けない
+    assert after_eight_hours < after_two_hours * 1.2
+
+
+@pytest.fixture
+def media_url(tmp_path, endpoint_routes):
+    import jupo_lorastack.endpoints as endpoints
+
+    source = tmp_path / "preview.mp4"
+    source.write_bytes(bytes(range(256)) * 16)
+    token = endpoints.media_tokens.issue(str(source), "video")
+    return f"/jupo/LoRAStack/media/{token}"
+
+
+def test_media_range_request(run_app, media_url):
+    async def requests(client):
+        resp = await client.get(media_url, headers={"Range": "bytes=100-199"})
+        return resp, await resp.read()
+
+    resp, body = run_app(requests)
+    assert resp.status == 206
+    assert resp.headers["Content-Range"] == "bytes 100-199/4096"
+    assert resp.headers["Accept-Ranges"] == "bytes"
+    assert body == bytes(range(100, 200))
+
+
+def test_media_if_none_match(run_app, media_url):
+    async def requests(client):
+        first = await client.get(media_url)
+        await first.read()
+        revalidated = await client.get(media_url, headers={"If-None-Match": first.headers["ETag"]})
+        other = await client.get(media_url, headers={"If-None-Match": '"other"'})
+        await other.read()
+        return first, revalidated, other
+
+    first, revalidated, other = run_app(requests)
+    assert first.status == 200
+    assert "immutable" in first.headers["Cache-Control"]
+    assert revalidated.status == 304
+    assert revalidated.headers["ETag"] == first.headers["ETag"]
+    assert other.status == 200
@@ -0,0 +1,45 @@
+import pytest
+
+model_list_module = pytest.importorskip("jupo_lorastack.model_list")
+
+
+@pytest.fixture
+def resolver(tmp_path, monkeypatch):
+    folder_paths = model_list_module.folder_paths
+    root = tmp_path / "loras"
+    root.mkdir()
+    (root / "old.safetensors").write_bytes(b"")
+
+    def get_filename_list(directory):
+        return sorted(path.name for path in root.iterdir())
+
+    def get_full_path(directory, name):
+        path = root / name
+        return str(path) if path.is_file() else None
+
+    monkeypatch.setattr(folder_paths, "get_filename_list", get_filename_list, raising=False)
+    monkeypatch.setattr(folder_paths, "get_full_path", get_full_path, raising=False)
+    # 監視中で, 通知がまだ届いていない状態
+    monkeypatch.setattr(model_list_module.watcher, "is_watching", lambda directory: True)
+    monkeypatch.setattr(model_list_module.watcher, "check_roots", lambda directory: False)
+
+    model_list = model_list_module.ModelList()
+    return model_list, model_list_module.NameResolver(model_list), root
+
+
+def test_file_added_before_notification_is_resolved(resolver):
+    model_list, name_resolver, root = resolver
+    assert name_resolver.resolve("loras", "old.safetensors") == str(root / "old.safetensors")
+
+    (root / "new.safetensors").write_bytes(b"")
+    assert "new.safetensors" not in model_list.get("loras")[1]
+
+    assert name_resolver.resolve("loras", "new.safetensors") == str(root / "new.safetensors")
+    # 見つかったので一覧も取り直される
+    assert "new.safetensors" in model_list.get("loras")[1]
+
+
+def test_missing_file_is_still_missing(resolver):
+    model_list, name_resolver, _root = resolver
+    assert name_resolver.resolve("loras", "missing.safetensors") is None
+    assert "loras" not in model_list.dirty
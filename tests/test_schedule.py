@@ -0,0 +1,47 @@
+import pytest
+
+schedule = pytest.importorskip("jupo_lorastack.schedule")
+normalize_schedule = schedule.normalize_schedule
+
+
+@pytest.fixture
+def step(monkeypatch):
+    monkeypatch.setattr(schedule, "SCHEDULE_STEP", 0.1)
+
+
+def test_without_step_only_float_error_is_rounded():
+    assert normalize_schedule(0.1 + 0.2, 0.7000000001) == (0.3, 0.7)
+    assert normalize_schedule(-0.5, 1.5) == (0.0, 1.0)
+
+
+def test_near_boundaries_are_merged(step):
+    assert normalize_schedule(0.31, 0.69) == (0.3, 0.7)
+    assert normalize_schedule(0.29, 0.71) == (0.3, 0.7)
+    assert normalize_schedule(0.0, 1.0) == (0.0, 1.0)
+
+
+def test_start_is_not_rounded_to_zero(step):
+    start, end = normalize_schedule(0.02, 0.5)
+    assert start > 0
+    assert (start, end) == (0.02, 0.5)
+
+
+def test_end_is_not_rounded_to_one(step):
+    start, end = normalize_schedule(0.5, 0.97)
+    assert end < 1
+    assert (start, end) == (0.5, 0.97)
+
+
+def test_interval_is_not_collapsed(step):
+    # 0.42 と 0.38 はどちらも 0.4 になる
+    start, end = normalize_schedule(0.38, 0.42)
+    assert start < end
+    assert (start, end) == (0.38, 0.42)
+
+    start, end = normalize_schedule(0.01, 0.04)
+    assert 0 < start < end
+
+
+def test_empty_interval_stays_empty(step):
+    start, end = normalize_schedule(0.6, 0.4)
+    assert start >= end
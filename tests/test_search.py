@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import pytest
+
+search_index = pytest.importorskip("jupo_lorastack.search_index")
+
+
+@pytest.fixture
+def loras(tmp_path, monkeypatch, endpoint_routes):
+    import jupo_lorastack.endpoints as endpoints
+
+    folder_paths = search_index.folder_paths
+    root = tmp_path / "loras"
+    root.mkdir()
+    for i in range(20):
+        (root / f"style_{i:02}.ckpt").write_bytes(b"")
+    (root / "style_00.civitai.json").write_text(json.dumps({"trainedWords": ["watercolor"], "model": {"name": "Soft Paint"}}))
+
+    def get_filename_list(directory):
+        return sorted(path.name for path in root.iterdir() if path.suffix == ".ckpt")
+
+    def get_full_path(directory, name):
+        path = root / name
+        return str(path) if path.is_file() else None
+
+    monkeypatch.setattr(folder_paths, "folder_names_and_paths", {"loras": ([str(root)], {".ckpt"})}, raising=False)
+    monkeypatch.setattr(folder_paths, "get_filename_list", get_filename_list, raising=False)
+    monkeypatch.setattr(folder_paths, "get_full_path", get_full_path, raising=False)
+    monkeypatch.setattr(endpoints, "search_indexes", search_index.SearchIndexes())
+    return root
+
+
+def test_search_by_name_and_sidecar(run_app, loras):
+    async def requests(client):
+        by_name = await client.get("/jupo/LoRAStack/search/loras", params={"q": "style 01"})
+        by_trigger = await client.get("/jupo/LoRAStack/search/loras", params={"q": "water"})
+        return await by_name.json(), await by_trigger.json()
+
+    by_name, by_trigger = run_app(requests)
+    assert by_name["results"][0]["file"] == "style_01.ckpt"
+    assert [result["file"] for result in by_trigger["results"]] == ["style_00.ckpt"]
+    assert by_trigger["results"][0]["name"] == "Soft Paint"
+
+
+def test_unknown_directory_is_not_found(run_app, loras):
+    async def requests(client):
+        resp = await client.get("/jupo/LoRAStack/search/unknown", params={"q": "style"})
+        return resp.status, await resp.json()
+
+    status, body = run_app(requests)
+    assert status == 404
+    assert body["status"] == "error"
+
+
+def test_concurrent_first_searches_build_once(run_app, loras, monkeypatch):
+    built = []
+    build_document = search_index.build_document
+
+    def counting_build_document(name, full_path):
+        built.append(name)
+        return build_document(name, full_path)
+
+    monkeypatch.setattr(search_index, "build_document", counting_build_document)
+
+    async def requests(client):
+        responses = await asyncio.gather(*(client.get("/jupo/LoRAStack/search/loras", params={"q": "style"}) for _ in range(8)))
+        return [(resp.status, (await resp.json())["total"]) for resp in responses]
+
+    assert run_app(requests) == [(200, 20)] * 8
+    # 同時に来た最初の検索はインデックスの構築を共有する
+    assert sorted(built) == sorted(path.name for path in loras.iterdir() if path.suffix == ".ckpt")
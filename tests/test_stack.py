@@ -0,0 +1,67 @@
+import copy
+import json
+import pickle
+
+import pytest
+
+stack_module = pytest.importorskip("jupo_lorastack.stack")
+LoRAStack = stack_module.LoRAStack
+
+
+def entries(*names):
+    return [{"lora": name, "strength_model": 0.8, "enabled": True, "custom": {"note": name}} for name in names]
+
+
+def test_node_output_is_a_plain_list():
+    stack = LoRAStack.from_value(entries("a.safetensors")).chain(entries("b.safetensors"))
+    output = stack.to_list()
+
+    # 他のカスタムノードは従来どおり dict のリストとして扱える
+    assert isinstance(output, list)
+    data = json.loads(json.dumps(output))
+    assert [item["lora"] for item in data] == ["a.safetensors", "b.safetensors"]
+    assert data[1]["custom"] == {"note": "b.safetensors"}
+
+
+def test_node_output_keeps_the_shared_stack():
+    stack = LoRAStack.from_value(entries("a.safetensors", "b.safetensors"))
+    output = stack.to_list()
+    assert LoRAStack.from_value(output) is stack
+    assert LoRAStack.from_value(pickle.loads(pickle.dumps(output))) == stack
+    assert LoRAStack.from_value(copy.deepcopy(output)) == stack
+
+
+def test_node_output_modified_in_place_is_rebuilt():
+    stack = LoRAStack.from_value(entries("a.safetensors"))
+    output = stack.to_list()
+    output.append(entries("c.safetensors")[0])
+
+    rebuilt = LoRAStack.from_value(output)
+    assert [entry.lora for entry in rebuilt] == ["a.safetensors", "c.safetensors"]
+
+
+def test_stack_node_returns_json_serializable_stack(endpoint_routes):
+    # lora_stack は読み込み時にルートを登録するので, endpoint_routes で PromptServer を用意しておく
+    lora_stack = pytest.importorskip("jupo_lorastack.lora_stack")
+    node = lora_stack.JupoLoRAStack()
+    first, _trigger = node.execute(lora_list=json.dumps(entries("a.safetensors")))
+    second, _trigger = node.execute(prev_stack=first, lora_list=json.dumps(entries("b.safetensors")))
+
+    assert isinstance(second, list)
+    assert [item["lora"] for item in json.loads(json.dumps(second))] == ["a.safetensors", "b.safetensors"]
+    # 前段のスタックは作り直さずに親として共有する
+    assert LoRAStack.from_value(second).parent is LoRAStack.from_value(first)
+
+
+def test_disabled_applied_cache_skips_digest(endpoint_routes, monkeypatch):
+    lora_stack = pytest.importorskip("jupo_lorastack.lora_stack")
+    monkeypatch.setattr(lora_stack.applied_cache, "max_size", 0)
+    monkeypatch.setattr(lora_stack, "get_available_loras", lambda stack: [])
+    monkeypatch.setattr(lora_stack, "_apply_stack", lambda available_loras, model, clip: (model, clip))
+
+    def applied_digest(available_loras):
+        raise AssertionError("applied_digest should not be computed")
+
+    monkeypatch.setattr(lora_stack, "applied_digest", applied_digest)
+    model, clip = object(), object()
+    assert lora_stack.apply_stack(entries("a.safetensors"), model, clip) == (model, clip)
@@ -0,0 +1,42 @@
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+thumbnails = pytest.importorskip("jupo_lorastack.thumbnails")
+
+
+@pytest.fixture
+def thumbnail_url(tmp_path, monkeypatch, endpoint_routes):
+    import jupo_lorastack.endpoints as endpoints
+
+    monkeypatch.setattr(endpoints, "thumbnail_cache", thumbnails.ThumbnailCache(str(tmp_path / "thumbnails")))
+    source = tmp_path / "preview.png"
+    Image.new("RGB", (640, 480), (200, 100, 50)).save(source)
+    token = endpoints.media_tokens.issue(str(source), "image")
+    return f"/jupo/LoRAStack/thumbnail/{token}?size=128"
+
+
+def test_cached_thumbnail_keeps_its_etag(run_app, thumbnail_url):
+    async def requests(client):
+        first = await client.get(thumbnail_url)
+        body = await first.read()
+        second = await client.get(thumbnail_url)
+        revalidated = await client.get(thumbnail_url, headers={"If-None-Match": first.headers["ETag"]})
+        return first, body, second, revalidated
+
+    first, body, second, revalidated = run_app(requests)
+    assert first.status == 200
+    assert first.headers["Content-Type"] == "image/webp"
+    assert body[:4] == b"RIFF"
+    # キャッシュから返しても ETag は変わらない
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert revalidated.status == 304
+
+
+def test_cache_hits_do_not_touch_mtime(tmp_path):
+    Image.new("RGB", (64, 64)).save(tmp_path / "a.png")
+    cache = thumbnails.ThumbnailCache(str(tmp_path / "thumbnails"))
+    path = cache.get(str(tmp_path / "a.png"), "image", 1, 64)
+    mtime = (tmp_path / "thumbnails").joinpath(path).stat().st_mtime_ns
+    assert cache.get(str(tmp_path / "a.png"), "image", 1, 64) == path
+    assert (tmp_path / "thumbnails").joinpath(path).stat().st_mtime_ns == mtime
+    assert path in cache.accessed
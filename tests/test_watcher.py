@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+watcher_module = pytest.importorskip("jupo_lorastack.watcher")
+ModelWatcher = watcher_module.ModelWatcher
+
+
+@pytest.fixture
+def polling_watcher(tmp_path, monkeypatch):
+    root = tmp_path / "loras"
+    (root / "sub").mkdir(parents=True)
+    watcher = ModelWatcher(["loras"])
+    monkeypatch.setattr(watcher, "_roots", lambda folder_name: [str(root)])
+    events = []
+    watcher.subscribe(lambda folder_name, directory: events.append((folder_name, directory)))
+    watcher.active = True
+    watcher.polling = True
+    return watcher, root, events
+
+
+def baseline(watcher):
+    for root in watcher._roots("loras"):
+        watcher._scan_tree("loras", root)
+    watcher._mark_ready(["loras"])
+
+
+def test_not_watching_until_baseline(polling_watcher):
+    watcher, root, events = polling_watcher
+    assert not watcher.is_watching("loras")
+    baseline(watcher)
+    assert watcher.is_watching("loras")
+    # 基準より前に取得された一覧を破棄させる
+    assert events == [("loras", str(root))]
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink"), reason="symlinks are not supported")
+def test_symlink_cycles_are_not_followed(polling_watcher):
+    watcher, root, _events = polling_watcher
+    try:
+        os.symlink(str(root), str(root / "sub" / "loop"))
+    except OSError:
+        pytest.skip("cannot create symlinks")
+    baseline(watcher)
+    assert sorted(watcher.dir_mtimes) == sorted([str(root), str(root / "sub")])
+
+
+def test_check_roots_detects_new_files(polling_watcher):
+    watcher, root, events = polling_watcher
+    baseline(watcher)
+    events.clear()
+
+    assert not watcher.check_roots("loras")
+    (root / "new.safetensors").write_bytes(b"")
+    os.utime(root, ns=(0, watcher.dir_mtimes[str(root)] + 1))
+    assert watcher.check_roots("loras")
+    assert ("loras", str(root)) in events
@@ -0,0 +1,16 @@
+import subprocess
+import shutil
+import os
+
+import pytest
+
+
+# web/ の ComfyUI に依存しないモジュールは node の組み込みテストランナーで検証する
+JS_TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "js")
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="node is not installed")
+def test_web_modules():
+    tests = sorted(os.path.join(JS_TESTS, name) for name in os.listdir(JS_TESTS) if name.endswith(".test.mjs"))
+    result = subprocess.run(["node", "--test", *tests], capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stdout + result.stderr
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+test_utils = pytest.importorskip("aiohttp.test_utils")
+hash_index = pytest.importorskip("jupo_lorastack.hash_index")
+workers = pytest.importorskip("jupo_lorastack.workers")
+
+FILE_SIZE = 64 * 1024 * 1024
+TICK = 0.005
+
+
+@pytest.fixture
+def large_file(tmp_path):
+    path = tmp_path / "large.safetensors"
+    chunk = bytes(range(256)) * (4 * 1024)
+    with open(path, "wb") as file:
+        for _ in range(FILE_SIZE // len(chunk)):
+            file.write(chunk)
+    return str(path)
+
+
+async def count_ticks(until) -> int:
+    """until() が真になるまでイベントループが TICK ごとに回った回数"""
+    ticks = 0
+    while not until():
+        await asyncio.sleep(TICK)
+        ticks += 1
+    return ticks
+
+
+def test_hashing_does_not_block_other_handlers(tmp_path, large_file):
+    index = hash_index.HashIndex(str(tmp_path / "hash_index.sqlite3"))
+
+    async def hash_handler(req):
+        # civitai_sidecar と同じくワーカープールで計算する
+        hashes = await workers.run_hash_job(index.get, large_file)
+        return web.json_response(hashes)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/hash", hash_handler)
+
+        async with test_utils.TestClient(test_utils.TestServer(app)) as client:
+            # 基準: 何もしていないときのティックの間隔
+            start = time.perf_counter()
+            deadline = start + 0.1
+            idle_ticks = await count_ticks(lambda: time.perf_counter() >= deadline)
+            idle_period = (time.perf_counter() - start) / idle_ticks
+
+            start = time.perf_counter()
+            hash_task = asyncio.ensure_future(client.get("/hash"))
+            busy_ticks = await count_ticks(hash_task.done)
+            duration = time.perf_counter() - start
+
+            resp = await hash_task
+            assert resp.status == 200
+            assert (await resp.json())["sha256"]
+            return busy_ticks, duration / idle_period
+
+    busy_ticks, expected_ticks = asyncio.run(run())
+    # ハッシュ計算中もイベントループが回り続ける (ループ上で計算すると 0〜1 回になる)
+    assert busy_ticks >= 2
+    assert busy_ticks >= expected_ticks * 0.25, (busy_ticks, expected_ticks)
@@ -1,9 +1,12 @@
 import { $el } from "../../../../scripts/ui.js";
-import { mk_endpoint, api_get, loadCSS } from "../../utils.js";
+import { mk_endpoint, api_post, loadCSS } from "../../utils.js";
 import { ViewModeManager } from "./view_mode_manager.js";
+import { PreviewBatcher } from "./preview_batcher.js";
 
 loadCSS("dialogs/explorer/css/file_render.css");
 
+const previewBatcher = new PreviewBatcher(paths => api_post("previews", { paths }));
+
 // ==============================================
 // ファイル表示を管理するクラス
 // ==============================================
@@ -133,29 +136,45 @@ export class FileRenderManager {
     // ------------------------------------------
     async loadPreview(filePath, itemElement) {
         try {
-            const mediaData = await api_get("preview/" + encodeURIComponent(`${this.parent.apiDir}/${filePath}`));
+            const mediaData = await previewBatcher.request(`${this.parent.apiDir}/${filePath}`);
 
             if (mediaData?.token) {
                 const url = mk_endpoint(`media/${mediaData.token}`);
+                // グリッド用に縮小したサムネイル (生成できない場合は元のメディアを使う)
+                const thumbSize = Math.ceil(FileRenderManager.gridWidth * (window.devicePixelRatio || 1));
+                const thumbUrl = mk_endpoint(`thumbnail/${mediaData.token}?size=${thumbSize}`);
                 let mediaElement;
 
                 if (mediaData.cate === "image") {
                     mediaElement = $el("img.jupo-file-explorer-preview-media", { 
-                        src: url, 
+                        src: thumbUrl, 
                         alt: filePath, 
                         loading: "lazy"
                     });
+                    mediaElement.addEventListener("error", () => {
+                        mediaElement.src = url;
+                    }, { once: true });
                 } else if (mediaData.cate === "video") {
+                    // 動画はホバーするまで読み込まない (それまではサムネイルを表示)
                     mediaElement = $el("video.jupo-file-explorer-preview-media", {
-                        src: url,
+                        poster: thumbUrl,
                         muted: true,
                         loop: true,
-                        preload: "metadata"
+                        preload: "none"
                     });
 
+                    // サムネイルを生成できない場合は従来通り動画の先頭を表示
+                    const poster = new Image();
+                    poster.addEventListener("error", () => {
+                        mediaElement.preload = "metadata";
+                        mediaElement.src = url;
+                    }, { once: true });
+                    poster.src = thumbUrl;
+
                     // マウスホバーで再生 / 停止
                     itemElement.addEventListener("mouseenter", () => {
                         this.pauseAllVideos();
+                        if (!mediaElement.src) mediaElement.src = url;
                         mediaElement.play().catch(e => console.warn("Autoplay failed: ", e));
                     });
                     itemElement.addEventListener("mouseleave", () => {
@@ -0,0 +1,54 @@
+// ==============================================
+// プレビュー取得を少数のリクエストにまとめる
+// ==============================================
+// 同じタイミングで要求されたパスを1回の POST にまとめる
+// サーバーは1リクエストあたりのパス数に上限 (MAX_BULK_PATHS) があるため CHUNK_SIZE ずつ送る
+export const PREVIEW_CHUNK_SIZE = 500;
+
+export class PreviewBatcher {
+    // post(paths) -> {パス: 結果} を返す関数
+    constructor(post, chunkSize = PREVIEW_CHUNK_SIZE) {
+        this.post = post;
+        this.chunkSize = chunkSize;
+        this.pending = new Map();
+        this.scheduled = false;
+    }
+
+    request(apiPath) {
+        return new Promise((resolve) => {
+            if (!this.pending.has(apiPath)) this.pending.set(apiPath, []);
+            this.pending.get(apiPath).push(resolve);
+
+            if (!this.scheduled) {
+                this.scheduled = true;
+                setTimeout(() => this.flush(), 0);
+            }
+        });
+    }
+
+    async flush() {
+        const batch = [...this.pending];
+        this.pending = new Map();
+        this.scheduled = false;
+
+        // チャンクごとに送信し, 届いたものから解決する (1つの失敗で他のチャンクを失わない)
+        const chunks = [];
+        for (let i = 0; i < batch.length; i += this.chunkSize) {
+            chunks.push(batch.slice(i, i + this.chunkSize));
+        }
+        await Promise.all(chunks.map(chunk => this.flushChunk(chunk)));
+    }
+
+    async flushChunk(chunk) {
+        let result = {};
+        try {
+            result = await this.post(chunk.map(([apiPath]) => apiPath)) || {};
+        } catch (error) {
+            console.error("プレビューの読み込みに失敗しました:", error);
+        }
+
+        for (const [apiPath, resolvers] of chunk) {
+            resolvers.forEach(resolve => resolve(result[apiPath] || null));
+        }
+    }
+}
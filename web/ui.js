@@ -67,9 +67,33 @@ export const Utils = {
     //  --- LoRA ファイル選択ダイアログ --------------------
     useExplorer: true, // 設定にて変更可能
 
+    // バージョン付きのファイル一覧 (2回目以降は差分のみ取得)
+    fileLists: {},
+
+    async getFileList(dir) {
+        const cached = this.fileLists[dir];
+        const query = cached ? `?since=${encodeURIComponent(cached.version)}` : "";
+        const res = await api_get(`list/${dir}${query}`);
+
+        let files;
+        if (res?.delta && cached) {
+            const removed = new Set(res.removed);
+            files = cached.files.filter(file => !removed.has(file));
+            if (res.added.length > 0) {
+                files = files.concat(res.added).sort();
+            }
+        } else {
+            files = Array.isArray(res?.files) ? res.files : [];
+        }
+
+        if (res?.version) {
+            this.fileLists[dir] = { version: res.version, files: files };
+        }
+        return [...files];
+    },
+
     async getLoRAs() {
-        const apiLoras = await api_get("files/loras");
-        return [...(Array.isArray(apiLoras) ? apiLoras : [])];
+        return await this.getFileList("loras");
     },
 
     async showLoRAChooser(event, currentValue, callback) {
@@ -109,8 +133,7 @@ export const Utils = {
 
     // --- Checkpoint ファイル選択ダイアログ ---------------
     async getCheckpoints() {
-        const apiCheckpoints = await api_get("files/checkpoints");
-        return [...(Array.isArray(apiCheckpoints) ? apiCheckpoints : [])];
+        return await this.getFileList("checkpoints");
     }, 
 
     async showCheckpointChooser(event, currentValue, callback) {